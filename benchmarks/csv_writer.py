@@ -0,0 +1,131 @@
+'''
+    Benchmark of the bulk CSV writer (csvwriter.py in the webapp), used by
+    the CSV exports of in-situ historical data (to_csv.csv_lines) and of the
+    SST series (mhw_historical.sst2csv), against the row-by-row writers
+    previously used, which formatted each value with strftime and "%" and
+    wrote each line. A synthetic multi-year 10-minute series, with gaps,
+    missing values and values on a tie between two roundings, is written
+    in monthly chunks (as read from the historical store), as well as
+    integer columns (MHW events) with negative fractions and -0.0, and files
+    are checked to be byte-identical.
+
+    Usage:
+
+        python benchmarks/csv_writer.py [--years 5]
+
+'''
+
+from tempfile import TemporaryDirectory
+import pandas as pd
+import numpy as np
+import argparse
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'containers', 'webapp'))
+from to_csv import csv_lines
+from csvwriter import csv_blocks
+
+def legacy_variable(f, sub, header):
+    ''' Single variable, as written by the previous to_csv() '''
+    with open(f, 'w') as csvfile:
+        csvfile.write('*** Observed ***\n\n')
+        csvfile.write(header)
+        for t, value in zip(sub.index, sub['temp']):
+            t, value = t.strftime('%Y-%m-%d %H:%M'), '%.2f' % float(value)
+            csvfile.write(t + '\t' + value + '\n')
+
+def legacy_currents(f, sub, header):
+    ''' Currents, as written by the previous to_csv_currents_rose() '''
+    with open(f, 'w') as csvfile:
+        csvfile.write(header)
+        for t, a, b, c, d in zip(sub.index, sub['s-surface'], sub['d-surface'],
+                sub['s-seabed'], sub['d-seabed']):
+            t, v1, v2, v3, v4 = t, '%.1f' % float(a), '%.1f' % float(b), '%.1f' % float(c), '%.1f' % float(d)
+            csvfile.write(t.strftime('%Y-%m-%d %H:%M') + '\t' + v1 + '\t' + v2 + '\t' + v3 + '\t' + v4 + '\n')
+
+def legacy_sst(f, time, sst):
+    ''' SST series, as written by the previous sst2csv() '''
+    with open(f, 'w') as csvfile:
+        csvfile.write('Date,SST (ºC)\n')
+        for t, temp in zip(time, sst):
+            csvfile.write('%s,%.2f\n' % (t.strftime('%Y-%m-%d'), temp))
+
+def legacy_events(f, durations):
+    ''' Integer columns, as written by the previous mhw2csv() ('%03d', '%d') '''
+    with open(f, 'w') as csvfile:
+        csvfile.write('Event ID,duration (days)\n')
+        for j, d in enumerate(durations):
+            csvfile.write('%03d,%d,%03d\n' % (j, int(d), int(d)))
+
+def write(f, blocks):
+    ''' Write blocks of text to file "f" '''
+    with open(f, 'w') as csvfile:
+        for block in blocks:
+            csvfile.write(block)
+
+def synthetic(years, rng):
+    ''' 10-minute series of buoy variables, with a gap, missing values and
+        values on ties (e.g. 0.125, 12.25) '''
+    time = pd.date_range('2019-01-01', periods=years * 365 * 144, freq='10T', tz='UTC')
+    columns = ['temp', 's-surface', 'd-surface', 's-seabed', 'd-seabed']
+    df = pd.DataFrame({key: rng.normal(15, 20, len(time)).astype(np.float32)
+            for key in columns}, index=time)
+    df.iloc[len(df) // 3 : len(df) // 3 + 2000] = np.nan
+    for key in columns:
+        k = rng.integers(0, len(df), len(df) // 20)
+        df.iloc[k[0::2], columns.index(key)] = np.nan
+        df.iloc[k[1::2], columns.index(key)] = rng.integers(-800, 800, len(k[1::2])) / 8
+    return df
+
+def timed(function, *args):
+    ''' Seconds taken by function(*args) '''
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def main(years):
+    rng = np.random.default_rng(1)
+    df = synthetic(years, rng)
+    chunks = [chunk for _, chunk in df.groupby(df.index.strftime('%Y-%m'))]
+    print(f'{len(df)} rows ({years} years every 10 minutes) in {len(chunks)} monthly chunks')
+
+    days = pd.date_range('1982-01-01 12:00', '2021-12-31 12:00', freq='D').to_pydatetime()
+    sst = np.ma.masked_invalid(rng.normal(12, 3, len(days)))
+    sst[::97] = np.ma.masked
+
+    # Integers with negative fractions and -0.0 (written without a sign)
+    durations = np.concatenate((rng.uniform(-3, 3, 10000), rng.integers(-2000, 2000, 10000),
+            [-0.0, 0.0, -0.5, -0.999, 0.5, -1.0, -1.5, 999.9, 1e6]))
+    ids = np.arange(len(durations))
+
+    header = 'Date\tSurface speed (cm/s)\tSurface direction (º)\tSeabed speed (cm/s)\tSeabed direction (º)\n'
+    cases = [
+        ('temperature', lambda f: legacy_variable(f, df, 'Date\tSeawater temperature (ºC)\n'),
+            lambda f: write(f, csv_lines(chunks, 'temp', 'Deenish', 'en'))),
+        ('currents', lambda f: legacy_currents(f, df, header),
+            lambda f: write(f, csv_lines(chunks, 'currents', 'Deenish', 'en'))),
+        (f'SST ({len(days)} days)', lambda f: legacy_sst(f, days, sst),
+            lambda f: write(f, csv_blocks([(days, '%Y-%m-%d'), (sst, '%.2f')], 'Date,SST (ºC)\n', ','))),
+        (f'integers ({len(durations)})', lambda f: legacy_events(f, durations),
+            lambda f: write(f, csv_blocks([(ids, '%03d'), (durations, '%d'), (durations, '%03d')],
+                'Event ID,duration (days)\n', ','))),
+    ]
+
+    with TemporaryDirectory() as folder:
+        old, new = f'{folder}/legacy.csv', f'{folder}/bulk.csv'
+        for name, legacy, bulk in cases:
+            t_legacy, t_bulk = timed(legacy, old), timed(bulk, new)
+            with open(old, 'rb') as a, open(new, 'rb') as b:
+                assert a.read() == b.read(), name
+            size = os.path.getsize(new) / 2**20
+            print(f'{name + ":":22s} legacy {t_legacy:7.3f} s   bulk {t_bulk:7.3f} s '
+                  f'({t_legacy / t_bulk:.0f}x, {size:.1f} MB, byte-identical)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=5)
+    main(parser.parse_args().years)
@@ -0,0 +1,172 @@
+'''
+    Run the incremental SFTP downloader (downloader.py) against a local SFTP
+    server (paramiko stand-in serving a temporary directory of synthetic
+    *.xml files). Files are downloaded for a varying number of channels,
+    reporting bytes/s and files/s. A delay is added to each file request
+    on the server side to mimic the round trip to the remote host. Then, new files are added to the remote
+    folder to check that only these are listed and downloaded, and that
+    files failing on first attempt are retried.
+
+    Usage:
+
+        python benchmarks/sftp_download.py [--files 2000] [--channels 1 4 8] [--latency 0.05]
+
+'''
+
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+import argparse
+import paramiko
+import logging
+import socket
+import threading
+import time
+import sys
+import os
+
+site = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'containers', 'Deenish-Island', 'site')
+sys.path.insert(0, site)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Log to console rather than to /log/app.log
+import log
+log.set_logger = lambda: logging.getLogger('sftp_download')
+# Server-side noise when clients close their connections
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+from xml_parser import synthetic
+from manifest import open_manifest, known_files
+from downloader import download, read_watermark
+
+''' Local SFTP server '''
+
+class Server(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+class Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class SFTPServer(paramiko.SFTPServerInterface):
+    latency = 0
+
+    def list_folder(self, path):
+        out = []
+        for name in os.listdir(path):
+            attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attr.filename = name
+            out.append(attr)
+        return out
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        time.sleep(self.latency)
+        handle = Handle(flags)
+        handle.readfile = open(path, 'rb')
+        return handle
+
+def serve(sock, key):
+    ''' Accept connections, one thread per connection '''
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPServer)
+        transport.start_server(server=Server())
+
+def start_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(100)
+    key = paramiko.RSAKey.generate(2048)
+    threading.Thread(target=serve, args=(sock, key), daemon=True).start()
+    return sock
+
+def connector(port, flaky=()):
+    ''' SFTP connection factory. Files in "flaky" fail on first attempt. '''
+    failed = set()
+    def connect():
+        transport = paramiko.Transport(('127.0.0.1', port))
+        transport.connect(username='user', password='pswd')
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        get = sftp.get
+        def flaky_get(remotepath, localpath):
+            name = os.path.basename(remotepath)
+            if name in flaky and name not in failed:
+                failed.add(name)
+                raise paramiko.SSHException(f'simulated failure for {name}')
+            return get(remotepath, localpath)
+        sftp.get = flaky_get
+        close = sftp.close
+        sftp.close = lambda: (close(), transport.close())
+        return sftp
+    return connect
+
+def remote_files(folder, t0, n):
+    ''' Write "n" synthetic files, one every ten minutes since "t0" '''
+    names = []
+    for i in range(n):
+        t = t0 + timedelta(minutes=10*i)
+        name = f'{t:%Y%m%d%H%M}.xml'
+        with open(f'{folder}/{name}', 'w') as f:
+            f.write(synthetic(t, 'Deenish'))
+        names.append(name)
+    return names
+
+def main(n, channels, latency):
+    SFTPServer.latency = latency
+    sock = start_server()
+    port = sock.getsockname()[1]
+
+    with TemporaryDirectory() as remote:
+        t0 = datetime(2021, 6, 1)
+        names = remote_files(remote, t0, n)
+
+        for workers in channels:
+            with TemporaryDirectory() as local:
+                db = open_manifest(f'{local}/manifest.db')
+                files, size, elapsed = download(db, connector(port), remote,
+                        local, workers=workers)
+                assert files == n and known_files(db) == set(names)
+                print(f'{workers:2d} channels: {files} files, {size} bytes in {elapsed:6.2f} s '
+                      f'({files / elapsed:7.1f} files/s, {size / elapsed / 1e6:6.2f} MB/s)')
+
+        # Incremental run: only new files are downloaded, failures are retried
+        with TemporaryDirectory() as local:
+            db = open_manifest(f'{local}/manifest.db')
+            download(db, connector(port), remote, local, workers=max(channels))
+            files, _, _ = download(db, connector(port), remote, local)
+            assert files == 0
+            new = remote_files(remote, t0 + timedelta(minutes=10*n), 20)
+            files, _, _ = download(db, connector(port, flaky=set(new[::5])),
+                    remote, local, workers=max(channels))
+            assert files == len(new) and known_files(db) == set(names + new)
+            print(f'incremental run: {files} new files downloaded, watermark {read_watermark(db)}')
+
+    sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--latency', type=float, default=0.05,
+            help='server delay per file request, in seconds')
+    args = parser.parse_args()
+
+    main(args.files, args.channels, args.latency)
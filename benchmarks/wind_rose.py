@@ -0,0 +1,85 @@
+'''
+    Benchmark of the single-pass wind-rose binning kernel (frequencies() in
+    wind_rose.py) against the bin-by-bin mask loop previously used in
+    wind_rose(). Synthetic multi-year 10-minute series of currents, wind
+    and wave period are binned, with missing data and values exactly on
+    the bin edges, and frequencies are checked to be bit-identical.
+
+    Usage:
+
+        python benchmarks/wind_rose.py [--years 5]
+
+'''
+
+import numpy as np
+import argparse
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'containers', 'El-Campello', 'site'))
+from wind_rose import frequencies, DIRECTIONS_DEG, DIRECTION_EDGES, SPEED_EDGES, STEP
+
+def legacy(wind_rose_data, vartype):
+    ''' Frequencies as computed by the previous wind_rose() '''
+    wind_rose_data = wind_rose_data.copy()
+    for i in range(len(wind_rose_data)):
+        if DIRECTIONS_DEG[-1] + STEP <= wind_rose_data[i,1] and wind_rose_data[i,1] < 360:
+            wind_rose_data[i,1] = wind_rose_data[i,1] - 360
+    bin_edges_dir, bin_edges_speed = DIRECTION_EDGES, SPEED_EDGES[vartype]
+    frequencies = np.array([])
+    for i in range(len(bin_edges_speed)-1):
+        for j in range(len(bin_edges_dir)-1):
+            log_mask_speed = (wind_rose_data[:,0] >= bin_edges_speed[i]) & (wind_rose_data[:,0] < bin_edges_speed[i+1])
+            log_mask_direction = (wind_rose_data[:,1] >= bin_edges_dir[j]) & (wind_rose_data[:,1] < bin_edges_dir[j+1])
+            bin_size = len(wind_rose_data[log_mask_speed & log_mask_direction])
+            frequencies = np.append(frequencies, bin_size/len(wind_rose_data))
+    return frequencies*100
+
+def synthetic(n, vartype, rng):
+    ''' Nx2 (speed, direction) series, with NaN and values on bin edges '''
+    top = SPEED_EDGES[vartype][-1]
+    speed = rng.gamma(2, SPEED_EDGES[vartype][-2] / 3, n)
+    direction = rng.uniform(-20, 380, n)
+    k = rng.integers(0, n, n // 20)
+    speed[k[0::4]] = rng.choice(SPEED_EDGES[vartype], len(k[0::4]))
+    direction[k[1::4]] = rng.choice(np.append(DIRECTION_EDGES, [360, 0]), len(k[1::4]))
+    speed[k[2::4]] = np.nan
+    direction[k[3::4]] = np.nan
+    speed[:3] = top, -1, top - 1e-9
+    return np.vstack((speed, direction)).T
+
+def main(years):
+    rng = np.random.default_rng(1)
+    n = years * 365 * 144
+    series = [(synthetic(n, vartype, rng), vartype)
+            for vartype in ('currents', 'currents', 'wind', 'wave')]
+    print(f'{len(series)} series of {n} samples ({years} years every 10 minutes)')
+
+    start = time.perf_counter()
+    reference = [legacy(data, vartype) for data, vartype in series]
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [frequencies([s])[0] for s in series]
+    t_single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = frequencies(series)
+    t_batch = time.perf_counter() - start
+
+    for ref, one, many in zip(reference, single, batch):
+        assert np.array_equal(ref, one) and np.array_equal(ref, many)
+    print('frequencies are bit-identical')
+    print(f'legacy:        {t_legacy:8.3f} s')
+    print(f'one by one:    {t_single:8.3f} s ({t_legacy / t_single:.0f}x)')
+    print(f'all at once:   {t_batch:8.3f} s ({t_legacy / t_batch:.0f}x)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.years)
@@ -0,0 +1,171 @@
+'''
+    Benchmark of the single-pass buoy *.xml parser (xmlparser.py) against
+    the line-by-line parser previously used in buoy.py. A synthetic corpus
+    of Puertos del Estado *.xml files is written to a temporary directory
+    for both the Deenish Island and the El Campello descriptor sets. Both
+    parsers are run on the corpus and their output is checked to be equal.
+
+    Usage:
+
+        python benchmarks/xml_parser.py [--files 100000] [--site Deenish|Campello]
+
+'''
+
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from tempfile import TemporaryDirectory
+import pandas as pd
+import numpy as np
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'containers', 'Deenish-Island', 'site'))
+from xmlparser import read_xml_files, columns, DEENISH, CAMPELLO
+
+HEADER = ['<?xml version="1.0" encoding="UTF-8"?>', '<INSTAC>',
+        '  <Platform Name="Buoy"/>', '  <Provider>Puertos del Estado</Provider>',
+        '  <Observations>']
+
+def parameter(descr, value):
+    ''' Synthetic parameter block '''
+    return [f'    <Parameter Descr="{descr}">', f'      <Value>{value:.2f}</Value>',
+            '    </Parameter>']
+
+def profile(ncells):
+    ''' Synthetic DCPS profile block '''
+    lines = ['    <Profile Descr="DCPS">']
+    for i in range(ncells):
+        lines += [f'      <Cell ID="{i}">',
+            '        <Point ID="1">', f'          <Value>{i + 1}</Value>', '        </Point>',
+            '        <Point ID="2">', '          <Descr>Speed</Descr>',
+            f'          <Value>{random.uniform(0, 60):.1f}</Value>', '        </Point>',
+            '        <Point ID="3">', '          <Descr>Direction</Descr>',
+            f'          <Value>{random.uniform(0, 360):.1f}</Value>', '        </Point>',
+            '      </Cell>']
+    return lines + ['    </Profile>']
+
+def synthetic(time, site):
+    ''' Synthetic *.xml document for the given time and site '''
+    lines = HEADER + [f'    <Time>{time:%Y-%m-%dT%H:%M:%S}Z</Time>']
+    if site == 'Deenish':
+        for descr in ('Temperature', 'Salinity', 'Dissolved Oxygen', 'pH',
+                'Chlorophyll RFU', 'BGA-PE RFU'):
+            lines += parameter(descr, random.uniform(5, 20))
+        lines += profile(8)
+    else:
+        for descr in ('Water Temperature', 'Dissolved Oxygen', 'Turbidity',
+                'Significant Wave Height Hm0', 'Wave Peak Direction',
+                'Wave Peak Period', 'Wave Height Swell Hm0',
+                'Average Corrected Wind Diretion', 'Average Corrected Wind Speed'):
+            lines += parameter(descr, random.uniform(0, 20))
+        lines += profile(14)
+    return '\n'.join(lines + ['  </Observations>', '</INSTAC>']) + '\n'
+
+def corpus(path, n, site):
+    ''' Write "n" synthetic files, one every ten minutes '''
+    t0, files = datetime(2021, 6, 1), []
+    for i in range(n):
+        t = t0 + timedelta(minutes=10*i)
+        file = f'{path}/{t:%Y%m%d%H%M}.xml'
+        with open(file, 'w') as f:
+            f.write(synthetic(t, site))
+        files.append(file)
+    return files
+
+''' Line-by-line parser, as previously found in buoy.py '''
+
+def legacy_find_value(line, f=None):
+    if '<Value>' not in line:
+        if f:
+            line = f.readline()
+            if '<Value>' not in line:
+                return np.nan
+        else:
+            return np.nan
+    i = line.find('e>') + 2
+    e = line.find('</')
+    return float(line[i:e])
+
+def legacy_find_time(line):
+    i = line.find('e>') + 2
+    e = line.find('</')
+    return parse(line[i:e])
+
+def legacy_read_xml_file(file, var, site):
+    if site == 'Deenish':
+        keys = (('Descr="Temperature"', 'temp', 1), ('Descr="Salinity"', 'salt', 1),
+                ('Descr="Dissolved Oxygen"', 'O2', 1), ('Descr="pH"', 'pH', 1),
+                ('Descr="Chlorophyll RFU"', 'RFU', 1), ('Descr="BGA-PE RFU"', 'BGA', 1))
+    else:
+        keys = (('Descr="Water Temperature"', 'temp', 1), ('Descr="Dissolved Oxygen"', 'O2', 1),
+                ('Descr="Turbidity"', 'tur', 1), ('Average Corrected Wind Diretion', 'd-wind', 1),
+                ('Average Corrected Wind Speed', 's-wind', 3.6),
+                ('Descr="Significant Wave Height Hm0"', 'wave-height', 1),
+                ('Descr="Wave Peak Direction"', 'd-wave', 1), ('Descr="Wave Peak Period"', 's-wave', 1),
+                ('Descr="Wave Height Swell Hm0"', 'swell-height', 1))
+    speed, direction, new = [], [], {}
+    with open(file, 'r') as f:
+        for i in range(5): f.readline()
+        line = f.readline()
+        while len(line):
+            if '<Time>' in line:
+                new['time'] = legacy_find_time(line)
+            elif '<Point ID="2">' in line:
+                speed.append(legacy_find_value(f.readline(), f=f))
+            elif '<Point ID="3">' in line:
+                direction.append(legacy_find_value(f.readline(), f=f))
+            else:
+                for key, name, scale in keys:
+                    if key in line:
+                        new[name] = scale * legacy_find_value(f.readline()); break
+            line = f.readline()
+    if len(new) < len(keys) + 1 or not speed or not direction:
+        return
+    if site == 'Deenish':
+        new['s-surface'], new['d-surface'] = speed[0], direction[0]
+        new['s-seabed'], new['d-seabed'] = speed[-1], direction[-1]
+    else:
+        new['s-surface'], new['d-surface'] = speed[0], direction[0]
+        new['s-15m'], new['d-15m'] = speed[11], direction[11]
+    for key, value in new.items():
+        var[key].append(value)
+
+def benchmark(n, site):
+    descriptors = DEENISH if site == 'Deenish' else CAMPELLO
+    names = columns(descriptors)
+
+    with TemporaryDirectory() as path:
+        print(f'{site}: writing {n} synthetic files...')
+        files = corpus(path, n, site)
+
+        t0 = time.perf_counter()
+        legacy = {name: [] for name in names}
+        for file in files:
+            legacy_read_xml_file(file, legacy, site)
+        t1 = time.perf_counter()
+        new = read_xml_files(files, descriptors)
+        t2 = time.perf_counter()
+
+    # Check both parsers agree
+    legacy = pd.DataFrame(legacy).set_index('time')
+    new = pd.DataFrame({name: new[name] for name in names}).set_index('time')
+    legacy.index = pd.to_datetime(legacy.index, utc=True)
+    pd.testing.assert_frame_equal(legacy, new)
+
+    print(f'{site}: line-by-line parser {t1 - t0:8.2f} s ({n / (t1 - t0):9.0f} files/s)')
+    print(f'{site}: single-pass parser  {t2 - t1:8.2f} s ({n / (t2 - t1):9.0f} files/s)')
+    print(f'{site}: speed-up x{(t1 - t0) / (t2 - t1):.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--site', choices=('Deenish', 'Campello'), action='append')
+    args = parser.parse_args()
+
+    for site in args.site or ('Deenish', 'Campello'):
+        benchmark(args.files, site)
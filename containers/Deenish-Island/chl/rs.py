@@ -27,6 +27,7 @@
 
 from oceancolour import oceancolour
 import pickle
+from artifact import write_artifact
 from slider import Slider
 import numpy as np
 import json
@@ -103,8 +104,7 @@ def RS():
 
         # Export figure to file
         logger.info(f'{now()} EXPORTING FIGURES TO FILE...')
-        with open('/data/pkl/CHL.pkl', 'wb') as f:
-            pickle.dump({'CHL': chl, 'CHLANM': anm}, f)
+        write_artifact('/data/pkl/CHL.pkl', {'CHL': chl, 'CHLANM': anm})
 
         logger.info(f'{now()} FINISHED...')
 
@@ -0,0 +1,114 @@
+'''
+    Versioned binary artifacts, the files the containers write for the
+    webapp (/data/pkl/*.pkl).
+
+    An artifact is a dictionary of JSON values (e.g. the output of
+    jsonize()) and NumPy arrays, written as a single file:
+
+        MAGIC, schema version, header length, generation (PREAMBLE)
+        JSON header {'values': {key: value}, 'arrays': {key: [dtype, shape, offset]}}
+        data of the arrays, each aligned to ALIGN bytes
+
+    The file is written to a temporary copy which then replaces the
+    original, so readers never see a partially written artifact. Each write
+    increments the generation of the artifact, which is read from the first
+    bytes of the file (generation()), so readers can tell cheaply whether
+    anything has changed. Arrays can be read memory-mapped.
+
+    Files written with pickle (e.g. by containers not upgraded yet) are
+    still read, as generation 0.
+'''
+
+from pickle import load
+import numpy as np
+import struct
+import json
+import os
+
+MAGIC = b'ARTIFACT'
+
+# Version of the format. Readers refuse artifacts of a later version.
+SCHEMA = 1
+
+# Magic, schema version, header length (bytes) and generation
+PREAMBLE = struct.Struct('<8sIIQ')
+
+ALIGN = 64
+
+def aligned(n):
+    ''' Smallest multiple of ALIGN not less than n '''
+    return -(-n // ALIGN) * ALIGN
+
+def scalar(value):
+    ''' Encoding of NumPy scalars in the JSON header '''
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} cannot be saved in an artifact')
+
+def generation(path):
+    ''' Generation of artifact, or 0 if missing or not an artifact '''
+    try:
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE.size)
+    except FileNotFoundError:
+        return 0
+    if len(preamble) < PREAMBLE.size or not preamble.startswith(MAGIC):
+        return 0
+    return PREAMBLE.unpack(preamble)[3]
+
+def write_artifact(path, data):
+    ''' Write dictionary "data" as an artifact, then publish it. Values are
+        JSON types or NumPy arrays (saved as binary). Returns the new
+        generation. '''
+
+    values, arrays, blocks, offset = {}, {}, [], 0
+    for key, value in data.items():
+        if type(value) is np.ndarray and value.dtype.kind in 'biufcmM':
+            value = np.ascontiguousarray(value)
+            arrays[key] = [value.dtype.str, list(value.shape), offset]
+            blocks.append(value)
+            offset += aligned(value.nbytes)
+        else:
+            values[key] = value
+
+    header = json.dumps({'values': values, 'arrays': arrays}, default=scalar).encode()
+    # Pad header so that the arrays are aligned
+    header += b' ' * (aligned(PREAMBLE.size + len(header)) - PREAMBLE.size - len(header))
+
+    number = generation(path) + 1
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, SCHEMA, len(header), number))
+        f.write(header)
+        for block in blocks:
+            f.write(block.tobytes())
+            f.write(b'\0' * (aligned(block.nbytes) - block.nbytes))
+    os.replace(tmp, path)
+    return number
+
+def read_artifact(path, mmap=False):
+    ''' Read artifact as a dictionary. If "mmap", arrays are memory-mapped
+        (read-only) instead of read. Pickle files are loaded as they are. '''
+
+    with open(path, 'rb') as f:
+        preamble = f.read(PREAMBLE.size)
+        if not preamble.startswith(MAGIC):
+            f.seek(0)
+            return load(f)
+        _, schema, size, _ = PREAMBLE.unpack(preamble)
+        if schema > SCHEMA:
+            raise ValueError(f'{path}: artifact schema {schema} is not supported')
+        header = json.loads(f.read(size))
+
+        data, start = header['values'], PREAMBLE.size + size
+        for key, (dtype, shape, offset) in header['arrays'].items():
+            dtype, shape = np.dtype(dtype), tuple(shape)
+            count = int(np.prod(shape))
+            if mmap and count:
+                data[key] = np.memmap(path, dtype=dtype, mode='r',
+                        offset=start + offset, shape=shape)
+            else:
+                data[key] = np.empty(shape, dtype=dtype)
+                f.seek(start + offset)
+                f.readinto(data[key].data.cast('B'))
+    return data
@@ -1,34 +1,31 @@
-from pickle import dump
 from datetime import datetime
-from json import dumps
+from encoder import encode, axis
+from artifact import write_artifact
 from log import set_logger, now
 
 logger = set_logger()
 
-def jsonize(data):
+# Decimal places of output variables
+PRECISION = {'fc_sst': 2}
+
+def jsonize(data, precision=PRECISION):
+    ''' Encode each variable (but strings) as JSON, with the decimal places
+        of "precision" '''
     logger.info(f'{now()} OUTPUT: Starting JSONization of data dict')
     for k, v in data.items():
         logger.info(f'   {now()} JSON {k}')
         if isinstance(v, str): continue
         try:
-            data[k] = dumps(v) 
+            data[k] = encode(v, precision.get(k))
         except TypeError as ERR:
-            if str(ERR) == 'Object of type datetime is not JSON serializable':
-                value = [i.strftime('%Y-%m-%d %H:%M') for i in v]
-                data[k] = dumps(value)   
-            elif str(ERR) == 'Object of type ndarray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            elif str(ERR) == 'Object of type MaskedArray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            else:
-                logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
+            logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
     return data
 
 def send_output(FC):
     ''' Produce output PICKLE file to be sent to web app '''
 
     MODEL = {
-        'fc_sst_time': FC['sst'][0],
+        'fc_sst_time': axis(FC['sst'][0]),
         'fc_sst': FC['sst'][1],
  
         'tf': FC['sst'][0][-1].strftime('%Y-%m-%d %H:%M'),
@@ -45,5 +42,4 @@ def send_output(FC):
         }
 
     outfile = '/data/pkl/MODEL-1.pkl'
-    with open(outfile, 'wb') as f:
-        dump(jsonize(MODEL), f)
+    write_artifact(outfile, jsonize(MODEL))
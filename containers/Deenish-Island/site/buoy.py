@@ -1,48 +1,186 @@
-from datetime import datetime, timedelta
-from pickle import dump
-import json
-from dateutil.parser import parse
+from datetime import datetime
+from contextlib import contextmanager
 from netCDF4 import Dataset
-from glob import glob
 import paramiko
 import pysftp
 import pandas as pd
 import numpy as np
-from pytz import timezone
+import fcntl
+import time
 import os
+from records import parse_records, valid_records
+from store import append_records, read_partition, write_partition, publish, read_table, partitions, previous, rollup
+from manifest import open_manifest, sync_manifest, remove_empty, manifest_stats, set_status, bundled_files
+from bundle import compact, read_texts
+from downloader import download
+from xmlparser import read_xml_texts, columns, DEENISH
+from qc import quality_control, lookback, DEENISH as TESTS
+from roseindex import update_index
 from log import set_logger, now
 
 logger = set_logger()
 
-def to_netcdf(df, ncname):
+# Rollup tiers of the 10-minute table (mean, min, max and count)
+TIERS = ('1H', '1D')
+
+# Wind roses in the index of historical data (level, vartype)
+ROSES = [('surface', 'currents'), ('seabed', 'currents')]
+
+@contextmanager
+def locked(name, blocking=True):
+    ''' Exclusive lock of file "name" (through "name.lock"). If not
+        "blocking", yields False at once when another process holds it,
+        and True otherwise. '''
+    fd = os.open(name + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+def fsync(name):
+    ''' Flush file "name" to disk '''
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def to_netcdf(df, ncname, append=False):
     ''' 
         Generate seawater temperature NetCDF from Deenish Island in-situ
         observations. This is used for the remote-sensing historical
-        data selection tool. 
+        data selection tool. If "append", rows are added in place at the
+        end of the existing file (unlimited dimension), under the lock of
+        the file, so readers never see a partially written file. Otherwise
+        the file is written to a temporary file which then replaces the
+        original.
     '''
 
-    # Get time from Deenish Island data frame
-    time, temp = df.index, np.array(df.get('temp'))
+    # Get time from Deenish Island data frame (seconds since epoch)
+    time, temp = df.index.asi8 / 1e9, np.array(df.get('temp'))
 
-    n = len(temp) # Length of time series
+    if append:
+        with locked(ncname):
+            with Dataset(ncname, 'a') as nc:
+                # Time last, so that an interrupted append leaves the last
+                # time missing and the file is written again next time
+                n = len(nc.dimensions['row'])
+                nc.variables['temp'][n:n + len(temp)] = temp
+                nc.variables['time'][n:n + len(time)] = time
+            fsync(ncname)
+        return
 
-    with Dataset(ncname, 'w', format='NETCDF4') as nc:
-        nc.createDimension('row', n)
+    tmp = ncname + '.tmp'
+    with Dataset(tmp, 'w', format='NETCDF4') as nc:
+        nc.createDimension('row', None)
 
         # Create time variable
         timevar = nc.createVariable('time', 'f8', dimensions=('row'))
         timevar.standard_name = 'time'
         timevar.units = 'seconds since 1970-01-01'
-        # Write time
-        timevar[:] = np.array([i.timestamp() for i in time])
 
         # Create temperature variable
         tempvar = nc.createVariable('temp', 'f4', dimensions=('row'))
         tempvar.standard_name = 'sea_water_temperature'
         tempvar.units = 'degC'
-        # Write temperature
+
+        # Write time and temperature
+        timevar[:] = time
         tempvar[:] = temp
 
+    fsync(tmp)
+    os.replace(tmp, ncname)
+
+def netcdf_last_time(ncname):
+    ''' Time of the last row in NetCDF, or None if rows cannot be appended '''
+    try:
+        with Dataset(ncname, 'r') as nc:
+            row = nc.dimensions['row']
+            # Files written before the time dimension was unlimited
+            if not row.isunlimited() or not len(row):
+                return None
+            last = nc.variables['time'][len(row) - 1]
+            # Interrupted append
+            if np.ma.is_masked(last):
+                return None
+            return pd.Timestamp(float(last), unit='s', tz='UTC')
+    except (FileNotFoundError, OSError, KeyError):
+        return None
+
+def to_csv(df, csvname, append=False):
+    ''' Generate seawater temperature CSV from Deenish Island in-situ
+        observations (rows with valid temperature only). If "append",
+        complete lines are added at the end of the existing file with a
+        single write (O_APPEND), so readers see either none or all of them.
+        Otherwise the file is written to a temporary file which then
+        replaces the original. '''
+
+    temp = df['temp'].to_numpy()
+    valid = temp > 0.0
+    dates = df.index[valid].strftime('%Y-%m-%d %H:%M')
+    values = np.char.mod('%.2f', temp[valid])
+    lines = ''.join(f'{t},{T}\n' for t, T in zip(dates, values))
+
+    if append:
+        data = lines.encode()
+        fd = os.open(csvname, os.O_WRONLY | os.O_APPEND)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return
+
+    tmp = csvname + '.tmp'
+    with open(tmp, 'w') as f:
+        # Write header
+        f.write('Seawater temperature at Deenish Island\n\n')
+        f.write('Date,in-situ seawater temperature (ºC)\n')
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, csvname)
+
+def csv_last_time(csvname):
+    ''' Time of the last row in CSV, or None if there are no rows (or the
+        last line is incomplete) '''
+    try:
+        with open(csvname, 'rb') as f:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - 256))
+            text = f.read().decode()
+        if not text.endswith('\n'):
+            return None
+        last = text.rstrip('\n').split('\n')[-1]
+        return pd.Timestamp(datetime.strptime(last.split(',')[0], '%Y-%m-%d %H:%M'), tz='UTC')
+    except (FileNotFoundError, ValueError):
+        return None
+
+def export(store, changed):
+    ''' Update NetCDF and CSV for historical data selector tool. Only rows
+        after the last row written are appended, unless history has changed
+        at or before that row ("changed" is the earliest 10-minute time with
+        new data, or None after a rebuild), in which case the whole file is
+        written again. '''
+
+    ncname, csvname = '/data/netcdf/Deenish-Island.nc', '/data/csv/Deenish-Island.csv'
+
+    for name, last_time, write in ((ncname, netcdf_last_time, to_netcdf),
+                                   (csvname, csv_last_time, to_csv)):
+        last = last_time(name)
+        if last is None or changed is None or changed <= last:
+            logger.info(f'{now()} Writing {name}...')
+            write(read_table(store, '10T', columns=['temp'], freq='10T'), name)
+        else:
+            var = read_table(store, '10T', t0=last, columns=['temp'], freq='10T', closed='right')
+            logger.info(f'{now()} Appending {len(var)} rows to {name}...')
+            write(var, name, append=True)
+
 def Buoy(conf):
     
     # Puertos del Estado INSTAC SFTP hostname and credentials    
@@ -52,221 +190,158 @@ def Buoy(conf):
     localpath = '/xml'
     logger.info(f'{now()} BUOY: Localpath is {localpath}')
       
-    # Retrieve names of *.xml files already downloaded and save to list
-    local = update_local_directory(localpath, '.xml')
-    logger.info(f'{now()} Local directory inspected. Number of files is {len(local)}')
-
-    # Remove empty (corrupted) files
-    files = sorted(glob(localpath + '/*.xml'))
-    for file in files:        
-        if is_empty(file):
-            os.remove(file)
-   
-    # Download files
-    try:
-        xml_file_download(local, localpath, host, user, pswd, folder)         
-    except paramiko.SSHException:
-        pass
-    
-    # Remove empty (corrupted) files
-    files = sorted(glob(localpath + '/*.xml'))
-    for file in files:
-        if is_empty(file):
-            os.remove(file)
-   
-    # Update list of names of *.xml files already downloaded
-    local = update_local_directory(localpath, '.xml')
-
-    # Initialize dictionary of output variables    
-    var = vardict() 
-    
-    logger.info(f'{now()} Reading files...')        
-    for f in local:
-        read_xml_file(localpath + '/' + f, var)
-
-    # Apply a quality control (mask missing data)
-    var = quality_control(var)    
-
-    var = pd.DataFrame(var)
-    # Resample at 10 minutes to ensure continuous time series
-    var = var.resample('10T', on='time').mean()
-
-    # Generate NetCDF for historical data selector tool
-    ncname = '/data/netcdf/Deenish-Island.nc'
-    logger.info(f'{now()}: Writing temperature to NetCDF {ncname}...')
-    to_netcdf(var, ncname)
-
-    # Generate CSV for historical data selector tool
-    csvname = '/data/csv/Deenish-Island.csv'
-
-    logger.info(f'{now()} Creating CSV file {csvname}...')
-    with open(csvname, 'w') as f:
-        # Write header
-        f.write('Seawater temperature at Deenish Island\n\n')
-        f.write('Date,in-situ seawater temperature (ºC)\n')
-        # Write data line by line
-        for t, T in zip(var.index, var.get('temp')):
-            if T > 0.0:
-                f.write(f'%s,%.2f\n' % (t.strftime('%Y-%m-%d %H:%M'), T))
-
     outdir = '/data/his/Deenish-Island/'
     if not ( os.path.isdir(outdir) ):
         os.makedirs(outdir)
 
-    logger.info(f'{now()} Saving historical records...')        
-    with open(f'{outdir}Deenish-Island.pkl', 'wb') as f:
-        dump(var, f)
-
-    logger.info(f'{now()} Quitting BUOY')  
-    return var 
-
-def is_empty(file):
-    ''' Check if downloaded file is empty (silent, failed download) '''
-    f = open(file, 'r')
-    lines = f.readlines()
-    if not lines:
-        return True
-    else:
-        return False
-
-def quality_control(var):
-
-    for key in var.keys():
-        var[key] = [i if ( i != 68. and i != 81. ) else np.nan for i in var[key]]
-
+    # The store and the manifest are updated under the lock, also taken by
+    # the backfill while it rebuilds the store. Meanwhile, runs are skipped
+    # (files are downloaded and parsed by the next run).
+    with locked(f'{outdir}store', blocking=False) as free:
+        if not free:
+            logger.info(f'{now()} BUOY: Store locked by backfill, skipping update')
+            return f'{outdir}store'
+
+        # Manifest of *.xml files already downloaded. The local directory is
+        # only listed again if it has been modified outside of the manifest.
+        db = open_manifest(f'{outdir}manifest.db')
+        added, removed = sync_manifest(db, localpath, '.xml')
+        logger.info(f'{now()} Manifest synchronized ({added} added, {removed} removed)')
+
+        # Remove empty (corrupted) files
+        remove_empty(db, localpath)
+
+        # Download files
+        try:
+            xml_file_download(db, localpath, host, user, pswd, folder,
+                    int(conf.get('channels', 4)))
+        except paramiko.SSHException:
+            pass
+
+        # Remove empty (corrupted) files
+        remove_empty(db, localpath)
+
+        # Pack files of closed days into daily bundles
+        compact(db, localpath)
+
+        # Parse files that are new or have been downloaded again. All files are
+        # parsed if the historical store has not been built yet.
+        store = f'{outdir}store'
+        stats = manifest_stats(db, 'new' if os.path.isdir(store) else None)
+        names = sorted(stats)
+        logger.info(f'{now()} Reading {len(names)} new or modified files...')
+        if names:
+            reader = lambda files: read_buoy_files(files,
+                    bundled_files(db, [os.path.basename(file) for file in files]))
+            stats = pd.DataFrame.from_dict(stats, orient='index', columns=['size', 'mtime'])
+            records = parse_records(localpath, names, stats, reader)
+            set_status(db, names, records['valid'])
+            history(records, outdir)
+        db.close()
+
+    logger.info(f'{now()} Quitting BUOY')
+    return store
+
+def history(records, outdir, rebuild=False):
+    ''' Append the complete records to the historical store, and resample
+        at 10 minutes only the monthly partitions touched. This is shared
+        with the backfill command, which rebuilds the store from scratch:
+        the new store is built next to it, and then replaces it at once, so
+        the webapp never sees a partial store (see store.publish). '''
+
+    store = f'{outdir}store'
+    if rebuild:
+        store, link = f'{store}.{time.time_ns()}', store
+
+    logger.info(f'{now()} Saving historical records...')
+    new = valid_records(records, columns(DEENISH))
+    touched = append_records(store, 'raw', new, 'file')
+    months = checked(store, touched)
+    for name in months:
+        resample(store, name)
+    update_index(store, ROSES, None if rebuild else months)
+    if rebuild:
+        publish(link, store)
+        store = link
+    logger.info(f'{now()} Partitions updated: {", ".join(touched)}')
+
+    # Update NetCDF and CSV for historical data selector tool
+    if len(new):
+        export(store, None if rebuild else new.index.min().floor('10T'))
+
+    return touched
+
+def checked(store, touched):
+    ''' Partitions to quality control again after "touched" have changed.
+        The first samples of the following partition are checked against
+        the last samples of a touched one, so it is included too. '''
+    names = partitions(store, 'raw')
+    months = set(touched)
+    for name in touched:
+        i = names.index(name) + 1
+        if i < len(names):
+            months.add(names[i])
+    return sorted(months)
+
+def variables(raw):
+    ''' Historical structure of output variables (NumPy columns) '''
+    var = {key: raw[key].to_numpy() for key in columns(DEENISH) if key != 'time'}
+    var['time'] = raw.index
     return var
 
-def read_xml_file(file, var):
-    ''' Read an *.xml file and update the fields of interest '''
-
-    # DCPS speed [cm/] and direction [Deg.M]
-    speed, direction = [], []
-
-    # Dictionary of new values
-    new = {'time': 0, 'temp': 0, 'salt': 0, 'O2': 0, 'pH': 0, 'RFU': 0, 'BGA': 0,
-        's-surface': 0, 's-seabed': 0, 'd-surface': 0, 'd-seabed': 0}
-
-    # Add some tests (check all variables are read in each file)
-    checklist = {'time': False, 'temp': False, 'salt': False, 'O2': False, 'pH': False,
-            'RFU': False, 'BGA': False, 'speed': False, 'direction': False}
-    
-    with open(file, 'r') as f:
-
-        # Discard header
-        for i in range(5): f.readline()
+def resample(store, name):
+    ''' Quality control the raw records of a partition, and resample at 10
+        minutes. Flags are saved to the "qc" table, next to "raw". Hourly
+        and daily rollups of the 10-minute data are updated too. '''
 
-        line = f.readline()
-        while len(line):
+    raw = read_partition(store, 'raw', name)
 
-            if '<Time>' in line:
-                                     
-                new['time'] = find_time(line); checklist['time'] = True
+    # Last samples of the previous partition, for tests looking back in time
+    context = previous(store, 'raw', name, lookback(TESTS))
+    if context is not None:
+        context = variables(context)
 
-            elif 'Descr="Temperature"' in line:
-                 
-                new['temp'] = find_value(f.readline()); checklist['temp'] = True
+    # Apply a quality control (mask missing and bad data)
+    var, flags = quality_control(variables(raw), TESTS, context)
+    write_partition(store, 'qc', name, pd.DataFrame(flags, index=raw.index))
 
-            elif 'Descr="Salinity"' in line:
-
-                new['salt'] = find_value(f.readline()); checklist['salt'] = True
-
-            elif 'Descr="Dissolved Oxygen"' in line:
-
-                new['O2'] = find_value(f.readline()); checklist['O2'] = True
-
-            elif 'Descr="pH"' in line:       
-
-                new['pH'] = find_value(f.readline()); checklist['pH'] = True
-
-            elif 'Descr="Chlorophyll RFU"' in line:
-
-                new['RFU'] = find_value(f.readline()); checklist['RFU'] = True
-                
-            elif 'Descr="BGA-PE RFU"' in line:
-
-                new['BGA'] = find_value(f.readline()); checklist['BGA'] = True
-
-            elif '<Point ID="2">' in line:                             
+    var = pd.DataFrame(var)
+    # Resample at 10 minutes to ensure continuous time series
+    var = var.resample('10T', on='time').mean()
+    write_partition(store, '10T', name, var)
 
-                speed.append(find_value(f.readline(), f=f)); checklist['speed'] = True
+    # Rollup tiers for long-range queries (directions averaged as vectors)
+    angles = [key for key in var if key.startswith('d-')]
+    for freq in TIERS:
+        write_partition(store, freq, name, rollup(var, freq, angles))
 
-            elif '<Point ID="3">' in line:
+def requalify(outdir):
+    ''' Quality control the whole history again (e.g. after a change in
+        the tests), one monthly partition at a time, without parsing *.xml
+        files. Returns the number of partitions. '''
 
-                direction.append(find_value(f.readline(), f=f)); checklist['direction'] = True
+    store = f'{outdir}store'
+    names = partitions(store, 'raw')
+    for name in names:
+        resample(store, name)
+    update_index(store, ROSES)
+    logger.info(f'{now()} Quality control applied to {len(names)} partitions')
 
-            # Read next line
-            line = f.readline()
- 
+    if names:
+        export(store, None)
 
-    # Check all required variables were successfully found in file
-    for key, value in checklist.items():
-        if not value:
-            logger.debug(f'Variable {key} not found in file {file}'); return
+    return len(names)
 
-    # Subset surface and seabed velocities from DCPS
-    new['s-surface'], new['d-surface'] = speed[0], direction[0]
-    new['s-seabed'], new['d-seabed'] = speed[-1], direction[-1]
+def read_buoy_files(files, bundles={}):
+    ''' Read *.xml files with the Deenish Island set of descriptors. Files
+        packed into daily bundles are given as {name: day} in "bundles" '''
+    return read_xml_texts(read_texts(files, bundles), len(files), DEENISH)
 
-    # Append new values to historical structure
-    for key, value in new.items():
-        var[key].append(value)
-    return
-                 
-def find_value(line, f=None):
-    ''' Get numeric value from line of text '''
-    if '<Value>' not in line:
-        if f:
-            line = f.readline()
-            if '<Value>' not in line:
-                return np.nan 
-        else:
-            return np.nan 
-    i = line.find('e>') + 2
-    e = line.find('</') 
-    return float(line[i:e])    
-
-def find_time(line):
-    ''' Get time from line of text '''
-    i = line.find('e>') + 2
-    e = line.find('</') 
-    return parse(line[i:e])    
-
-def update_local_directory(localpath, extension):
-    ''' Get a list with the names of *.xml files already downloaded '''
-    local = []
-    for file in os.listdir(localpath):
-        if file.endswith(extension):
-            local.append(file)
-    return sorted(local)
-         
-def xml_file_download(local, localpath, host, user, pswd, folder):
-    ''' Download *.xml files to local path using SFTP credentials '''
+def xml_file_download(db, localpath, host, user, pswd, folder, channels):
+    ''' Download new *.xml files to local path using SFTP credentials '''
     logger.info(f'{now()} XML_FILE_DOWNLOAD Setting known hosts')
     cnopts = pysftp.CnOpts(knownhosts='known_hosts')
-    # Open SFTP connection and start the download
-    logger.info(f'{now()} XML_FILE_DOWNLOAD Opening SFTP connection')
-    with pysftp.Connection(host=host, username=user, password=pswd, cnopts=cnopts) as sftp:
-        logger.info(f'{now()} XML_FILE_DOWNLOAD Changing SFTP folder')
-        sftp.cwd(folder)
-        logger.info(f'{now()} XML_FILE_DOWNLOAD Running SFTP.LISTDIR()')
-        for file in sftp.listdir():
-            if ( file not in local ) and file[-4:] == '.xml':
-                logger.info(f'{now()}: Downloading {file}'); 
-                count = 0
-                while count < 3:
-                    try: 
-                        sftp.get(file, localpath=localpath + '/' + file); 
-                        if is_empty(localpath + '/' + file):
-                            count += 1; continue
-                        break
-                    except paramiko.SSHException: count += 1; continue
-
-def vardict():
-    ''' Initialize empty dictionary for buoy data '''
-    return {
-            'time':  [], 'temp': [], 'salt': [], 'pH': [], 'O2': [], 'RFU': [], 'BGA': [],
-
-            's-surface': [], 'd-surface': [],
-
-            's-seabed': [], 'd-seabed': [], 
-            }
+    # Each SFTP channel opens its own connection
+    connect = lambda: pysftp.Connection(host=host, username=user, password=pswd, cnopts=cnopts)
+    logger.info(f'{now()} XML_FILE_DOWNLOAD Downloading over {channels} SFTP channels')
+    download(db, connect, folder, localpath, workers=channels)
@@ -0,0 +1,50 @@
+'''
+    Site climatology (seasonal cycle and 90th percentile) of seawater
+    temperature, by day of year.
+
+    Climatologies have 366 days, in the calendar of a leap year, as in
+    mhw.py: 29 February is always day 60, and in other years days from
+    1 March on are shifted by one, so that a calendar date always maps to
+    the same day of the climatology.
+'''
+
+from functools import lru_cache
+import pandas as pd
+import numpy as np
+import pickle
+
+@lru_cache()
+def load_climatology(infile):
+    ''' Read climatology from local PICKLE file, once per process. Returns
+        dense arrays, where day of year "d" is at position d - 1. '''
+    with open(infile, 'rb') as f:
+        clim = pickle.load(f)
+
+    i = np.asarray(clim['time'], dtype=int) - 1
+    seas, pc90 = np.full(366, np.nan), np.full(366, np.nan)
+    seas[i], pc90[i] = clim['seas'], clim['pc90']
+    return seas, pc90
+
+def day_of_year(time):
+    ''' Day of year (1-366) in the calendar of a leap year '''
+    time = pd.DatetimeIndex(time)
+    return time.dayofyear.to_numpy() + ((time.month > 2) & ~time.is_leap_year)
+
+def site_climatology(infile, time):
+    ''' Climatology at 12:00 of each day from a day before the first time to
+        8 days after the last time. Returns time, seasonal cycle and 90th
+        percentile. '''
+
+    seas, pc90 = load_climatology(infile)
+
+    t0, t1 = time[0] - pd.Timedelta(days=1), time[-1] + pd.Timedelta(days=8)
+
+    # Noons in [t0, t1)
+    noon = t0.normalize() + pd.Timedelta(hours=12)
+    if noon < t0:
+        noon += pd.Timedelta(days=1)
+    Time = pd.date_range(noon, t1, freq='D')
+    Time = Time[Time < t1]
+
+    i = day_of_year(Time) - 1
+    return Time, seas[i], pc90[i]
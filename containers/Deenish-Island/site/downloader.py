@@ -0,0 +1,157 @@
+'''
+    Incremental, concurrent download of *.xml files from the Puertos del
+    Estado INS-TAC SFTP folder.
+
+    A high-water mark (modification time and name of the newest remote file
+    already downloaded) is kept in the manifest. The remote folder is listed
+    with listdir_attr, and only entries not older than the mark (less a safety
+    margin, for files arriving late or clock skew) are considered. Missing
+    files are fetched concurrently over a small pool of SFTP channels, with
+    retries for each file.
+
+    The mark always advances past the files listed. A file that still fails
+    after its retries is recorded in the manifest (table "failures") and
+    fetched again by name on the next runs, up to "runs" runs; then it is
+    given up (and logged), so that a file that keeps failing never holds the
+    downloader back.
+
+    "connect" is a function returning a new SFTP connection, which must
+    provide listdir_attr(path), get(remotepath, localpath) and close(), as
+    both pysftp.Connection and paramiko.SFTPClient do. This allows running
+    the downloader against a local SFTP server for testing.
+'''
+
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import os
+from manifest import (get_meta, set_meta, known_files, add_file, failed_files,
+        set_failed, remove_failed)
+from log import set_logger, now
+
+logger = set_logger()
+
+def read_watermark(db):
+    ''' High-water mark (mtime, name) of remote files already downloaded '''
+    value = get_meta(db, 'watermark')
+    if value is None:
+        return None
+    mtime, name = value.split(' ', 1)
+    return float(mtime), name
+
+def write_watermark(db, mark):
+    set_meta(db, 'watermark', f'{mark[0]!r} {mark[1]}')
+    db.commit()
+
+def new_entries(sftp, folder, extension, watermark, known, margin):
+    ''' List the remote files that are newer than the high-water mark (less
+        "margin" seconds) and have not been downloaded yet. Returns a list
+        of (mtime, name, size), sorted by modification time. '''
+    since = watermark[0] - margin if watermark else float('-inf')
+    entries = []
+    for attr in sftp.listdir_attr(folder):
+        name = attr.filename
+        if name.endswith(extension) and attr.st_mtime >= since and name not in known:
+            entries.append((attr.st_mtime, name, attr.st_size))
+    return sorted(entries)
+
+def failed_entries(db, known, runs):
+    ''' Files that failed on earlier runs and have not been downloaded since.
+        Returns those to retry (failed on less than "runs" runs) as a list of
+        (mtime, name, size), and the names of those given up. '''
+    failures = failed_files(db)
+    remove_failed(db, [name for name in failures if name in known])
+    retry = sorted((mtime, name, None) for name, (mtime, n) in failures.items()
+            if n < runs and name not in known)
+    return retry, {name for name, (mtime, n) in failures.items() if n >= runs}
+
+def channel(channels, connect, opened):
+    ''' SFTP connection of the current worker thread. Each thread opens
+        its own connection on first use. '''
+    if getattr(channels, 'sftp', None) is None:
+        channels.sftp = connect()
+        opened.append(channels.sftp)
+    return channels.sftp
+
+def drop_channel(channels, opened):
+    ''' Drop a broken connection. A new one is opened on next use. '''
+    sftp, channels.sftp = getattr(channels, 'sftp', None), None
+    if sftp is not None:
+        opened.remove(sftp)
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+def fetch(channels, connect, opened, folder, localpath, name, retries):
+    ''' Download a single file. The file is written to a temporary name
+        first, so that an interrupted download is never taken for a complete
+        file. Returns the number of bytes downloaded (0 if failed). '''
+    local, tmp = f'{localpath}/{name}', f'{localpath}/{name}.part'
+    for attempt in range(retries):
+        try:
+            channel(channels, connect, opened).get(f'{folder}/{name}', tmp)
+            size = os.path.getsize(tmp)
+            if size:
+                os.replace(tmp, local)
+                return size
+            # Empty file (silent, failed download)
+        except Exception as err:
+            logger.info(f'{now()} DOWNLOAD: {name} failed ({err}), attempt {attempt + 1}')
+            drop_channel(channels, opened)
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+    return 0
+
+def download(db, connect, folder, localpath, extension='.xml', workers=4,
+        retries=3, margin=86400, runs=3):
+    ''' Download new remote files to local path and add them to manifest.
+        Returns the number of files and bytes downloaded, and the elapsed
+        time in seconds. '''
+
+    start = time.perf_counter()
+
+    # Thread-local SFTP connections, and list of all connections opened
+    channels, opened = threading.local(), []
+    try:
+        watermark, known = read_watermark(db), known_files(db)
+        retried, given_up = failed_entries(db, known, runs)
+        entries = new_entries(channel(channels, connect, opened), folder,
+                extension, watermark, known | given_up, margin)
+        # Listing connection is not needed by the worker threads
+        drop_channel(channels, opened)
+        logger.info(f'{now()} DOWNLOAD: {len(entries)} new files since watermark {watermark}')
+        listed = {entry[1] for entry in entries}
+        retried = [entry for entry in retried if entry[1] not in listed]
+        if retried:
+            logger.info(f'{now()} DOWNLOAD: {len(retried)} files failed on earlier runs')
+
+        files, size, failed = 0, 0, []
+        with ThreadPool(workers) as pool:
+            results = pool.imap(lambda entry: fetch(channels, connect, opened,
+                folder, localpath, entry[1], retries), entries + retried)
+            # Manifest is updated from this (main) thread only
+            for entry, nbytes in zip(entries + retried, results):
+                if nbytes and add_file(db, localpath, entry[1]):
+                    files, size = files + 1, size + nbytes
+                    remove_failed(db, [entry[1]])
+                else:
+                    failed.append(entry)
+                    if set_failed(db, entry[1], entry[0]) >= runs:
+                        logger.info(f'{now()} DOWNLOAD: {entry[1]} failed on {runs} runs, given up')
+    finally:
+        for sftp in list(opened):
+            sftp.close()
+
+    # Advance the watermark past all files listed: failed files are retried
+    # from the manifest, not by holding the watermark back
+    if entries:
+        mark = max(entries)[:2]
+        if watermark is None or mark > watermark:
+            write_watermark(db, mark)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f'{now()} DOWNLOAD: {files} files, {size} bytes in {elapsed:.1f} s '
+            f'({files / elapsed:.1f} files/s, {size / elapsed:.0f} bytes/s). '
+            f'{len(failed)} failed.')
+    return files, size, elapsed
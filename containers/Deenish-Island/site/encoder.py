@@ -0,0 +1,118 @@
+'''
+    Type-dispatched JSON encoding of output variables.
+
+    Each value is encoded once, after its type: NumPy arrays (floats
+    rounded to the decimal places of the variable, if given), masked
+    arrays (masked values as null), times ('%Y-%m-%d %H:%M'), NumPy scalars
+    and plain JSON types. NaN is written as NaN, as json.dumps does, since
+    the output is embedded in JavaScript.
+
+    Time axes of the charts are encoded as start, step and length (see
+    axis()), and expanded in the browser by timeaxis() (static/js/timeaxis.js).
+'''
+
+from datetime import datetime
+from json import dumps
+import pandas as pd
+import numpy as np
+
+TIME = '%Y-%m-%d %H:%M'
+
+MINUTE = 60 * 10**9
+
+def floats(values, decimals=None):
+    ''' List of floats, rounded to "decimals" if given '''
+    values = np.asarray(values, dtype=float)
+    if decimals is not None:
+        values = np.round(values, decimals)
+    return values.tolist()
+
+def default(value):
+    ''' Encoding of NumPy types inside lists and dictionaries '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, datetime):
+        return value.strftime(TIME)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def encode(value, decimals=None):
+    ''' JSON text of "value". Floats are rounded to "decimals" if given.
+        Raises TypeError for types that cannot be encoded. '''
+
+    if isinstance(value, pd.DatetimeIndex):
+        return dumps(value.strftime(TIME).tolist())
+    if isinstance(value, (pd.Series, pd.Index)):
+        value = value.to_numpy()
+
+    if isinstance(value, np.ma.MaskedArray):
+        if value.dtype.kind not in 'fiu':
+            return dumps(value.tolist(), default=default)
+        out = np.array(floats(np.ma.getdata(value), decimals), dtype=object)
+        out[np.ma.getmaskarray(value)] = None
+        return dumps(out.tolist())
+
+    if isinstance(value, np.ndarray):
+        kind = value.dtype.kind
+        if kind == 'f':
+            return dumps(floats(value, decimals))
+        if kind == 'M':
+            times = np.datetime_as_string(value, unit='m')
+            return dumps(np.char.replace(times, 'T', ' ').tolist())
+        value = value.tolist()
+
+    if isinstance(value, (list, tuple)) and len(value):
+        if isinstance(value[0], datetime):
+            return dumps([t.strftime(TIME) for t in value])
+        if decimals is not None and isinstance(value[0], (float, np.floating)):
+            return dumps(floats(value, decimals))
+
+    if isinstance(value, datetime):
+        return dumps(value.strftime(TIME))
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and decimals is not None:
+        value = round(value, decimals)
+    return dumps(value, default=default)
+
+def utc(times):
+    ''' Times as a UTC DatetimeIndex (naive times are taken as UTC) '''
+    times = pd.DatetimeIndex(times)
+    return times.tz_localize('UTC') if times.tz is None else times.tz_convert('UTC')
+
+def local(times, tz):
+    ''' Local (wall-clock) times in time zone "tz" of UTC times, to the minute '''
+    return utc(times).tz_convert(tz).tz_localize(None).floor('T')
+
+def axis(times, tz=None):
+    ''' Compact time axis: the first time (local if "tz" is given, as TIME),
+        the step in minutes and the number of times. The times fall on a
+        regular grid in UTC, and two lists of [index, n] give the exceptions:
+
+            'gaps'     n steps of the grid are missing before time "index"
+            'shifts'   the local clock changes by n minutes at time "index"
+                       (daylight saving time)
+
+        The time of sample i is then start + (i + gaps) * step + shifts,
+        with the gaps and shifts at or before i. '''
+
+    times = pd.DatetimeIndex(times)
+    if tz is not None:
+        times = utc(times).tz_convert(tz)
+    wall = (times if times.tz is None else times.tz_localize(None)).asi8 // MINUTE
+    grid = (times if times.tz is None else times.tz_convert('UTC')).asi8 // MINUTE
+    if not len(times):
+        return {'start': None, 'step': 1, 'length': 0, 'gaps': [], 'shifts': []}
+
+    diff = np.diff(grid)
+    step = int(np.gcd.reduce(diff)) if diff.any() else 1
+    skip, shift = diff // step - 1, np.diff(wall - grid)
+    i, j = np.flatnonzero(skip), np.flatnonzero(shift)
+    return {
+        'start': pd.Timestamp(wall[0] * MINUTE).strftime(TIME),
+        'step': step,
+        'length': len(times),
+        'gaps': np.column_stack((i + 1, skip[i])).tolist(),
+        'shifts': np.column_stack((j + 1, shift[j])).tolist(),
+    }
@@ -1,32 +1,34 @@
-from pickle import dump
 import pytz
 from datetime import datetime
 import sys
 import os
-from json import dumps
 import numpy as np
+from encoder import encode, axis, local
+from artifact import write_artifact
 from log import set_logger, now
 
 logger = set_logger()
 
-def jsonize(data):
+# Decimal places of output variables
+PRECISION = {
+    'temp': 2, 'salt': 2, 'pH': 2, 'O2': 2, 'RFU': 2, 'BGA': 2,
+    'seas': 2, 'pc90': 2,
+    'DCP_rose_speed_surface': 1, 'DCP_rose_direction_surface': 0,
+    'DCP_rose_speed_seabed': 1, 'DCP_rose_direction_seabed': 0,
+}
+
+def jsonize(data, precision=PRECISION):
+    ''' Encode each variable (but strings) as JSON, with the decimal places
+        of "precision" '''
     logger.info(f'{now()} OUTPUT: Starting JSONization of data dict')
     for k, v in data.items():
         if 'safe' in k: continue
         logger.info(f'   {now()} JSON {k}')
         if isinstance(v, str): continue
         try:
-            data[k] = dumps(v) 
+            data[k] = encode(v, precision.get(k))
         except TypeError as ERR:
-            if str(ERR) == 'Object of type datetime is not JSON serializable':
-                value = [i.strftime('%Y-%m-%d %H:%M') for i in v]
-                data[k] = dumps(value)   
-            elif str(ERR) == 'Object of type ndarray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            elif str(ERR) == 'Object of type MaskedArray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            else:
-                logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
+            logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
     return data
 
 def MHW():
@@ -49,24 +51,19 @@ def send_output(sub, clim, surface_series, surface_fig, seabed_series, seabed_fi
     try:
         # Get climatology
         time_c, seas, pc90 = clim
-        # This is needed to jsonize the climatological time
-        time_c = [datetime(i.year, i.month, i.day, i.hour).strftime('%Y-%m-%d %H:%M') for i in time_c]
-
         # Convert UTC time to local time 
-        time = [utc_to_local(i, timezone) for i in sub.index]
+        time = local(sub.index, timezone)
 
         # Get time range
         t0, t1 = time[0], time[-1]
 
-        # Determine first x-axis tick
-        for i in time:
-            if not i.hour and not i.minute:
-                break
-        tick0 = i.strftime('%Y-%m-%d')
+        # Determine first x-axis tick (first midnight)
+        midnight = time[(time.hour == 0) & (time.minute == 0)]
+        tick0 = (midnight[0] if len(midnight) else t1).strftime('%Y-%m-%d')
     
         BUOY = {
-            # Buoy time
-            'time': time,
+            # Buoy time (compact axis, expanded in the browser)
+            'time': axis(sub.index, timezone),
             'tick0': tick0,
             't0': t0.strftime('%Y-%m-%d %H:%M'),
             't1': t1.strftime('%Y-%m-%d %H:%M'),
@@ -96,7 +93,7 @@ def send_output(sub, clim, surface_series, surface_fig, seabed_series, seabed_fi
             'latest_seabed_direction': round(sub.get('d-seabed')[-1], 0),
 
             # Local SST climatology
-            'time_c': time_c,
+            'time_c': axis(time_c),
             'seas': seas,
             'pc90': pc90,
     
@@ -124,8 +121,7 @@ def send_output(sub, clim, surface_series, surface_fig, seabed_series, seabed_fi
             }
 
         outfile = '/data/pkl/BUOY-1.pkl'
-        with open(outfile, 'wb') as f:
-            dump(jsonize(BUOY), f)
+        write_artifact(outfile, jsonize(BUOY))
 
     except Exception as err:
            exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -0,0 +1,243 @@
+'''
+    Cumulative daily wind-rose histograms of the in-situ history.
+
+    For each level (e.g. surface currents, wind), the 10-minute samples of
+    each day are counted in the 9x16 speed and direction bins of the wind
+    rose (see wind_rose.py). The index keeps the cumulative counts, so that
+    cube[d] holds the counts of all days up to day "d" (included). The
+    histogram of any range of days [d0, d1) is then cube[d1 - 1] -
+    cube[d0 - 1], in constant time regardless of the span. The first and
+    last 10-minute time of each day are kept as well, to count the samples
+    in the range (missing data included) as the wind-rose frequencies do.
+
+    The index is kept next to the tables of the store, in {path}/rose, split
+    in monthly segments like the tables: {path}/rose/{YYYY-MM}.{generation}
+    holds the rows of the days of that month. The segments of the current
+    version are listed in {path}/rose/index.json, which is replaced
+    atomically, so readers never see a partially written index. Segments are
+    read memory-mapped, and a query only reads the rows it needs. When
+    partitions of the 10-minute table change, only the days of these
+    partitions are counted again, and only the segments from the first day
+    changed are written again: the segments before are kept as they are. A
+    rebuild is written to a new folder, {path}/rose.{generation}, published
+    by replacing the {path}/rose symbolic link. As with partitions, replaced
+    segments and folders are kept for a while for readers (see store.py).
+'''
+
+from store import partitions, read_partition, extent, publish, remove_replaced
+from wind_rose import histograms
+import pandas as pd
+import numpy as np
+import json
+import time
+import os
+
+DAY = 86400 * 10**9
+
+STEP = 600 * 10**9
+
+# No data in day
+NONE = np.iinfo(np.int64).min
+
+def day(t):
+    ''' Day (since epoch) of a UTC timestamp '''
+    return pd.Timestamp(t).value // DAY
+
+def daily(df, levels):
+    ''' Counts of each day in a partition of the 10-minute table, for
+        (level, vartype) pairs. Returns days, counts, and first and last
+        time of each day. '''
+    t = df.index.asi8
+    days, start = np.unique(t // DAY, return_index=True)
+    end = np.append(start[1:], len(t))
+
+    series = []
+    for level, vartype in levels:
+        speed, direction = (df[key].to_numpy() if key in df else np.full(len(t), np.nan)
+                for key in (f's-{level}', f'd-{level}'))
+        series += [(np.vstack((speed[a:b], direction[a:b])).T, vartype)
+                for a, b in zip(start, end)]
+    counts, _ = histograms(series)
+    counts = counts.reshape(len(levels), len(days), -1).transpose(1, 0, 2)
+    return days, counts, t[start], t[end - 1]
+
+# Arrays of the index, with a row for each day
+KEYS = ('cube', 'first', 'last', 'next', 'prev')
+
+def segments(start, ndays):
+    ''' Months (YYYY-MM) of the "ndays" days of the index from day "start"
+        (since epoch), and the first day of each in the index, followed by
+        "ndays" '''
+    days = np.array([start, start + ndays - 1], dtype='datetime64[D]')
+    months = np.arange(*days.astype('datetime64[M]') + [0, 1])
+    bounds = np.maximum(months.astype('datetime64[D]').astype(np.int64) - start, 0)
+    return np.datetime_as_string(months).tolist(), bounds.tolist() + [ndays]
+
+def read_index(path):
+    ''' Wind rose index of store (segments are read with read_days), or
+        None if not built '''
+    folder = os.path.realpath(f'{path}/rose')
+    try:
+        with open(f'{folder}/index.json', 'r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    # Index written before it was split in segments
+    if 'segments' not in index:
+        return None
+    index['folder'] = folder
+    index['months'], index['bounds'] = segments(index['start'], index['ndays'])
+    return index
+
+def read_days(index, key, a, b):
+    ''' Rows of array "key" of the index for days a to b (exclusive),
+        memory-mapped from the segments of these days only '''
+    bounds = index['bounds']
+    k0, k1 = np.searchsorted(bounds, a, 'right') - 1, np.searchsorted(bounds, b, 'left')
+    parts = [np.load(f'{index["folder"]}/{index["segments"][k]}/{key}.npy', mmap_mode='r')
+            [max(a, bounds[k]) - bounds[k] : min(b, bounds[k + 1]) - bounds[k]]
+            for k in range(k0, k1)]
+    return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+def write_index(path, index, rows, k):
+    ''' Write the rows from segment "k" of "index" (a new version of it)
+        as new segments, after the segments before "k" of the current
+        version, then publish it '''
+    rebuild = k == 0
+    folder = f'{path}/rose.{time.time_ns()}' if rebuild else os.path.realpath(f'{path}/rose')
+    os.makedirs(folder, exist_ok=True)
+
+    old = read_index(path)
+    kept = [] if rebuild else old['segments'][:k]
+    months, bounds = segments(index['start'], index['ndays'])
+    for j in range(k, len(months)):
+        name = f'{months[j]}.{time.time_ns()}'
+        os.makedirs(f'{folder}/{name}')
+        for key in KEYS:
+            np.save(f'{folder}/{name}/{key}.npy', rows[key][bounds[j] - bounds[k] : bounds[j + 1] - bounds[k]])
+        kept.append(name)
+
+    with open(f'{folder}/index.json.tmp', 'w') as f:
+        json.dump({'start': index['start'], 'ndays': index['ndays'],
+            'levels': index['levels'], 'segments': kept}, f)
+    os.replace(f'{folder}/index.json.tmp', f'{folder}/index.json')
+
+    if rebuild:
+        publish(f'{path}/rose', folder)
+        return
+    # Segments replaced are kept for readers, and removed by a later update
+    for month in months[k:]:
+        remove_replaced(f'{folder}/{month}')
+
+def update_index(path, levels, months=None):
+    ''' Count again the days of partitions "months" of the 10-minute table
+        (default all, i.e. rebuild) for (level, vartype) pairs, and update
+        the cumulative counts from the first day changed. '''
+    names = partitions(path, '10T')
+    if not names:
+        return
+
+    first_time, last_time = extent(path, '10T')
+    start = day(first_time)
+    ndays, nlevels = day(last_time) - start + 1, len(levels)
+
+    index = read_index(path)
+    if (index is None or index['levels'] != [level for level, _ in levels]
+            or index['start'] != start or index['ndays'] > ndays):
+        months = None
+
+    if months is None:
+        months, a = names, 0
+    else:
+        # First day counted again, or new
+        a = min([index['ndays']] + [max(0, day(pd.Timestamp(f'{name}-01')) - start)
+                for name in months])
+        if a == ndays:
+            return
+        # Days after the last day with data before, whose nearest day with
+        # data after them may change
+        if a > 0:
+            a = int(read_days(index, 'prev', a - 1, a)[0]) + 1
+
+    # Segments from the one of day "a" are written again
+    _, bounds = segments(start, ndays)
+    k = int(np.searchsorted(bounds, a, 'right')) - 1
+    a, n = bounds[k], ndays - bounds[k]
+    if k == 0:
+        months = names
+
+    counts = np.zeros((n, nlevels, 16 * 9), dtype=np.int64)
+    first, last = np.full(n, NONE), np.full(n, NONE)
+    total, prev = np.zeros((nlevels, 16 * 9), dtype=np.int64), -1
+
+    if k > 0:
+        # Days already in the index (cumulative to daily counts)
+        b = index['ndays']
+        total = read_days(index, 'cube', a - 1, a)[0]
+        prev = int(read_days(index, 'prev', a - 1, a)[0])
+        counts[:b - a] = np.diff(read_days(index, 'cube', a, b), axis=0, prepend=total[None])
+        first[:b - a] = read_days(index, 'first', a, b)
+        last[:b - a] = read_days(index, 'last', a, b)
+
+    for name in months:
+        # Days of month are counted again (or removed if gone)
+        m0 = pd.Timestamp(f'{name}-01', tz='UTC')
+        i, j = day(m0) - start - a, day(m0 + pd.offsets.MonthBegin()) - start - a
+        i, j = max(0, i), min(n, j)
+        if i >= j:
+            continue
+        counts[i:j], first[i:j], last[i:j] = 0, NONE, NONE
+        if name not in names:
+            continue
+        columns = [f'{x}-{level}' for level, _ in levels for x in 'sd']
+        days, c, f, l = daily(read_partition(path, '10T', name, columns), levels)
+        days -= start + a
+        counts[days], first[days], last[days] = c, f, l
+
+    # Nearest days with data, at or after and at or before each day
+    has, d = first != NONE, np.arange(a, ndays)
+    after = np.minimum.accumulate(np.where(has, d, ndays)[::-1])[::-1]
+    before = np.maximum.accumulate(np.where(has, d, prev))
+
+    write_index(path, {
+        'start': int(start), 'ndays': int(ndays),
+        'levels': [level for level, _ in levels],
+    }, {
+        'cube': total + np.cumsum(counts, axis=0),
+        'first': first, 'last': last, 'next': after, 'prev': before,
+    }, k)
+
+def rose_histograms(path, t0, t1, levels):
+    ''' Counts of "levels" in the wind rose bins over the days from t0 to t1
+        (exclusive), and the number of 10-minute samples from the first to
+        the last in the range. Returns None if the index is not built. '''
+    index = read_index(path)
+    if index is None or not set(levels) <= set(index['levels']):
+        return None
+
+    ndays = index['ndays']
+    d0 = min(max(day(t0) - index['start'], 0), ndays)
+    d1 = min(max(-(-pd.Timestamp(t1).value // DAY) - index['start'], 0), ndays)
+    if d0 >= d1:
+        return np.zeros((len(levels), 16 * 9), dtype=np.int64), 0
+
+    i = [index['levels'].index(level) for level in levels]
+    counts = read_days(index, 'cube', d1 - 1, d1)[0]
+    if d0 > 0:
+        counts = counts - read_days(index, 'cube', d0 - 1, d0)[0]
+    counts = counts[i]
+
+    a, b = read_days(index, 'next', d0, d0 + 1)[0], read_days(index, 'prev', d1 - 1, d1)[0]
+    n = 0 if a > b else int((read_days(index, 'last', b, b + 1)[0]
+            - read_days(index, 'first', a, a + 1)[0]) // STEP) + 1
+    return counts, n
+
+def rose_frequencies(path, t0, t1, levels):
+    ''' Frequency (%) of each wind rose bin for "levels" from t0 to t1
+        (exclusive), as wind_rose.frequencies() would give for the 10-minute
+        samples in the range. Returns None if not available. '''
+    result = rose_histograms(path, t0, t1, levels)
+    if result is None or not result[1]:
+        return None
+    counts, n = result
+    return counts / n * 100 # [%]
@@ -29,9 +29,10 @@ from datetime import datetime, timedelta
 from output import send_output
 from pytz import timezone as tz
 import numpy as np
-import pickle
-from wind_rose import wind_rose
+from wind_rose import wind_rose, frequencies
 from buoy import Buoy
+from store import read_table, nearest
+from climatology import site_climatology
 from log import set_logger, now
 import os
 
@@ -48,55 +49,13 @@ def configuration():
             config[key] = val
     return config
 
-def subset(buoy, t0, t1):
-    ''' Subset buoy data for the requested time period '''
-    
-    time = buoy.index 
-  
-    i0, i1 = np.argmin(abs(time - t0)), np.argmin(abs(time - t1)) + 1
-    
-    sub = buoy[i0 : i1]
-
-    return sub
-
-def site_climatology(infile, time):
-    ''' Reads site climatology from local PICKLE file '''
-    
-    with open(infile, 'rb') as f:
-        clim = pickle.load(f)
-    
-    t0, t1 = time[0] - timedelta(days=1), time[-1] + timedelta(days=8)
-    
-    time = []
-    while t0 < t1:
-        time.append(t0); t0 += timedelta(minutes=10)
-    # Data from local climatology file    
-    day_of_year, seasonal_cycle, PC90 = clim['time'], clim['seas'], clim['pc90']
-    
-    # Output initialization
-    Time, Seas, Pc90 = [], [], []
-    
-    for t in time:        
-        H, M = t.hour, t.minute            
-        if H == 12 and not M:
-            # Get day of year
-            Day_Of_Year = t.timetuple().tm_yday
-            # Find time index in local climatology file
-            i = np.where(day_of_year == Day_Of_Year)[0][0]
-            # Append to output arrays
-            Time.append(t)
-            Seas.append(seasonal_cycle[i])
-            Pc90.append(PC90[i])
-    
-    return Time, Seas, Pc90
-
 def prepare_wind_rose(r, D):
     
     r, D = np.array(r), np.array(D)
 
     return np.vstack((r, D)).T
 
-def windrose(sub, level='surface'):
+def windrose(sub, level='surface', frequency=None):
     ''' Create wind rose figure and associated time series '''
     series = dict(time=sub.index,
             speed=sub.get(f's-{level}'),
@@ -105,14 +64,21 @@ def windrose(sub, level='surface'):
     # Subset for the last 24 hours
     time, r, D = sub.index[-144::], sub.get(f's-{level}')[-144::], sub.get(f'd-{level}')[-144::]
     # Create figure
-    idate, edate, wind_rose_fig = wind_rose(time, prepare_wind_rose(r, D), 'currents')
-    # Fix legend
-    wind_rose_fig = wind_rose_fig.replace("strength", "speed")
+    idate, edate, wind_rose_fig = wind_rose(time, prepare_wind_rose(r, D), 'currents', frequency, 'speed')
     # Wrap 
     fig = {'idate': idate, 'edate': edate, 'fig': wind_rose_fig}
 
     return series, fig
 
+def windroses(sub, levels):
+    ''' Wind roses of current at several levels. The histograms of all
+        levels are computed at once. '''
+    last = sub.iloc[-144::]
+    data = [(prepare_wind_rose(last.get(f's-{level}'), last.get(f'd-{level}')), 'currents')
+            for level in levels]
+    return [windrose(sub, level, frequency)
+            for level, frequency in zip(levels, frequencies(data))]
+
 
 def SITE(date=datetime.now()):
     
@@ -126,7 +92,7 @@ def SITE(date=datetime.now()):
             raise FileNotFoundError(f'config file not found at root directory {root}')
                 
         logger.info(f'{now()} Loading buoy data...')
-        var = Buoy(config)
+        store = Buoy(config)
     
         # Subset for the latest NDAYS as per config file 
         t1 = tz('UTC').localize(date)
@@ -134,17 +100,23 @@ def SITE(date=datetime.now()):
         t0 = t1 - timedelta(days=NDAYS)
     
         logger.info(f'{now()} Subsetting...')
-        sub = subset(var, t0, t1)
+        # Only the monthly partitions overlapping the period are read
+        sub = read_table(store, '10T', t0, t1, freq='10T')
+        if not len(sub):
+            # No data in the latest NDAYS: the last NDAYS with data
+            t1, _ = nearest(store, '10T', t0)
+            if t1 is None:
+                raise ValueError(f'No buoy data in {store}')
+            t0 = t1 - timedelta(days=NDAYS)
+            sub = read_table(store, '10T', t0, t1, freq='10T')
 
         # Read climatology 
         logger.info(f'{now()} Reading climatology...')
         clim = site_climatology(config.get('clim_site'), sub.index)
 
-        # Make wind rose histogram for surface currents
-        surface_series, surface_fig = windrose(sub)
-
-        # Make wind rose histogram for seabed currents
-        seabed_series, seabed_fig = windrose(sub, level='seabed')
+        # Make wind rose histograms for surface and seabed currents
+        (surface_series, surface_fig), (seabed_series, seabed_fig) = windroses(sub,
+                ['surface', 'seabed'])
 
         # Get time zone
         timezone = config.get('timezone')
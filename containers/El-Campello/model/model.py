@@ -157,9 +157,7 @@ def MODEL(date=datetime.now()):
 
         # Get wind rose for next 72 hours forecasted wind speed and direction
         logger.info(f'{now()} Preparing 72-hour ECMWF wind histogram...')
-        idate, edate, wind_rose_fig = wind_rose(FC['wind_time_fc'], prepare_wind_rose(FC['wind_speed_fc'], FC['wind_direction_fc']), 'wind')
-        # Fix legend title
-        wind_rose_fig = wind_rose_fig.replace("strength", "speed")
+        idate, edate, wind_rose_fig = wind_rose(FC['wind_time_fc'], prepare_wind_rose(FC['wind_speed_fc'], FC['wind_direction_fc']), 'wind', legend='speed')
         # Wrap into a dictionary
         wind_rose_figure = {'idate': idate, 'edate': edate, 'fig': wind_rose_fig}
         # Wrap direction/period time series into a dictionary (used for CSV export)
@@ -219,9 +217,7 @@ def MODEL(date=datetime.now()):
             FC['VTPK'] = np.nan, np.nan
 
         # Get wind rose for next 24 hours forecasted wave peak period and direction
-        idate, edate, wind_rose_fig = wind_rose(FC['VTPK'][0], prepare_wind_rose(FC['VTPK'][1], FC['VPED'][1]), 'wave')
-        # Fix legend title
-        wind_rose_fig = wind_rose_fig.replace("strength", "period")
+        idate, edate, wind_rose_fig = wind_rose(FC['VTPK'][0], prepare_wind_rose(FC['VTPK'][1], FC['VPED'][1]), 'wave', legend='period')
         # Wrap into a dictionary
         wave_rose_figure = {'idate': idate, 'edate': edate, 'fig': wind_rose_fig}
         # Wrap direction/period time series into a dictionary (used for CSV export)
@@ -1,6 +1,6 @@
 from datetime import datetime
-from pickle import dump
-from json import dumps
+from encoder import encode, axis
+from artifact import write_artifact
 from log import set_logger, now
 import numpy as np
 import pandas as pd
@@ -37,24 +37,26 @@ def dates_in_table(time):
         
     return EN, ES, C
 
-def jsonize(data):
+# Decimal places of output variables
+PRECISION = {
+    'u_wind_fc': 1, 'v_wind_fc': 1, 'wind_speed_fc': 1,
+    'fc_wav': 2, 'fc_wav_sw2': 2,
+    'fc_wind_rose_period': 1, 'fc_wind_rose_direction': 0,
+    'fc_wave_rose_period': 1, 'fc_wave_rose_direction': 0,
+}
+
+def jsonize(data, precision=PRECISION):
+    ''' Encode each variable (but strings) as JSON, with the decimal places
+        of "precision" '''
     logger.info(f'{now()} OUTPUT: Starting JSONization of data dict')
     for k, v in data.items():
         if 'safe' in k: continue
         logger.info(f'   {now()} JSON {k}')
         if isinstance(v, str): continue
         try:
-            data[k] = dumps(v) 
+            data[k] = encode(v, precision.get(k))
         except TypeError as ERR:
-            if str(ERR) == 'Object of type datetime is not JSON serializable':
-                value = [i.strftime('%Y-%m-%d %H:%M') for i in v]
-                data[k] = dumps(value)   
-            elif str(ERR) == 'Object of type ndarray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            elif str(ERR) == 'Object of type MaskedArray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            else:
-                logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
+            logger.info(f'   {now()} WARNING: Could not jsonize {k} due to {str(ERR)}')
     return data
 
 def utc_to_local(time, tz):
@@ -85,8 +87,8 @@ def send_output(FC, wave_rose_figure, wave_rose_series, wind_rose_figure, wind_r
         'wind_time_fc': wind_time_fc,
         'wind_speed_fc': FC['wind_speed_fc'],
         
-        # Waves time     
-        'fc_wav_time': fc_wav_time,
+        # Waves time (compact axis, expanded in the browser)
+        'fc_wav_time': axis(FC['Hs_fc'][0], timezone),
         # Significant Wave Height
         'fc_wav':      FC['Hs_fc'][1],
         # Secondary swell
@@ -155,5 +157,4 @@ def send_output(FC, wave_rose_figure, wave_rose_series, wind_rose_figure, wind_r
     MODEL['wave_forecast_dates']= items
 
     outfile = '/data/pkl/MODEL-2.pkl'
-    with open(outfile, 'wb') as f:
-        dump(MODEL, f)
+    write_artifact(outfile, MODEL)
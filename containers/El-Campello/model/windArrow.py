@@ -1,6 +1,6 @@
 import matplotlib.pyplot as plt
 from datetime import datetime
-from pickle import load
+from artifact import read_artifact
 from json import loads
 import numpy as np
 from PIL import Image
@@ -27,8 +27,7 @@ def windArrow(PKL, fout):
                            '#EDC212', '#ED8F12', '#ED6312', '#ED2912', '#D5102D'))                    
     
     # Load forecast data
-    with open(PKL, 'rb') as f:   
-        data = load(f)
+    data = read_artifact(PKL)
         
     # Retrieve u, v components of wind
     u, v, time = data['u_wind_fc'], data['v_wind_fc'], data['wind_time_fc']
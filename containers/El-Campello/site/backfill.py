@@ -0,0 +1,132 @@
+'''
+    Rebuild the El Campello historical records from the raw *.xml archive
+    (e.g. after a parser fix or a change in the quality control).
+
+    The list of *.xml files is split into shards, which are parsed in parallel
+    by a pool of processes. Each finished shard is saved as a checkpoint, so
+    that an interrupted rebuild can be resumed where it stopped. Then, the
+    shards are merged, and the historical store is built again from scratch,
+    with the same code as in Buoy(), next to the live store, which it then
+    replaces at once. The lock of the store is held throughout, and the
+    regular runs (cron) skip their update meanwhile. Both loose and bundled
+    (see bundle.py) files are read, as listed in the manifest.
+
+    With --qc-only, files are not parsed again: the quality control (see
+    qc.py) is applied again to the raw records already in the store, one
+    monthly partition at a time.
+
+    Usage:
+
+        python backfill.py [--workers N] [--shard-size 2000] [--restart]
+        python backfill.py --qc-only
+
+'''
+
+from multiprocessing import Pool
+from functools import partial
+from hashlib import md5
+import pandas as pd
+import argparse
+import shutil
+import time
+import os
+from records import load_records, save_records, parse_records
+from manifest import open_manifest, sync_manifest, manifest_stats, bundled_files, set_status
+from buoy import history, requalify, read_buoy_files, locked
+from log import set_logger, now
+
+logger = set_logger()
+
+localpath = '/xml'
+
+outdir = '/data/his/El-Campello/'
+
+def shards(stats, size):
+    ''' Split the (sorted) list of files into shards of "size" files. Each
+        shard is identified by a hash of the names, sizes and modification
+        times of its files, so that a checkpoint is only reused if the shard
+        has not changed since. '''
+    names = sorted(stats.index)
+    for i in range(0, len(names), size):
+        chunk = names[i : i + size]
+        key = md5(stats.loc[chunk].to_csv().encode()).hexdigest()[:12]
+        yield f'shard-{i // size:05d}-{key}.pkl', chunk
+
+def parse_shard(args):
+    ''' Parse a shard of files and save it as a checkpoint '''
+    checkpoint, names, stats, bundles = args
+    records = parse_records(localpath, names, stats,
+            partial(read_buoy_files, bundles=bundles))
+    save_records(records, checkpoint)
+    return len(names)
+
+def backfill(workers, size, restart):
+
+    checkpoints = f'{outdir}backfill/'
+    if restart and os.path.isdir(checkpoints):
+        shutil.rmtree(checkpoints)
+    if not ( os.path.isdir(checkpoints) ):
+        os.makedirs(checkpoints)
+
+    db = open_manifest(f'{outdir}manifest.db')
+    sync_manifest(db, localpath, '.xml')
+    stats = pd.DataFrame.from_dict(manifest_stats(db),
+            orient='index', columns=['size', 'mtime'])
+    bundles = bundled_files(db)
+    db.close()
+    logger.info(f'{now()} BACKFILL: Number of files is {len(stats)}')
+
+    # Skip shards already checkpointed by a previous (interrupted) run
+    tasks = [(checkpoints + name, chunk, stats.loc[chunk],
+            {name: bundles[name] for name in chunk if name in bundles})
+            for name, chunk in shards(stats, size)]
+    pending = [task for task in tasks if not os.path.isfile(task[0])]
+    logger.info(f'{now()} BACKFILL: {len(tasks) - len(pending)} shards found '
+            f'in checkpoint, {len(pending)} shards to go')
+
+    start, done = time.perf_counter(), 0
+    with Pool(workers) as pool:
+        for count in pool.imap_unordered(parse_shard, pending):
+            done += count
+            rate = done / (time.perf_counter() - start)
+            logger.info(f'{now()} BACKFILL: Parsed {done} files ({rate:.0f} files/s)')
+    elapsed = time.perf_counter() - start
+
+    # Merge shards
+    records = pd.concat([load_records(checkpoint) for checkpoint, *_ in tasks]).sort_index()
+    db = open_manifest(f'{outdir}manifest.db')
+    set_status(db, records.index, records['valid'])
+    db.close()
+
+    touched = history(records, outdir, rebuild=True)
+
+    # Rebuild is complete. Checkpoints are no longer needed.
+    shutil.rmtree(checkpoints)
+
+    rate = done / elapsed if elapsed else 0
+    logger.info(f'{now()} BACKFILL: {done} files parsed by {workers} workers in '
+            f'{elapsed:.1f} s ({rate:.0f} files/s). {len(touched)} partitions.')
+    return done, elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shard-size', type=int, default=2000)
+    parser.add_argument('--restart', action='store_true',
+            help='discard checkpoints from a previous run')
+    parser.add_argument('--qc-only', action='store_true',
+            help='only apply the quality control again to the stored records')
+    args = parser.parse_args()
+
+    # Lock of the store and manifest (see Buoy), once a run in progress has
+    # finished. Runs are skipped until the store has been rebuilt.
+    with locked(f'{outdir}store'):
+        if args.qc_only:
+            start = time.perf_counter()
+            count = requalify(outdir)
+            print(f'{count} partitions in {time.perf_counter() - start:.1f} s')
+            raise SystemExit
+
+        done, elapsed = backfill(args.workers, args.shard_size, args.restart)
+        print(f'{done} files in {elapsed:.1f} s ({done / elapsed if elapsed else 0:.0f} files/s)')
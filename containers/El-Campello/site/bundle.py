@@ -0,0 +1,124 @@
+'''
+    Daily bundles of *.xml files.
+
+    Once a day is closed, its loose *.xml files are packed into a compressed
+    bundle, {localpath}/bundles/{YYYYMMDD}.xml.gz, and removed from the local
+    directory. Each file is a separate gzip member of the bundle, so the
+    bundle is still a valid gzip file, and any file can be decompressed on its
+    own. The offset and length of each member are kept in an index next to
+    the bundle, {YYYYMMDD}.json. Files are assigned to a day after their
+    modification (download) time in UTC. Only the current day is kept as
+    loose files.
+'''
+
+from datetime import datetime, timezone
+import gzip
+import json
+import os
+from manifest import loose_files, set_bundle, mark_directory
+from log import set_logger, now
+
+logger = set_logger()
+
+def bundle_name(localpath, day):
+    ''' Paths to bundle and index of "day" '''
+    path = f'{localpath}/bundles/{day}'
+    return path + '.xml.gz', path + '.json'
+
+def file_day(mtime):
+    ''' Day (YYYYMMDD) of modification time in UTC '''
+    return datetime.fromtimestamp(mtime, timezone.utc).strftime('%Y%m%d')
+
+def read_index(localpath, day):
+    ''' Offset index of bundle: {name: (offset, length)} '''
+    try:
+        with open(bundle_name(localpath, day)[1], 'r') as f:
+            return {name: tuple(v) for name, v in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+def pack(localpath, day, names):
+    ''' Append files to the bundle of "day", then update its index. Files
+        already in the bundle are appended again and the index is pointed to
+        the new copy. The index is replaced atomically, so that a bundle is
+        never left with a broken index. '''
+    bundle, index_name = bundle_name(localpath, day)
+    index = read_index(localpath, day)
+    with open(bundle, 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        for name in names:
+            with open(f'{localpath}/{name}', 'rb') as g:
+                member = gzip.compress(g.read(), mtime=0)
+            f.write(member)
+            index[name] = (offset, len(member))
+            offset += len(member)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp = index_name + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_name)
+
+def compact(db, localpath, today=None):
+    ''' Pack loose files of closed days (before "today", UTC) into daily
+        bundles. Returns the number of files packed. '''
+    if today is None:
+        today = datetime.now(timezone.utc).strftime('%Y%m%d')
+
+    days = {}
+    for name, mtime in loose_files(db):
+        day = file_day(mtime)
+        if day < today:
+            days.setdefault(day, []).append(name)
+    if not days:
+        return 0
+
+    os.makedirs(f'{localpath}/bundles', exist_ok=True)
+
+    count = 0
+    for day, names in sorted(days.items()):
+        pack(localpath, day, names)
+        # Bundle is complete and indexed: loose files can go
+        set_bundle(db, names, day)
+        for name in names:
+            os.remove(f'{localpath}/{name}')
+        count += len(names)
+    mark_directory(db, localpath)
+    logger.info(f'{now()} COMPACT: {count} files packed into {len(days)} daily bundles')
+    return count
+
+def decode(data):
+    ''' Decode file contents with universal newlines, as in text mode '''
+    return data.decode().replace('\r\n', '\n').replace('\r', '\n')
+
+def read_record(localpath, day, name):
+    ''' Read a single file from the bundle of "day" '''
+    offset, length = read_index(localpath, day)[name]
+    with open(bundle_name(localpath, day)[0], 'rb') as f:
+        f.seek(offset)
+        return decode(gzip.decompress(f.read(length)))
+
+def read_day(localpath, day):
+    ''' Read all files in the bundle of "day": {name: text} '''
+    index = read_index(localpath, day)
+    with open(bundle_name(localpath, day)[0], 'rb') as f:
+        data = f.read()
+    return {name: decode(gzip.decompress(data[offset : offset + length]))
+            for name, (offset, length) in sorted(index.items())}
+
+def read_texts(files, bundles):
+    ''' Read files, either loose or from bundles. "bundles" is the day of
+        bundle of each bundled file name. Yields the text of each file, in
+        the same order. Bundles are read as a whole, once for consecutive
+        files of the same day. '''
+    day, texts = None, {}
+    for file in files:
+        localpath, name = os.path.split(file)
+        if name not in bundles:
+            with open(file, 'r') as f:
+                yield f.read()
+            continue
+        if bundles[name] != day:
+            day = bundles[name]
+            texts = read_day(localpath, day)
+        yield texts[name]
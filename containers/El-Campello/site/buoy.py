@@ -1,19 +1,46 @@
-from datetime import datetime, timedelta
-from pickle import dump
-import json
-from dateutil.parser import parse
+from contextlib import contextmanager
 from get_uv import get_uv
-from glob import glob
 import paramiko
 import pysftp
 import pandas as pd
 import numpy as np
-from pytz import timezone
+import fcntl
+import time
 import os
+from records import parse_records, valid_records
+from store import append_records, read_partition, write_partition, publish, partitions, previous, rollup
+from manifest import open_manifest, sync_manifest, remove_empty, manifest_stats, set_status, bundled_files
+from bundle import compact, read_texts
+from downloader import download
+from xmlparser import read_xml_texts, columns, CAMPELLO
+from qc import quality_control, lookback, CAMPELLO as TESTS
+from roseindex import update_index
 from log import set_logger, now
 
 logger = set_logger()
 
+# Rollup tiers of the 10-minute table (mean, min, max and count)
+TIERS = ('1H', '1D')
+
+# Wind roses in the index of historical data (level, vartype)
+ROSES = [('surface', 'currents'), ('15m', 'currents'), ('wind', 'wind'), ('wave', 'wave')]
+
+@contextmanager
+def locked(name, blocking=True):
+    ''' Exclusive lock of file "name" (through "name.lock"). If not
+        "blocking", yields False at once when another process holds it,
+        and True otherwise. '''
+    fd = os.open(name + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
 def Buoy(conf):
     
     # Puertos del Estado INSTAC SFTP hostname and credentials    
@@ -23,229 +50,159 @@ def Buoy(conf):
     localpath = '/xml'
     logger.info(f'{now()} BUOY: Localpath is {localpath}')
       
-    # Retrieve names of *.xml files already downloaded and save to list
-    local = update_local_directory(localpath, '.xml')
-    logger.info(f'{now()} Local directory inspected. Number of files is {len(local)}')
-
-    # Remove empty (corrupted) files
-    files = sorted(glob(localpath + '/*.xml'))
-    for file in files:        
-        if is_empty(file):
-            os.remove(file)
-   
-    # Download files
-    try:
-        xml_file_download(local, localpath, host, user, pswd, folder)         
-    except paramiko.SSHException:
-        pass
-    
-    # Remove empty (corrupted) files
-    files = sorted(glob(localpath + '/*.xml'))
-    for file in files:
-        if is_empty(file):
-            os.remove(file)
-   
-    # Update list of names of *.xml files already downloaded
-    local = update_local_directory(localpath, '.xml')
-   
-    # Initialize dictionary of output variables    
-    var = vardict() 
-
-    logger.info(f'{now()} Reading files...')
-    for f in local:
-        read_xml_file(localpath + '/' + f, var)
-
-    # Find u- and v- components of wind from wind speed and direction
-    var['u-wind'], var['v-wind'] = get_uv(var['s-wind'], var['d-wind'], 'FROM') 
-
-    # Apply a quality control (mask missing data)
-    var = quality_control(var)    
-
-    var = pd.DataFrame(var)
-    # Resample at 10 minutes to ensure continuous time series
-    var = var.resample('10T', on='time').mean()
-
     outdir = '/data/his/El-Campello/'
     if not ( os.path.isdir(outdir) ):
         os.makedirs(outdir)
 
-    logger.info(f'{now()}: Saving historical records...')        
-    with open(f'{outdir}El-Campello.pkl', 'wb') as f:
-        dump(var, f)
-
-    logger.info(f'{now()}: Quitting BUOY')  
-    return var 
-
-def is_empty(file):
-    ''' Check if downloaded file is empty (silent, failed download) '''
-    f = open(file, 'r')
-    lines = f.readlines()
-    if not lines:
-        return True
-    else:
-        return False
-
-def quality_control(var):
-
-    for key in var.keys():
-        var[key] = [i if ( i != 68. and i != 81. ) else np.nan for i in var[key]]
-
+    # The store and the manifest are updated under the lock, also taken by
+    # the backfill while it rebuilds the store. Meanwhile, runs are skipped
+    # (files are downloaded and parsed by the next run).
+    with locked(f'{outdir}store', blocking=False) as free:
+        if not free:
+            logger.info(f'{now()} BUOY: Store locked by backfill, skipping update')
+            return f'{outdir}store'
+
+        # Manifest of *.xml files already downloaded. The local directory is
+        # only listed again if it has been modified outside of the manifest.
+        db = open_manifest(f'{outdir}manifest.db')
+        added, removed = sync_manifest(db, localpath, '.xml')
+        logger.info(f'{now()} Manifest synchronized ({added} added, {removed} removed)')
+
+        # Remove empty (corrupted) files
+        remove_empty(db, localpath)
+
+        # Download files
+        try:
+            xml_file_download(db, localpath, host, user, pswd, folder,
+                    int(conf.get('channels', 4)))
+        except paramiko.SSHException:
+            pass
+
+        # Remove empty (corrupted) files
+        remove_empty(db, localpath)
+
+        # Pack files of closed days into daily bundles
+        compact(db, localpath)
+
+        # Parse files that are new or have been downloaded again. All files are
+        # parsed if the historical store has not been built yet.
+        store = f'{outdir}store'
+        stats = manifest_stats(db, 'new' if os.path.isdir(store) else None)
+        names = sorted(stats)
+        logger.info(f'{now()} Reading {len(names)} new or modified files...')
+        if names:
+            reader = lambda files: read_buoy_files(files,
+                    bundled_files(db, [os.path.basename(file) for file in files]))
+            stats = pd.DataFrame.from_dict(stats, orient='index', columns=['size', 'mtime'])
+            records = parse_records(localpath, names, stats, reader)
+            set_status(db, names, records['valid'])
+            history(records, outdir)
+        db.close()
+
+    logger.info(f'{now()} Quitting BUOY')
+    return store
+
+def history(records, outdir, rebuild=False):
+    ''' Append the complete records to the historical store, and resample
+        at 10 minutes only the monthly partitions touched. This is shared
+        with the backfill command, which rebuilds the store from scratch:
+        the new store is built next to it, and then replaces it at once, so
+        the webapp never sees a partial store (see store.publish). '''
+
+    store = f'{outdir}store'
+    if rebuild:
+        store, link = f'{store}.{time.time_ns()}', store
+
+    logger.info(f'{now()} Saving historical records...')
+    touched = append_records(store, 'raw', valid_records(records, columns(CAMPELLO)), 'file')
+    months = checked(store, touched)
+    for name in months:
+        resample(store, name)
+    update_index(store, ROSES, None if rebuild else months)
+    if rebuild:
+        publish(link, store)
+        store = link
+    logger.info(f'{now()} Partitions updated: {", ".join(touched)}')
+
+    return touched
+
+def checked(store, touched):
+    ''' Partitions to quality control again after "touched" have changed.
+        The first samples of the following partition are checked against
+        the last samples of a touched one, so it is included too. '''
+    names = partitions(store, 'raw')
+    months = set(touched)
+    for name in touched:
+        i = names.index(name) + 1
+        if i < len(names):
+            months.add(names[i])
+    return sorted(months)
+
+def variables(raw):
+    ''' Historical structure of output variables (NumPy columns) '''
+    var = {key: raw[key].to_numpy() for key in columns(CAMPELLO) if key != 'time'}
+    var['time'] = raw.index
     return var
 
-def read_xml_file(file, var):
-    ''' Read an *.xml file and update the fields of interest '''
-
-    # DCPS speed [cm/s] and direction [Deg.M]
-    speed, direction = [], []    
-
-    # Dictionary of new values
-    new = {'time': 0, 'temp': 0, 'tur': 0, 'O2': 0,
-        's-wind': 0, 'd-wind': 0, 
-        'wave-height': 0, 'swell-height': 0,
-        's-wave': 0, 'd-wave': 0,
-        's-surface': 0, 'd-surface': 0,
-        's-15m': 0, 'd-15m': 0}
-
-    # Add some tests (check all variables are read in each file)
-    checklist = {'time': False, 'temp': False, 'tur': False, 'O2': False,
-            's-wind': False, 'd-wind': False,
-            'wave-height': False, 'swell-height': False,
-            'wave-period' : False, 'wave-direction': False,
-            'speed': False, 'direction': False } 
-    
-    with open(file, 'r') as f:
-
-        # Discard header
-        for i in range(5): f.readline()
-
-        line = f.readline()
-        while len(line):
-
-            if '<Time>' in line:
-                                     
-                new['time'] = find_time(line); checklist['time'] = True
-
-            elif 'Descr="Water Temperature"' in line:
-                 
-                new['temp'] = find_value(f.readline()); checklist['temp'] = True
+def wind_components(var, flags):
+    ''' Add u- and v- components of wind, from wind speed and direction
+        after quality control (NaN where either is masked), with the worst
+        flag of the two '''
+    # get_uv works in place on the direction array, so pass a copy
+    var['u-wind'], var['v-wind'] = get_uv(var['s-wind'], var['d-wind'].copy(), 'FROM')
+    flags['u-wind'] = flags['v-wind'] = np.maximum(flags['s-wind'], flags['d-wind'])
 
-            elif 'Descr="Dissolved Oxygen"' in line:
+def resample(store, name):
+    ''' Quality control the raw records of a partition, and resample at 10
+        minutes. Flags are saved to the "qc" table, next to "raw". Hourly
+        and daily rollups of the 10-minute data are updated too. '''
 
-                new['O2'] = find_value(f.readline()); checklist['O2'] = True
+    raw = read_partition(store, 'raw', name)
 
-            elif 'Descr="Turbidity"' in line:       
+    # Last samples of the previous partition, for tests looking back in time
+    context = previous(store, 'raw', name, lookback(TESTS))
+    if context is not None:
+        context = variables(context)
 
-                new['tur'] = find_value(f.readline()); checklist['tur'] = True
+    # Apply a quality control (mask missing and bad data)
+    var, flags = quality_control(variables(raw), TESTS, context)
+    wind_components(var, flags)
+    write_partition(store, 'qc', name, pd.DataFrame(flags, index=raw.index))
 
-            elif '<Point ID="2">' in line:                             
-
-                speed.append(find_value(f.readline(), f=f)); checklist['speed'] = True
-
-            elif '<Point ID="3">' in line:
-
-                direction.append(find_value(f.readline(), f=f)); checklist['direction'] = True
-
-            elif 'Average Corrected Wind Diretion' in line:
-
-                new['d-wind'] = find_value(f.readline()); checklist['d-wind'] = True
-
-            elif 'Average Corrected Wind Speed' in line:
-
-                new['s-wind'] = 3.6*find_value(f.readline()); checklist['s-wind'] = True
-
-            elif 'Descr="Significant Wave Height Hm0"' in line: 
-
-                new['wave-height'] = find_value(f.readline()); checklist['wave-height'] = True
-
-            elif 'Descr="Wave Peak Direction"' in line:
-                            
-                new['d-wave'] = find_value(f.readline()); checklist['wave-direction'] = True
-
-            elif 'Descr="Wave Peak Period"' in line:
-                            
-                new['s-wave'] = find_value(f.readline()); checklist['wave-period'] = True
-
-            elif 'Descr="Wave Height Swell Hm0"' in line:
-                            
-                new['swell-height'] = find_value(f.readline()); checklist['swell-height'] = True
-
-            # Read next line
-            line = f.readline()
-            
-    # Check all required variables were successfully found in file
-    for key, value in checklist.items():
-        if not value:
-            logger.debug(f'Variable {key} not found in file {file}'); return
-
-    # Subset surface and 15-meter depth velocities from DCPS
-    new['s-surface'], new['d-surface'] = speed[0], direction[0]
-    new['s-15m'],     new['d-15m']   = speed[11], direction[11]
-
-    # Append new values to historical structure
-    for key, value in new.items():
-        var[key].append(value)
-    return
-                 
-def find_value(line, f=None):
-    ''' Get numeric value from line of text '''
-    if '<Value>' not in line:
-        if f:
-            line = f.readline()
-            if '<Value>' not in line:
-                return np.nan 
-        else:
-            return np.nan 
-    i = line.find('e>') + 2
-    e = line.find('</') 
-    return float(line[i:e])    
-
-def find_time(line):
-    ''' Get time from line of text '''
-    i = line.find('e>') + 2
-    e = line.find('</') 
-    return parse(line[i:e])    
-
-def update_local_directory(localpath, extension):
-    ''' Get a list with the names of *.xml files already downloaded '''
-    local = []
-    for file in os.listdir(localpath):
-        if file.endswith(extension):
-            local.append(file)
-    return sorted(local)
-         
-def xml_file_download(local, localpath, host, user, pswd, folder):
-    ''' Download *.xml files to local path using SFTP credentials '''
+    var = pd.DataFrame(var)
+    # Resample at 10 minutes to ensure continuous time series
+    var = var.resample('10T', on='time').mean()
+    write_partition(store, '10T', name, var)
+
+    # Rollup tiers for long-range queries (directions averaged as vectors)
+    angles = [key for key in var if key.startswith('d-')]
+    for freq in TIERS:
+        write_partition(store, freq, name, rollup(var, freq, angles))
+
+def requalify(outdir):
+    ''' Quality control the whole history again (e.g. after a change in
+        the tests), one monthly partition at a time, without parsing *.xml
+        files. Returns the number of partitions. '''
+
+    store = f'{outdir}store'
+    names = partitions(store, 'raw')
+    for name in names:
+        resample(store, name)
+    update_index(store, ROSES)
+    logger.info(f'{now()} Quality control applied to {len(names)} partitions')
+
+    return len(names)
+
+def read_buoy_files(files, bundles={}):
+    ''' Read *.xml files with the El Campello set of descriptors. Files
+        packed into daily bundles are given as {name: day} in "bundles" '''
+    return read_xml_texts(read_texts(files, bundles), len(files), CAMPELLO)
+
+def xml_file_download(db, localpath, host, user, pswd, folder, channels):
+    ''' Download new *.xml files to local path using SFTP credentials '''
     logger.info(f'{now()} XML_FILE_DOWNLOAD Setting known hosts')
     cnopts = pysftp.CnOpts(knownhosts='known_hosts')
-    # Open SFTP connection and start the download
-    logger.info(f'{now()} XML_FILE_DOWNLOAD Opening SFTP connection')
-    with pysftp.Connection(host=host, username=user, password=pswd, cnopts=cnopts) as sftp:
-        logger.info(f'{now()} XML_FILE_DOWNLOAD Changing SFTP folder')
-        sftp.cwd(folder)
-        logger.info(f'{now()} XML_FILE_DOWNLOAD Running SFTP.LISTDIR()')
-        for file in sftp.listdir():
-            if ( file not in local ) and file[-4:] == '.xml':
-                logger.info(f'{now()}: Downloading {file}'); 
-                count = 0
-                while count < 3:
-                    try: 
-                        sftp.get(file, localpath=localpath + '/' + file); 
-                        if is_empty(localpath + '/' + file):
-                            count += 1; continue
-                        break
-                    except paramiko.SSHException: count += 1; continue
-
-def vardict():
-    ''' Initialize empty dictionary for buoy data '''
-    return {
-            'time':  [], 'temp': [], 'tur': [], 'O2': [],
-
-        's-wind': [], 'd-wind': [],
-
-        'wave-height': [], 'swell-height': [],
-
-        's-wave': [], 'd-wave': [],
-
-        's-surface': [], 'd-surface': [], 's-15m': [], 'd-15m': []
-
-           }       
+    # Each SFTP channel opens its own connection
+    connect = lambda: pysftp.Connection(host=host, username=user, password=pswd, cnopts=cnopts)
+    logger.info(f'{now()} XML_FILE_DOWNLOAD Downloading over {channels} SFTP channels')
+    download(db, connect, folder, localpath, workers=channels)
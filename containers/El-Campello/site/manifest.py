@@ -0,0 +1,172 @@
+'''
+    Persistent manifest of the *.xml files downloaded to the local directory.
+    For each file, the size, modification time, checksum and parse status are
+    kept in a SQLite database, so that new remote files and empty (failed)
+    downloads can be found without listing or opening every local file.
+
+    Files of closed days are packed into daily bundles (see bundle.py). The
+    manifest keeps their rows, with the day of the bundle in column "bundle"
+    (NULL for loose files in the local directory).
+
+    Parse status is one of:
+
+        'new'       downloaded, not parsed yet
+        'parsed'    parsed, all variables found
+        'invalid'   parsed, some variables missing
+        'empty'     empty file (silent, failed download)
+
+    Remote files whose download failed are kept in table "failures", with
+    their modification time and the number of runs in which they failed,
+    until they are downloaded (see downloader.py).
+
+    The local directory is only scanned when its modification time differs
+    from the one recorded after the last scan (i.e. files were added or
+    removed by someone other than the manifest functions).
+'''
+
+from hashlib import md5
+import sqlite3
+import os
+
+INSERT = '''INSERT OR REPLACE INTO files (name, size, mtime, checksum, status)
+    VALUES (?, ?, ?, ?, ?)'''
+
+def open_manifest(filename):
+    ''' Open (create if needed) the manifest database '''
+    db = sqlite3.connect(filename)
+    db.execute('''CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY,
+        size INTEGER, mtime REAL, checksum TEXT, status TEXT, bundle TEXT)''')
+    # Manifests created before files were bundled
+    if 'bundle' not in [row[1] for row in db.execute('PRAGMA table_info(files)')]:
+        db.execute('ALTER TABLE files ADD COLUMN bundle TEXT')
+    db.execute('CREATE INDEX IF NOT EXISTS status ON files (status)')
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    db.execute('''CREATE TABLE IF NOT EXISTS failures (name TEXT PRIMARY KEY,
+        mtime REAL, runs INTEGER)''')
+    db.commit()
+    return db
+
+def get_meta(db, key):
+    row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(db, key, value):
+    db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+def checksum(file):
+    ''' MD5 checksum of file '''
+    with open(file, 'rb') as f:
+        return md5(f.read()).hexdigest()
+
+def entry(localpath, name):
+    ''' Manifest row for local file '''
+    file = localpath + '/' + name
+    st = os.stat(file)
+    status = 'new' if st.st_size else 'empty'
+    return name, st.st_size, st.st_mtime, checksum(file), status
+
+def mark_directory(db, localpath):
+    ''' Record the modification time of the local directory, once the
+        manifest is known to be in agreement with its contents '''
+    set_meta(db, 'mtime', os.stat(localpath).st_mtime_ns)
+    db.commit()
+
+def sync_manifest(db, localpath, extension):
+    ''' Bring the manifest up to date with the local directory, only if the
+        directory has changed since last time. Returns the number of files
+        added to and removed from the manifest. '''
+    if get_meta(db, 'mtime') == str(os.stat(localpath).st_mtime_ns):
+        return 0, 0
+
+    with os.scandir(localpath) as entries:
+        local = {e.name for e in entries if e.name.endswith(extension)}
+    known = {name for name, in db.execute('SELECT name FROM files WHERE bundle IS NULL')}
+
+    added, removed = local - known, known - local
+    db.executemany(INSERT, (entry(localpath, name) for name in sorted(added)))
+    db.executemany('DELETE FROM files WHERE name = ?', ((name,) for name in removed))
+    mark_directory(db, localpath)
+    return len(added), len(removed)
+
+def known_files(db):
+    ''' Set of file names in the manifest '''
+    return {name for name, in db.execute('SELECT name FROM files')}
+
+def add_file(db, localpath, name):
+    ''' Add a downloaded file to the manifest. Returns False if empty. '''
+    row = entry(localpath, name)
+    db.execute(INSERT, row)
+    mark_directory(db, localpath)
+    return row[-1] != 'empty'
+
+def failed_files(db):
+    ''' Remote files whose download failed: {name: (mtime, runs)} '''
+    return {name: (mtime, runs) for name, mtime, runs in
+            db.execute('SELECT name, mtime, runs FROM failures')}
+
+def set_failed(db, name, mtime):
+    ''' Record a failed download of remote file. Returns the number of runs
+        in which it has failed. '''
+    db.execute('''INSERT INTO failures VALUES (?, ?, 1) ON CONFLICT (name)
+        DO UPDATE SET mtime = excluded.mtime, runs = runs + 1''', (name, mtime))
+    db.commit()
+    return db.execute('SELECT runs FROM failures WHERE name = ?', (name,)).fetchone()[0]
+
+def remove_failed(db, names):
+    ''' Forget failed downloads (e.g. downloaded since) '''
+    db.executemany('DELETE FROM failures WHERE name = ?', ((name,) for name in names))
+    db.commit()
+
+def remove_empty(db, localpath):
+    ''' Remove empty (corrupted) files from local directory and manifest.
+        Returns the number of files removed. '''
+    names = [name for name, in db.execute(
+        "SELECT name FROM files WHERE status = 'empty'")]
+    for name in names:
+        try:
+            os.remove(localpath + '/' + name)
+        except FileNotFoundError:
+            pass
+    if names:
+        db.executemany('DELETE FROM files WHERE name = ?', ((name,) for name in names))
+        mark_directory(db, localpath)
+    return len(names)
+
+def manifest_stats(db, status=None):
+    ''' Size and modification time of the non-empty files in manifest, or
+        only of those files with the given parse status '''
+    if status is None:
+        rows = db.execute("SELECT name, size, mtime FROM files WHERE status != 'empty'")
+    else:
+        rows = db.execute('SELECT name, size, mtime FROM files WHERE status = ?', (status,))
+    return {name: (size, mtime) for name, size, mtime in rows}
+
+def set_status(db, names, valid):
+    ''' Set parse status of files after reading '''
+    db.executemany('UPDATE files SET status = ? WHERE name = ?',
+            (('parsed' if v else 'invalid', name) for name, v in zip(names, valid)))
+    db.commit()
+
+def loose_files(db):
+    ''' Name and modification time of the (non-empty) loose files '''
+    return db.execute('''SELECT name, mtime FROM files
+        WHERE bundle IS NULL AND status != 'empty' ORDER BY name''').fetchall()
+
+def set_bundle(db, names, day):
+    ''' Record that files have been packed into the bundle of "day" '''
+    db.executemany('UPDATE files SET bundle = ? WHERE name = ?',
+            ((day, name) for name in names))
+    db.commit()
+
+def bundled_files(db, names=None):
+    ''' Day of bundle for each bundled file, optionally only for "names" '''
+    if names is None:
+        return dict(db.execute('SELECT name, bundle FROM files WHERE bundle IS NOT NULL'))
+    days = {}
+    names = list(names)
+    # Query in batches, to stay within the SQLite limit on parameters
+    for i in range(0, len(names), 500):
+        batch = names[i : i + 500]
+        days.update(db.execute(f'''SELECT name, bundle FROM files WHERE bundle IS NOT NULL
+            AND name IN ({', '.join('?' * len(batch))})''', batch))
+    return days
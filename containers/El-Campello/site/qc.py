@@ -0,0 +1,141 @@
+'''
+    Vectorized quality control of in-situ variables.
+
+    Tests are applied to NumPy columns, and configured for each variable:
+
+        'sentinels'   values used by the buoy for missing data
+        'range'       (min, max) valid range (None for no limit)
+        'rate'        maximum rate of change from the previous sample, per hour
+        'spike'       (window, threshold) maximum deviation from the median of
+                      the previous "window" samples
+
+    Flags follow the QARTOD convention:
+
+        1 pass, 3 suspect (rate of change), 4 fail (range, spike), 9 missing
+
+    Values flagged as fail or missing are masked (NaN). The rate-of-change
+    and spike tests only look back in time, so data can be checked in chunks
+    (e.g. monthly partitions) as long as the last samples of the previous
+    chunk are given as context. Flags of a chunk do not depend on where the
+    chunk boundaries are.
+'''
+
+from numpy.lib.stride_tricks import sliding_window_view
+import pandas as pd
+import numpy as np
+import warnings
+
+PASS, SUSPECT, FAIL, MISSING = 1, 3, 4, 9
+
+# Sentinels used by the buoys for missing data (applied to all variables)
+SENTINELS = (68., 81.)
+
+DIRECTION = {'range': (0, 360)}
+
+# Deenish Island
+DEENISH = {
+    'temp': {'range': (-2.5, 40), 'rate': 4, 'spike': (6, 2)},
+    'salt': {'range': (2, 42), 'rate': 4, 'spike': (6, 2)},
+    'pH':   {'range': (6.5, 9.5), 'rate': 1, 'spike': (6, 0.5)},
+    'O2':   {'range': (0, None)},
+    'RFU':  {'range': (0, None)},
+    'BGA':  {'range': (0, None)},
+    's-surface': {'range': (0, None)},
+    'd-surface': DIRECTION,
+    's-seabed': {'range': (0, None)},
+    'd-seabed': DIRECTION,
+}
+
+# El Campello
+CAMPELLO = {
+    'temp': {'range': (-2.5, 40), 'rate': 4, 'spike': (6, 2)},
+    'O2':   {'range': (0, None)},
+    'tur':  {'range': (0, None)},
+    's-wind': {'range': (0, 250)},
+    'd-wind': DIRECTION,
+    'wave-height': {'range': (0, 20)},
+    'd-wave': DIRECTION,
+    's-wave': {'range': (0, 30)},
+    'swell-height': {'range': (0, 20)},
+    's-surface': {'range': (0, None)},
+    'd-surface': DIRECTION,
+    's-15m': {'range': (0, None)},
+    'd-15m': DIRECTION,
+}
+
+def lookback(tests):
+    ''' Number of previous samples needed as context by the tests '''
+    n = 1
+    for test in tests.values():
+        if 'spike' in test:
+            n = max(n, test['spike'][0])
+    return n
+
+def check(values, hours, test):
+    ''' Flags of a single variable. "hours" is the time since the previous
+        sample. Returns flags and masked values. '''
+
+    values = np.array(values, dtype=float)
+    flags = np.full(len(values), PASS, dtype=np.int8)
+
+    # Missing data and sentinels
+    missing = np.isnan(values) | np.isin(values, test.get('sentinels', SENTINELS))
+    flags[missing] = MISSING
+    values[missing] = np.nan
+
+    # Valid range
+    lo, hi = test.get('range', (None, None))
+    with np.errstate(invalid='ignore'):
+        bad = np.zeros(len(values), dtype=bool)
+        if lo is not None: bad |= values < lo
+        if hi is not None: bad |= values > hi
+    flags[bad] = FAIL
+    values[bad] = np.nan
+
+    # Rate of change from previous sample
+    if 'rate' in test and len(values) > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = np.abs(np.diff(values)) / hours[1:]
+        suspect = np.concatenate(([False], rate > test['rate']))
+        flags[suspect & (flags == PASS)] = SUSPECT
+
+    # Spike: deviation from the median of the previous samples
+    if 'spike' in test:
+        window, threshold = test['spike']
+        if len(values) > window:
+            previous = sliding_window_view(values[:-1], window)
+            # Windows with no data give NaN median (and a warning)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                median = np.nanmedian(previous, axis=1)
+                spike = np.concatenate((np.zeros(window, dtype=bool),
+                    np.abs(values[window:] - median) > threshold))
+            flags[spike & (flags < FAIL)] = FAIL
+            values[spike] = np.nan
+
+    return flags, values
+
+def quality_control(var, tests, context=None):
+    ''' Check NumPy columns in "var" (with time in var['time']). "context" is
+        the last samples of the previous chunk, with the same keys. Returns
+        masked values and flags, for all keys but time. '''
+
+    time = pd.DatetimeIndex(var['time'])
+    if context is not None and len(context['time']):
+        m = len(context['time'])
+        time = pd.DatetimeIndex(context['time']).append(time)
+    else:
+        context, m = None, 0
+
+    # Time since previous sample, in hours
+    hours = np.diff(time.asi8, prepend=time.asi8[:1]) / 3.6e12
+
+    values, flags = {'time': var['time']}, {}
+    for key in var:
+        if key == 'time': continue
+        column = np.asarray(var[key], dtype=float)
+        if context is not None:
+            column = np.concatenate((np.asarray(context[key], dtype=float), column))
+        flag, value = check(column, hours, tests.get(key, {}))
+        values[key], flags[key] = value[m:], flag[m:]
+    return values, flags
@@ -0,0 +1,38 @@
+from pickle import dump, load
+import pandas as pd
+import os
+
+def load_records(filename):
+    ''' Load parsed records. This is a data frame with one row per *.xml
+        file, indexed by file name, with the file size and modification time
+        and a boolean column "valid" set to False for incomplete files. '''
+    try:
+        with open(filename, 'rb') as f:
+            return load(f)
+    except (FileNotFoundError, EOFError):
+        return pd.DataFrame(columns=['size', 'mtime', 'valid'])
+
+def save_records(records, filename):
+    ''' Save parsed records. Write to a temporary file first, so that an
+        interrupted run does not leave a truncated file behind '''
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        dump(records, f)
+    os.replace(tmp, filename)
+
+def parse_records(localpath, names, stats, reader):
+    ''' Parse a list of files into new records. "stats" is a data frame of
+        (size, mtime) indexed by file name '''
+    new = pd.DataFrame(reader([localpath + '/' + name for name in names]),
+            index=pd.Index(names))
+    new['size'], new['mtime'] = stats.loc[names, 'size'], stats.loc[names, 'mtime']
+    return new
+
+def valid_records(records, keys):
+    ''' Get the complete records as a data frame of "keys" indexed by time,
+        with the name of the file of each record in column "file" '''
+    valid = records[records['valid'].astype(bool)]
+    var = pd.DataFrame({key: valid[key].to_numpy(float) for key in keys if key != 'time'},
+            index=pd.DatetimeIndex(pd.to_datetime(valid['time'], utc=True), name='time'))
+    var['file'] = valid.index.to_numpy()
+    return var
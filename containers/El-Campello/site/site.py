@@ -29,10 +29,11 @@ from datetime import datetime, timedelta
 from output import send_output
 from pytz import timezone as tz
 import numpy as np
-import pickle
 from get_uv import get_uv
-from wind_rose import wind_rose
+from wind_rose import wind_rose, frequencies
 from buoy import Buoy
+from store import read_table, nearest
+from climatology import site_climatology
 from log import set_logger, now
 import os
 
@@ -49,55 +50,13 @@ def configuration():
             config[key] = val
     return config
 
-def subset(buoy, t0, t1):
-    ''' Subset buoy data for the requested time period '''
-    
-    time = buoy.index 
-  
-    i0, i1 = np.argmin(abs(time - t0)), np.argmin(abs(time - t1)) + 1
-    
-    sub = buoy[i0 : i1]
-
-    return sub
-
-def site_climatology(infile, time):
-    ''' Reads site climatology from local PICKLE file '''
-    
-    with open(infile, 'rb') as f:
-        clim = pickle.load(f)
-    
-    t0, t1 = time[0] - timedelta(days=1), time[-1] + timedelta(days=8)
-    
-    time = []
-    while t0 < t1:
-        time.append(t0); t0 += timedelta(minutes=10)
-    # Data from local climatology file    
-    day_of_year, seasonal_cycle, PC90 = clim['time'], clim['seas'], clim['pc90']
-    
-    # Output initialization
-    Time, Seas, Pc90 = [], [], []
-    
-    for t in time:        
-        H, M = t.hour, t.minute            
-        if H == 12 and not M:
-            # Get day of year
-            Day_Of_Year = t.timetuple().tm_yday
-            # Find time index in local climatology file
-            i = np.where(day_of_year == Day_Of_Year)[0][0]
-            # Append to output arrays
-            Time.append(t)
-            Seas.append(seasonal_cycle[i])
-            Pc90.append(PC90[i])
-    
-    return Time, Seas, Pc90
-
 def prepare_wind_rose(r, D):
     
     r, D = np.array(r), np.array(D)
 
     return np.vstack((r, D)).T
 
-def windrose(sub, level='surface', vartype='currents'):
+def windrose(sub, level='surface', vartype='currents', frequency=None):
     ''' Create wind rose figure and associated time series '''
     series = dict(time=sub.index,
             speed=sub.get(f's-{level}'),
@@ -106,17 +65,22 @@ def windrose(sub, level='surface', vartype='currents'):
     # Subset for the last 24 hours
     time, r, D = sub.index[-144::], sub.get(f's-{level}')[-144::], sub.get(f'd-{level}')[-144::]
     # Create figure
-    idate, edate, wind_rose_fig = wind_rose(time, prepare_wind_rose(r, D), vartype)
-    # Fix legend
-    if 'wave' in level:
-        wind_rose_fig = wind_rose_fig.replace("strength", "period")
-    else:
-        wind_rose_fig = wind_rose_fig.replace("strength", "speed")
+    idate, edate, wind_rose_fig = wind_rose(time, prepare_wind_rose(r, D), vartype, frequency,
+            'period' if 'wave' in level else 'speed')
     # Wrap 
     fig = {'idate': idate, 'edate': edate, 'fig': wind_rose_fig}
 
     return series, fig
 
+def windroses(sub, levels):
+    ''' Wind roses of several levels, given as (level, vartype) pairs. The
+        histograms of all levels are computed at once. '''
+    last = sub.iloc[-144::]
+    data = [(prepare_wind_rose(last.get(f's-{level}'), last.get(f'd-{level}')), vartype)
+            for level, vartype in levels]
+    return [windrose(sub, level, vartype, frequency)
+            for (level, vartype), frequency in zip(levels, frequencies(data))]
+
 
 def SITE(date=datetime.now()):
     
@@ -130,7 +94,7 @@ def SITE(date=datetime.now()):
             raise FileNotFoundError(f'config file not found at root directory {root}')
                 
         logger.info(f'{now()} Loading buoy data...')
-        var = Buoy(config)
+        store = Buoy(config)
     
         ''' Subset for the latest NDAYS as per config file '''
         t1 = tz('UTC').localize(date)
@@ -138,21 +102,25 @@ def SITE(date=datetime.now()):
         t0 = t1 - timedelta(days=NDAYS)
 
         logger.info(f'{now()} Subsetting...')
-        sub = subset(var, t0, t1)
+        # Only the monthly partitions overlapping the period are read
+        sub = read_table(store, '10T', t0, t1, freq='10T')
+        if not len(sub):
+            # No data in the latest NDAYS: the last NDAYS with data
+            t1, _ = nearest(store, '10T', t0)
+            if t1 is None:
+                raise ValueError(f'No buoy data in {store}')
+            t0 = t1 - timedelta(days=NDAYS)
+            sub = read_table(store, '10T', t0, t1, freq='10T')
 
         # Read climatology 
         logger.info(f'{now()} Reading climatology...')
         clim = site_climatology(config.get('clim_site'), sub.index)
 
         ''' Wind Roses '''
-        # Surface currents
-        surface_series, surface_fig = windrose(sub)
-        # 15-meter depth currents
-        z15_series, z15_fig = windrose(sub, level='15m')
-        # Winds 
-        wind_series, wind_fig = windrose(sub, level='wind', vartype='wind')
-        # Wave period
-        wave_series, wave_fig = windrose(sub, level='wave', vartype='wave')
+        # Surface and 15-meter depth currents, winds and wave period
+        (surface_series, surface_fig), (z15_series, z15_fig), \
+        (wind_series, wind_fig), (wave_series, wave_fig) = windroses(sub,
+                [('surface', 'currents'), ('15m', 'currents'), ('wind', 'wind'), ('wave', 'wave')])
 
         ''' Add wind series for time series plot (subset every 3 hours) '''
         wind3h = {
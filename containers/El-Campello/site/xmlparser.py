@@ -0,0 +1,152 @@
+'''
+    Single-pass parser for the Puertos del Estado (INS-TAC) buoy *.xml files.
+
+    Each file is read at once. Time and scalar descriptors are located with
+    str.find, and the value of a descriptor is taken from the next line. For
+    the DCPS, speed (<Point ID="2">) and direction (<Point ID="3">) are given
+    for each cell of the profile, and the value may be found up to two lines
+    below; all points are collected with a single regular expression. Values
+    are written straight into preallocated NumPy columns, and timestamps are
+    converted in bulk once all files have been read.
+'''
+
+from dateutil.parser import parse
+import pandas as pd
+import numpy as np
+import re
+
+# Deenish Island: (column, descriptor, scale factor)
+DEENISH = {
+    'scalars': (
+        ('temp', 'Descr="Temperature"', 1),
+        ('salt', 'Descr="Salinity"', 1),
+        ('O2', 'Descr="Dissolved Oxygen"', 1),
+        ('pH', 'Descr="pH"', 1),
+        ('RFU', 'Descr="Chlorophyll RFU"', 1),
+        ('BGA', 'Descr="BGA-PE RFU"', 1),
+    ),
+    # DCPS cells of interest: (level, index of cell in profile)
+    'cells': (('surface', 0), ('seabed', -1)),
+}
+
+# El Campello: (column, descriptor, scale factor)
+CAMPELLO = {
+    'scalars': (
+        ('temp', 'Descr="Water Temperature"', 1),
+        ('O2', 'Descr="Dissolved Oxygen"', 1),
+        ('tur', 'Descr="Turbidity"', 1),
+        ('d-wind', 'Average Corrected Wind Diretion', 1),
+        ('s-wind', 'Average Corrected Wind Speed', 3.6), # m/s to km/h
+        ('wave-height', 'Descr="Significant Wave Height Hm0"', 1),
+        ('d-wave', 'Descr="Wave Peak Direction"', 1),
+        ('s-wave', 'Descr="Wave Peak Period"', 1),
+        ('swell-height', 'Descr="Wave Height Swell Hm0"', 1),
+    ),
+    # DCPS cells of interest: (level, index of cell in profile)
+    'cells': (('surface', 0), ('15m', 11)),
+}
+
+TIME = '<Time>'
+
+# DCPS points: speed is ID 2 and direction is ID 3. Groups are: point ID,
+# value line (next line) or value line (two lines below).
+POINTS = re.compile(r'<Point ID="([23])">[^\n]*\n(?:([^\n]*<Value>[^\n]*)|[^\n]*\n([^\n]*))')
+
+# Number of header lines to discard at the beginning of each file
+HEADER = 5
+
+def columns(descriptors):
+    ''' Names of the output columns for a set of descriptors '''
+    names = ['time'] + [name for name, _, _ in descriptors['scalars']]
+    for level, _ in descriptors['cells']:
+        names += [f's-{level}', f'd-{level}']
+    return names
+
+def value(line):
+    ''' Get numeric value from line of text '''
+    return float(line[line.find('e>') + 2 : line.find('</')])
+
+def read_xml_files(files, descriptors):
+    ''' Read a list of *.xml files. Return a dictionary of NumPy columns,
+        with one row per file, and a boolean column "valid" set to False
+        for files missing any of the required variables. '''
+    return read_xml_texts((read_text(file) for file in files), len(files), descriptors)
+
+def read_text(file):
+    ''' Read whole file at once '''
+    with open(file, 'r') as f:
+        return f.read()
+
+def read_xml_texts(texts, n, descriptors):
+    ''' Parse "n" *.xml documents given as strings. See read_xml_files '''
+
+    scalars, cells = descriptors['scalars'], descriptors['cells']
+
+    # Preallocate output columns
+    out = {name: np.full(n, np.nan) for name in columns(descriptors)[1:]}
+    times = np.empty(n, dtype=object)
+    valid = np.zeros(n, dtype=bool)
+
+    for row, text in enumerate(texts):
+        times[row], valid[row] = parse_text(text, row, scalars, cells, out)
+
+    # Convert timestamps in bulk (NaT for incomplete files)
+    times[~valid] = None
+    out['time'] = to_datetime(times)
+    out['valid'] = valid
+    return out
+
+def parse_text(text, row, scalars, cells, out):
+    ''' Parse one *.xml document into row "row" of the output columns.
+        Return time string and whether all variables were found. '''
+
+    # Discard header
+    pos = 0
+    for i in range(HEADER):
+        pos = text.find('\n', pos) + 1
+        if not pos: return None, False
+
+    i = text.find(TIME, pos)
+    if i < 0: return None, False
+    time = text[i + len(TIME) : text.find('</', i)]
+
+    for name, key, scale in scalars:
+        # Last occurrence, as the line-by-line parser kept overwriting values
+        i = text.rfind(key, pos)
+        if i < 0: return None, False
+        # Value is expected in the next line
+        i = text.find('\n', i) + 1
+        if not i: return None, False
+        line = text[i : text.find('\n', i)]
+        if '<Value>' in line:
+            out[name][row] = scale * value(line)
+
+    speed, direction = [], []
+    for point, line, below in POINTS.findall(text, pos):
+        line = line or below
+        val = value(line) if '<Value>' in line else np.nan
+        if point == '2':
+            speed.append(val)
+        else:
+            direction.append(val)
+
+    # Check DCPS profile was found in file
+    if not speed or not direction:
+        return None, False
+
+    for level, i in cells:
+        try:
+            s, d = speed[i], direction[i]
+        except IndexError:
+            return None, False
+        out[f's-{level}'][row], out[f'd-{level}'][row] = s, d
+
+    return time, True
+
+def to_datetime(times):
+    ''' Convert timestamps to a UTC DatetimeIndex. Use the vectorized ISO 8601
+        parser, and only fall back to dateutil for non-standard strings. '''
+    try:
+        return pd.to_datetime(times, utc=True)
+    except (ValueError, TypeError):
+        return pd.to_datetime([parse(t) if t else None for t in times], utc=True)
@@ -1,9 +1,9 @@
-from pickle import dump
 from math import nan
 from netCDF4 import Dataset, num2date
 import numpy as np
 from datetime import datetime, timedelta
 from json import dumps
+from artifact import write_artifact
 from log import set_logger, now
 from waveSlider import waveSlider
 import pytz
@@ -63,5 +63,4 @@ def send_output(coast, tz, buoy):
         }
 
     outfile = '/data/pkl/CAMPELLO-WAVES.pkl'
-    with open(outfile, 'wb') as f:
-        dump(RS, f)
+    write_artifact(outfile, RS)
@@ -0,0 +1,35 @@
+// Expand a compact time axis (see encoder.axis) into the list of times
+// ('YYYY-MM-DD HH:MM') of a chart. Lists of times are returned as they are.
+var timeaxes = {};
+
+function timeaxis(axis) {
+   if ( Array.isArray(axis) ) {
+       return axis;
+   }
+   if ( !axis.length ) {
+       return [];
+   }
+   // Axes are shared by the charts of a page, so each is expanded once
+   var key = JSON.stringify(axis);
+   if ( key in timeaxes ) {
+       return timeaxes[key];
+   }
+
+   // Local times are handled as UTC, so no time zone is applied here
+   var start = Date.parse(axis.start.replace(' ', 'T') + ':00Z');
+   var step = axis.step * 60000;
+   var times = new Array(axis.length);
+   var g = 0, s = 0, skip = 0, shift = 0;
+   for (var i = 0; i < axis.length; i++) {
+       while ( g < axis.gaps.length && axis.gaps[g][0] == i ) {
+           skip += axis.gaps[g++][1];
+       }
+       while ( s < axis.shifts.length && axis.shifts[s][0] == i ) {
+           shift += axis.shifts[s++][1];
+       }
+       var t = new Date(start + (i + skip) * step + shift * 60000);
+       times[i] = t.toISOString().slice(0, 16).replace('T', ' ');
+   }
+   timeaxes[key] = times;
+   return times;
+}
@@ -1,8 +1,9 @@
-from flask import render_template, request, url_for, redirect, send_file
+from flask import render_template, request, url_for, redirect, send_file, make_response, Response, abort
 from datetime import datetime
 from mhw_historical import mhw_historical
-from ostia import OSTIA, get_ostia_times
-from pickle import load
+from ostia import OSTIA, get_ostia_times, configuration
+from cache import cached_artifact, cached_page, CODINGS
+from exports import export_path, download_name, open_export, stream
 from app import app
 import numpy as np
 import pandas as pd
@@ -13,14 +14,49 @@ import os
 import util
 
 def dataload(pkl, dic):
-    ''' Load data from container. Update dictionary '''
+    ''' Load data from container (artifact or pickle, cached while it does
+        not change). Update dictionary '''
     try:
-        with open(pkl, 'rb') as f:
-            var = load(f)
+        var = cached_artifact(pkl)
     except FileNotFoundError:
         var = {}
     return {**dic, **var}
 
+def encoded(variants):
+    ''' Response with a page in the content coding preferred by the
+        browser, from its variants compressed beforehand ({coding: bytes},
+        uncompressed as 'identity', see cached_page) '''
+    coding = request.accept_encodings.best_match(CODINGS)
+    body = variants[coding] if coding else variants['identity']
+    response = make_response(body)
+    if coding:
+        response.content_encoding = coding
+    response.vary.add('Accept-Encoding')
+    return response, coding
+
+def page(template, paths, context=None, files=()):
+    ''' Render template with the data of files "paths" (see dataload), and
+        of context() if given (e.g. data read from the NetCDF "files"). The
+        page is cached, with its compressed variants, until one of the files
+        changes, and browsers get 304 (Not Modified) if they have it
+        already. '''
+    def render():
+        data = {}
+        for pkl in paths:
+            data = dataload(pkl, data)
+        if context:
+            data.update(context())
+        return render_template(template, **data)
+
+    etag, mtime, variants = cached_page(request.path, [*paths, *files], render)
+    response, coding = encoded(variants)
+    # Each variant has its own (strong) ETag
+    response.set_etag(f'{etag}-{coding}' if coding else etag)
+    response.last_modified = mtime or None
+    # Browsers must check with the server before using their copy
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 #######################################################
 #                                                     #
 #                 HOME    PAGE                        #
@@ -218,8 +254,7 @@ def form():
     filename = site.replace("'", "_").replace(" ", "-") 
 
     root = '/data/BIRDS/'
-    with open(f'{root}{filename}-WEB.pkl', 'rb') as f:
-        data = load(f) # Load eBird observations
+    data = cached_artifact(f'{root}{filename}-WEB.pkl') # Load eBird observations
 
     # Get coordinates of sightings
     lon, lat = data.get('lonBird'), data.get('latBird')
@@ -290,14 +325,9 @@ def Deenish():
 @app.route('/Deenish-Island')
 def Deenish_Island():
 
-    # Load observations
-    data = dataload('/data/pkl/BUOY-1.pkl', {})
-    # Load forecasts
-    data = dataload('/data/pkl/MODEL-1.pkl', data)
-    # Load wave forecast
-    data = dataload('/data/pkl/DEENISH-WAVE-SERIES.pkl', data)
-
-    return render_template('Deenish-Island.html', **data) 
+    # Observations, forecasts and wave forecast
+    return page('Deenish-Island.html', ['/data/pkl/BUOY-1.pkl',
+        '/data/pkl/MODEL-1.pkl', '/data/pkl/DEENISH-WAVE-SERIES.pkl'])
 
 ''' Deenish: remote sensing (EN) '''
 '''
@@ -344,24 +374,21 @@ def sstframe():
         # Load map for requested date
         return redirect(url_for('sstuserdate', userdate=userdate))
     else:
-        # Read last two weeks SST figure
-        data = dataload('/data/SST.pkl', {})
-        # Get time list in SST database
-        ini, timelist = get_ostia_times()
-        # Append time information for date selection calendar widgets
-        data['ini'] = ini; data['timelist'] = timelist
-        # Return template
-        return render_template('sst-iframe.html', **data)
+        # Read last two weeks SST figure, and time list in SST database
+        # for the date selection calendar widgets
+        def context():
+            ini, timelist = get_ostia_times()
+            return dict(ini=ini, timelist=timelist)
+        return page('sst-iframe.html', ['/data/SST.pkl'], context, [configuration().get('sstnc')])
 
 @app.route('/sst/<userdate>')
 def sstuserdate(userdate):
 
     # Read SST for selected date
-    fig, timelist = OSTIA(userdate, 'sst')
-    # Wrap everything before rendering template
-    data = dict(SST=fig, ini=userdate, timelist=timelist)
-    # Return template
-    return render_template('sst-iframe.html', **data)
+    def context():
+        fig, timelist = OSTIA(userdate, 'sst')
+        return dict(SST=fig, ini=userdate, timelist=timelist)
+    return page('sst-iframe.html', [], context, [configuration().get('sstnc')])
 
 ''' Deenish: sea surface temperature anomaly (EN) '''
 '''
@@ -378,24 +405,21 @@ def anmframe():
         # Load map for requested date
         return redirect(url_for('anmuserdate', userdate=userdate))
     else:
-        # Read last two weeks ANM figure
-        data = dataload('/data/ANM.pkl', {})
-        # Get time list in SST database
-        ini, timelist = get_ostia_times()
-        # Append time information for date selection calendar widgets
-        data['ini'] = ini; data['timelist'] = timelist
-        # Return template
-        return render_template('anm-iframe.html', **data)
+        # Read last two weeks ANM figure, and time list in SST database
+        # for the date selection calendar widgets
+        def context():
+            ini, timelist = get_ostia_times()
+            return dict(ini=ini, timelist=timelist)
+        return page('anm-iframe.html', ['/data/ANM.pkl'], context, [configuration().get('sstnc')])
 
 @app.route('/anm/<userdate>')
 def anmuserdate(userdate):
 
     # Read ANM for selected date
-    fig, timelist = OSTIA(userdate, 'anm')
-    # Wrap everything before rendering template
-    data = dict(ANM=fig, ini=userdate, timelist=timelist)
-    # Return template
-    return render_template('anm-iframe.html', **data)
+    def context():
+        fig, timelist = OSTIA(userdate, 'anm')
+        return dict(ANM=fig, ini=userdate, timelist=timelist)
+    return page('anm-iframe.html', [], context, [configuration().get('sstnc')])
 
 
 ''' Deenish: marine heat waves (EN) '''
@@ -413,24 +437,21 @@ def mhwframe():
         # Load map for requested date
         return redirect(url_for('mhwuserdate', userdate=userdate))
     else:
-        # Read last two weeks MHW figure
-        data = dataload('/data/MHW.pkl', {})
-        # Get time list in SST database
-        ini, timelist = get_ostia_times()
-        # Append time information for date selection calendar widgets
-        data['ini'] = ini; data['timelist'] = timelist[4::]
-        # Return template
-        return render_template('mhw-iframe.html', **data)
+        # Read last two weeks MHW figure, and time list in SST database
+        # for the date selection calendar widgets
+        def context():
+            ini, timelist = get_ostia_times()
+            return dict(ini=ini, timelist=timelist[4::])
+        return page('mhw-iframe.html', ['/data/MHW.pkl'], context, [configuration().get('sstnc')])
 
 @app.route('/mhw/<userdate>')
 def mhwuserdate(userdate):
 
     # Read SST for selected date
-    fig, timelist = OSTIA(userdate, 'mhw')
-    # Wrap everything before rendering template
-    data = dict(MHW=fig, ini=userdate, timelist=timelist[4::])
-    # Return template
-    return render_template('mhw-iframe.html', **data)
+    def context():
+        fig, timelist = OSTIA(userdate, 'mhw')
+        return dict(MHW=fig, ini=userdate, timelist=timelist[4::])
+    return page('mhw-iframe.html', [], context, [configuration().get('sstnc')])
 
 ''' Deenish: chlorophyll (EN) '''
 '''
@@ -442,8 +463,7 @@ def chl():
 @app.route('/chl')
 def chlframe():
 
-    data = dataload('/data/pkl/CHL.pkl', {})
-    return render_template('chl-iframe.html', **data)
+    return page('chl-iframe.html', ['/data/pkl/CHL.pkl'])
 
 ''' Deenish: wave forecast (EN) '''
 '''
@@ -533,7 +553,15 @@ def hisframe():
 
         for key in request.form:
             if 'csv' in key:
-                return send_file(key, as_attachment=True)
+                # In-situ data of the buoys (written by the containers)
+                if key in [f'/data/csv/{nc}.csv' for nc in buoys()['nc']]:
+                    return send_file(key, as_attachment=True)
+                # Series of the grid point, from the export cache
+                f = open_export(key)
+                if not f:
+                    abort(404)
+                return send_file(f, mimetype='text/csv', as_attachment=True,
+                        download_name=download_name(key))
 
         # Get position selected on the map 
         lon, lat = float(request.form['longitude']), float(request.form['latitude'])
@@ -563,17 +591,31 @@ def hisframe():
         if 'CS' in request.form:
             CS = True
 
-        # Produce figure 
-        try:
+        # Files the figure is made from (SST, climatology and buoy series)
+        config = configuration()
+        files = [config.get('sstnc'), config.get('climnc')]
+        if buoy:
+            files.append(f'/data/netcdf/{buoy[0]}.nc')
+
+        def render():
             fig, csvsst, csvclim, csvmhw, csvcs, csvinsitu = mhw_historical(lon, lat, MHW, CS, buoy=buoy)
+            page = render_template('figure.html', fig=fig, MHW=MHW, CS=CS, insitu=insitu,
+                csvsst=csvsst, csvclim=csvclim, csvmhw=csvmhw, csvcs=csvcs, csvinsitu=csvinsitu)
+            # Exports linked from the figure
+            return page, [f for f in (csvsst, csvclim, csvmhw, csvcs) if f]
+
+        # Produce figure (cached, with its compressed variants, for the
+        # same position and options until the files change)
+        try:
+            _, _, variants = cached_page(f'{request.path}?{lon},{lat},{MHW},{CS}', files, render)
         except RuntimeError:
             error = 'SITE MUST BE AT SEA.'
             return render_template('remote-sensing-historical.html', latitude=52, longitude=-15,
                 polygon=json.dumps([[46,-25],[58,-25],[58,-5],[46,-5]]), error=error) 
    
-        # Return figure
-        return render_template('figure.html', fig=fig, MHW=MHW, CS=CS, insitu=insitu,
-                csvsst=csvsst, csvclim=csvclim, csvmhw=csvmhw, csvcs=csvcs, csvinsitu=csvinsitu)
+        # Return figure (compressed, as the browser accepts)
+        response, _ = encoded(variants)
+        return response
 
     else:
 
@@ -584,10 +626,8 @@ def hisframe():
 @app.route('/Deenish-Island-Historical', methods=['GET', 'POST'])
 def Deenish_Island_Historical():
 
-    # Load historical data
-    with open('/data/his/Deenish-Island/Deenish-Island.pkl', 'rb') as f: 
-        data = load(f)
-    timelist = data.index
+    # First and last times of historical data
+    timelist = util.timelist('Deenish')
 
     if request.method == 'POST':
 
@@ -609,27 +649,27 @@ def Deenish_Island_Historical():
                 date1=start, date2=end, date3=uv, csv='true')
 
         elif 'temp' in request.form:
-            f = f'/data/CSV/csv-temp-{ini}-{fin}.csv'
+            variable = 'temp'
 
         elif 'salt' in request.form:
-            f = f'/data/CSV/csv-salt-{ini}-{fin}.csv'
+            variable = 'salt'
 
         elif 'ph' in request.form:
-            f = f'/data/CSV/csv-pH-{ini}-{fin}.csv'
+            variable = 'pH'
 
         elif 'O2' in request.form:
-            f = f'/data/CSV/csv-O2-{ini}-{fin}.csv'
+            variable = 'O2'
 
         elif 'RFU' in request.form:
-            f = f'/data/CSV/csv-RFU-{ini}-{fin}.csv'
+            variable = 'RFU'
 
         elif 'BGA' in request.form:
-            f = f'/data/CSV/csv-BGA-{ini}-{fin}.csv'
+            variable = 'BGA'
 
         elif 'currents' in request.form:
-            f = f'/data/CSV/csv-currents-{ini}-{fin}.csv'
+            variable = 'currents'
 
-        return send_file(f, as_attachment=True)
+        return download('Deenish', variable, start, end, f'csv-{variable}-{ini}-{fin}.csv', 'en')
 
     else:
 
@@ -663,58 +703,44 @@ def Campello():
 @app.route('/El-Campello')
 def El_Campello():
 
-    # Load observations
-    data = dataload('/data/pkl/BUOY-2.pkl', {})
-    # Load forecasts
-    data = dataload('/data/pkl/MODEL-2.pkl', data)
-
     for pic in glob.iglob(os.path.join('/data/IMG/', '*.png')):
         if os.path.isfile(pic):
             shutil.copy2(pic, '/app/app/static/')
             os.remove(pic)
 
-    return render_template('El-Campello.html', **data) 
+    # Observations and forecasts
+    return page('El-Campello.html', ['/data/pkl/BUOY-2.pkl', '/data/pkl/MODEL-2.pkl'])
 
 ''' El Campello: in-situ operational (ES) '''
 @app.route('/es/El-Campello')
 def El_Campello_es():
 
-    # Load observations
-    data = dataload('/data/pkl/BUOY-2.pkl', {})
-    # Load forecasts
-    data = dataload('/data/pkl/MODEL-2.pkl', data)
-
     for pic in glob.iglob(os.path.join('/data/IMG/', '*.png')):
         if os.path.isfile(pic):
             shutil.copy2(pic, '/app/app/static/')
             os.remove(pic)
 
-    return render_template('El-Campello_es.html', **data) 
+    # Observations and forecasts
+    return page('El-Campello_es.html', ['/data/pkl/BUOY-2.pkl', '/data/pkl/MODEL-2.pkl'])
 
 ''' El Campello: Regional Wave Forecast (EN) '''
 @app.route('/El-Campello-Waves')
 def El_Campello_Waves():
     # Load remote sensing
-    data = dataload('/data/pkl/CAMPELLO-WAVES.pkl', {})
-
-    return render_template('El-Campello-Waves.html', **data)
+    return page('El-Campello-Waves.html', ['/data/pkl/CAMPELLO-WAVES.pkl'])
     
 ''' El Campello: Regional Wave Forecast (ES) '''
 @app.route('/es/El-Campello-Waves')
 def El_Campello_Waves_es():
     # Load remote sensing
-    data = dataload('/data/pkl/CAMPELLO-WAVES.pkl', {})
-
-    return render_template('El-Campello-Waves_es.html', **data)
+    return page('El-Campello-Waves_es.html', ['/data/pkl/CAMPELLO-WAVES.pkl'])
     
 ''' El Campello: Historical Data (EN) '''
 @app.route('/El-Campello-Historical', methods=['GET', 'POST'])
 def El_Campello_Historical():
 
-    # Load historical data
-    with open('/data/his/El-Campello/El-Campello.pkl', 'rb') as f: 
-        data = load(f)
-    timelist = data.index
+    # First and last times of historical data
+    timelist = util.timelist('Campello')
 
     if request.method == 'POST':
 
@@ -740,27 +766,27 @@ def El_Campello_Historical():
                 date1=start, date2=end, date3=uv, csv='true')
 
         elif 'temp' in request.form:
-            f = f'/data/CSV/csv-temp-{ini}-{fin}.csv'
+            variable = 'temp'
 
         elif 'tur' in request.form:
-            f = f'/data/CSV/csv-tur-{ini}-{fin}.csv'
+            variable = 'tur'
 
         elif 'O2' in request.form:
-            f = f'/data/CSV/csv-O2-{ini}-{fin}.csv'
+            variable = 'O2'
 
         elif 'SWH' in request.form:
-            f = f'/data/CSV/csv-swh-{ini}-{fin}.csv'
+            variable = 'swh'
 
         elif 'wave' in request.form:
-            f = f'/data/CSV/csv-wave-{ini}-{fin}.csv'
+            variable = 'wave'
 
         elif 'wind' in request.form:
-            f = f'/data/CSV/csv-wind-{ini}-{fin}.csv'
+            variable = 'wind'
 
         elif 'currents' in request.form:
-            f = f'/data/CSV/csv-currents-{ini}-{fin}.csv'
+            variable = 'currents'
 
-        return send_file(f, as_attachment=True)
+        return download('Campello', variable, start, end, f'csv-{variable}-{ini}-{fin}.csv', 'en')
 
     else:
 
@@ -773,10 +799,8 @@ def El_Campello_Historical():
 @app.route('/es/El-Campello-Historical', methods=['GET', 'POST'])
 def El_Campello_Historical_es():
 
-    # Load historical data
-    with open('/data/his/El-Campello/El-Campello.pkl', 'rb') as f: 
-        data = load(f)
-    timelist = data.index
+    # First and last times of historical data
+    timelist = util.timelist('Campello')
 
     if request.method == 'POST':
 
@@ -802,27 +826,27 @@ def El_Campello_Historical_es():
                 date1=start, date2=end, date3=uv, csv='true')
 
         elif 'temp' in request.form:
-            f = f'/data/CSV/csv-temp-{ini}-{fin}.csv'
+            variable = 'temp'
 
         elif 'tur' in request.form:
-            f = f'/data/CSV/csv-tur-{ini}-{fin}.csv'
+            variable = 'tur'
 
         elif 'O2' in request.form:
-            f = f'/data/CSV/csv-O2-{ini}-{fin}.csv'
+            variable = 'O2'
 
         elif 'SWH' in request.form:
-            f = f'/data/CSV/csv-swh-{ini}-{fin}.csv'
+            variable = 'swh'
 
         elif 'wave' in request.form:
-            f = f'/data/CSV/csv-wave-{ini}-{fin}.csv'
+            variable = 'wave'
 
         elif 'wind' in request.form:
-            f = f'/data/CSV/csv-wind-{ini}-{fin}.csv'
+            variable = 'wind'
 
         elif 'currents' in request.form:
-            f = f'/data/CSV/csv-currents-{ini}-{fin}.csv'
+            variable = 'currents'
 
-        return send_file(f, as_attachment=True)
+        return download('Campello', variable, start, end, f'csv-{variable}-{ini}-{fin}.csv', 'es')
 
     else:
 
@@ -844,6 +868,18 @@ def new_request(form, language, boya):
 
     return data
 
+def download(boya, variable, start, end, filename, language):
+    ''' Send CSV "variable" of buoy for the requested dates as attachment
+        "filename", from the export cache, or streamed as it is written (and
+        saved to the cache) '''
+    key, lines = util.csv_export(boya, variable, start, end, language)
+    path = export_path(key, filename)
+    f = open_export(path)
+    if f:
+        return send_file(f, mimetype='text/csv', as_attachment=True, download_name=filename)
+    return Response(stream(path, lines), mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 def get_dates(form):
     ''' This function returns the dates selected in the calendar widgets '''
 
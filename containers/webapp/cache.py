@@ -0,0 +1,179 @@
+'''
+    In-process cache of the artifacts (and pickles) written by the
+    containers, for dataload().
+
+    Entries are keyed by path and validated with a single os.stat: an
+    artifact is read again only if its modification time, size or inode
+    has changed (a new version is published by renaming a new file over
+    the old one), and then only if its generation has changed too. The
+    cache holds at most BUDGET bytes (estimated) per worker, and the least
+    recently used entries are evicted first.
+
+    Pages rendered only from these files (e.g. the operational pages) are
+    cached too, and rendered again only when one of their files changes.
+    Pages hold at most PAGE_BUDGET bytes (all variants) per worker, also
+    evicting the least recently used first.
+    Their ETag is the hash of the page, so it is the same in all workers.
+    Pages are compressed (gzip, and brotli if installed) once, when they
+    are rendered, and each response picks the variant the browser accepts.
+'''
+
+from collections import OrderedDict
+from artifact import read_artifact, generation
+from threading import Lock
+from hashlib import md5
+import numpy as np
+import gzip
+import sys
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Memory budget of the cache in each worker (bytes)
+BUDGET = 256 * 2**20
+
+# path: (stat key, generation, size in bytes, data)
+ENTRIES = OrderedDict()
+
+STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0,
+        'page_hits': 0, 'page_misses': 0, 'page_evictions': 0, 'page_bytes': 0}
+
+# key: (stat keys of files, ETag, last modification time, variants of page,
+#       files linked, size in bytes)
+PAGES = OrderedDict()
+
+# Memory budget of the pages in each worker (bytes), e.g. maps of dates
+# and figures of positions selected by users
+PAGE_BUDGET = 64 * 2**20
+
+# Content codings of the variants of pages, by order of preference
+CODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# Compression settings (brotli 9 is close to 11 in size, and ten times faster)
+GZIP_LEVEL, BROTLI_QUALITY = 6, 9
+
+LOCK = Lock()
+
+def stat_key(path):
+    ''' Modification time, size and inode of file, or None if missing '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def footprint(value):
+    ''' Approximate memory used by a loaded value (bytes) '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(footprint(k) + footprint(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value) + sum(footprint(v) for v in value)
+    return sys.getsizeof(value)
+
+def evict(size):
+    ''' Remove least recently used entries until "size" more bytes fit '''
+    while ENTRIES and STATS['bytes'] + size > BUDGET:
+        _, (_, _, n, _) = ENTRIES.popitem(last=False)
+        STATS['bytes'] -= n
+        STATS['evictions'] += 1
+
+def cached_artifact(path):
+    ''' Contents of artifact (or pickle) "path", from the cache if it has
+        not changed. Raises FileNotFoundError if there is no such file. The
+        dictionary returned is shared, and must not be modified. '''
+    key = stat_key(path)
+    if key is None:
+        with LOCK:
+            entry = ENTRIES.pop(path, None)
+            if entry:
+                STATS['bytes'] -= entry[2]
+        raise FileNotFoundError(path)
+
+    with LOCK:
+        entry = ENTRIES.get(path)
+        if entry and entry[0] == key:
+            ENTRIES.move_to_end(path)
+            STATS['hits'] += 1
+            return entry[3]
+
+    # Same generation (e.g. file touched but not written again)
+    number = generation(path)
+    with LOCK:
+        if entry and number and entry[1] == number and path in ENTRIES:
+            ENTRIES[path] = (key,) + entry[1:]
+            ENTRIES.move_to_end(path)
+            STATS['hits'] += 1
+            return entry[3]
+
+    data = read_artifact(path)
+    size = footprint(data)
+    with LOCK:
+        STATS['misses'] += 1
+        old = ENTRIES.pop(path, None)
+        if old:
+            STATS['bytes'] -= old[2]
+        if size <= BUDGET:
+            evict(size)
+            ENTRIES[path] = (key, number, size, data)
+            STATS['bytes'] += size
+    return data
+
+def compress(body, coding):
+    ''' Page (bytes) compressed with content coding 'gzip' or 'br' '''
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+def cached_page(key, paths, render):
+    ''' Page "key" (e.g. route) rendered by render() from files "paths",
+        rendered again only if any of the files has changed. render() returns
+        the page, or the page and the files it links to (e.g. exports), and
+        then the page is rendered again if any of these is removed. Returns
+        ETag, last modification time of the files (seconds since epoch) and
+        the variants of the page, {coding: bytes}, uncompressed as
+        'identity'. Pages larger than PAGE_BUDGET are not kept. '''
+    inputs = tuple(stat_key(path) for path in paths)
+    with LOCK:
+        page = PAGES.get(key)
+    if page and page[0] == inputs and all(os.path.exists(path) for path in page[4]):
+        with LOCK:
+            if key in PAGES:
+                PAGES.move_to_end(key)
+            STATS['page_hits'] += 1
+        return page[1:4]
+
+    body, links = render(), ()
+    if isinstance(body, tuple):
+        body, links = body
+    body = body.encode()
+    variants = {coding: compress(body, coding) for coding in CODINGS}
+    variants['identity'] = body
+    etag = md5(body).hexdigest()
+    mtime = max((k[0] for k in inputs if k), default=0) / 1e9
+    size = sum(len(v) for v in variants.values())
+    with LOCK:
+        STATS['page_misses'] += 1
+        old = PAGES.pop(key, None)
+        if old:
+            STATS['page_bytes'] -= old[5]
+        if size <= PAGE_BUDGET:
+            # Least recently used pages first
+            while PAGES and STATS['page_bytes'] + size > PAGE_BUDGET:
+                _, evicted = PAGES.popitem(last=False)
+                STATS['page_bytes'] -= evicted[5]
+                STATS['page_evictions'] += 1
+            PAGES[key] = (inputs, etag, mtime, variants, tuple(links), size)
+            STATS['page_bytes'] += size
+    return etag, mtime, variants
+
+def cache_stats():
+    ''' Hits, misses, evictions, entries and bytes used by the cache '''
+    with LOCK:
+        return dict(STATS, entries=len(ENTRIES), pages=len(PAGES))
@@ -0,0 +1,139 @@
+'''
+    Bulk CSV writer shared by the exports of the webapp (to_csv.py and
+    mhw_historical.py).
+
+    A CSV is given as a header and a list of columns, each with the format
+    of its values. Columns are formatted at once, as NumPy arrays of bytes:
+    times with np.datetime_as_string, and numbers with fixed precision by
+    integer arithmetic on the digits. Each field is padded with null bytes
+    to the width of its column, and the rows of a block are joined by
+    removing the padding. The text is produced as a generator of blocks of
+    BLOCK rows, to be written (or streamed) in large writes.
+
+    The text is byte-identical to formatting each value with "%": values
+    close to a tie between two roundings, infinities and very large values
+    are formatted with "%" itself, and NaN as 'nan'.
+'''
+
+import numpy as np
+import re
+
+# Rows in each block of text
+BLOCK = 65536
+
+# Formats of times, and their unit in np.datetime_as_string()
+TIMES = {'%Y-%m-%d %H:%M': 'm', '%Y-%m-%d': 'D'}
+
+# Day and month abbreviation (climatology)
+DAY = '%d-%b'
+
+MONTHS = np.frombuffer(b'JanFebMarAprMayJunJulAugSepOctNovDec', dtype=np.uint8).reshape(12, 3)
+
+# Number formats: '%.2f', '%d', '%03d'
+NUMBER = re.compile(r'%(?:0(\d+))?(?:\.(\d+))?([fd])$')
+
+def matrix(values):
+    ''' Fixed-width fields (bytes, null-padded) as a 2-D array of bytes '''
+    values = np.asarray(values)
+    width = max(values.dtype.itemsize // (4 if values.dtype.kind == 'U' else 1), 1)
+    return values.astype(f'S{width}').view(np.uint8).reshape(len(values), width)
+
+def right(strings, width):
+    ''' Strings as fields of "width" bytes (at least), aligned right '''
+    return matrix([s.encode().rjust(width, b'\0') for s in strings])
+
+def times(values, fmt):
+    ''' Fields of times (datetime64, datetime or DatetimeIndex in UTC) '''
+    values = np.asarray(values, dtype='datetime64[m]')
+    if fmt == DAY:
+        days = matrix(np.datetime_as_string(values, unit='D'))[:, 8:]
+        months = (values.astype('datetime64[M]') - values.astype('datetime64[Y]')).astype(int)
+        dash = np.full((len(values), 1), ord('-'), dtype=np.uint8)
+        return np.hstack((days, dash, MONTHS[months]))
+    out = matrix(np.datetime_as_string(values, unit=TIMES[fmt]))
+    if fmt.endswith('%H:%M'):
+        out[:, 10] = ord(' ')
+    return out
+
+def digits(a, least):
+    ''' Fields of the decimal digits of non-negative integers, with at least
+        "least" digits (zero-filled) '''
+    width = max(least, len(str(a.max())) if len(a) else 1)
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    out = (a[:, None] // powers % 10 + ord('0')).astype(np.uint8)
+    # Leading zeros are padding
+    out[(a[:, None] < powers) & (np.arange(width) < width - least)] = 0
+    return out
+
+def fixed(values, decimals, least=1, integer=False):
+    ''' Fields of numbers with "decimals" decimal places ('%.{decimals}f'),
+        or of integers zero-filled to "least" digits ('%0{least}d') '''
+    fmt = f'%0{least}d' if integer else f'%.{decimals}f'
+    # Masked values (e.g. land) as NaN, as "%" writes them
+    x = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    if integer:
+        x = np.trunc(x)
+    y = x * 10.0**decimals
+
+    # Numbers rounded exactly by np.rint (not near a tie, not too large)
+    with np.errstate(invalid='ignore'):
+        exact = (np.abs(y) < 2**52) & (np.abs(y - np.floor(y) - 0.5) > np.abs(y) * 2**-50)
+        if integer and least > 1:
+            exact &= x >= 0
+    a = np.where(exact, np.abs(np.rint(y)), 0).astype(np.int64)
+
+    out = digits(a, max(least, decimals + 1))
+    if decimals:
+        dot = np.full((len(a), 1), ord('.'), dtype=np.uint8)
+        out = np.hstack((out[:, :-decimals], dot, out[:, -decimals:]))
+    negative = exact & np.signbit(x)
+    if integer:
+        # int() drops the sign of zero (e.g. of -0.5 or -0.0)
+        negative &= a != 0
+    sign = np.where(negative, ord('-'), 0).astype(np.uint8)
+    out = np.hstack((sign[:, None], out))
+
+    # Other values formatted by "%", the same strings at once (e.g. 'nan')
+    rows = np.flatnonzero(~exact)
+    if len(rows):
+        strings = np.array(['nan' if v != v else fmt % (int(v) if integer else v)
+                for v in x[rows].tolist()])
+        width = max(out.shape[1], max(map(len, strings)))
+        out = np.hstack((np.zeros((len(a), width - out.shape[1]), dtype=np.uint8), out))
+        unique, inverse = np.unique(strings, return_inverse=True)
+        for k, field in enumerate(right(unique, width)):
+            out[rows[inverse == k]] = field
+    return out
+
+def fields(values, fmt):
+    ''' Fields of a column of values with format "fmt" (e.g. '%.2f') '''
+    if fmt in TIMES or fmt == DAY:
+        return times(values, fmt)
+    if fmt == '%s':
+        return matrix([str(v).encode() for v in values])
+    number = NUMBER.match(fmt)
+    if number is None:
+        raise ValueError(f'Format {fmt} is not supported')
+    least, decimals, kind = number.groups()
+    return fixed(values, int(decimals or 0), int(least or 1), kind == 'd')
+
+def rows(columns, sep='\t'):
+    ''' Text of the rows of columns [(values, format), ...] '''
+    separator = np.array([ord(sep)], dtype=np.uint8)
+    blocks = []
+    for values, fmt in columns:
+        blocks += [fields(values, fmt), np.broadcast_to(separator, (len(values), 1))]
+    if not blocks or not len(blocks[0]):
+        return ''
+    blocks[-1] = np.broadcast_to(np.array([ord('\n')], dtype=np.uint8), blocks[-1].shape)
+    text = np.hstack(blocks).ravel()
+    return text[text != 0].tobytes().decode()
+
+def csv_blocks(columns, header='', sep='\t'):
+    ''' Text of CSV (header, and rows of columns [(values, format), ...]) as
+        a generator of blocks of BLOCK rows '''
+    if header:
+        yield header
+    n = len(columns[0][0]) if columns else 0
+    for i in range(0, n, BLOCK):
+        yield rows([(values[i : i + BLOCK], fmt) for values, fmt in columns], sep)
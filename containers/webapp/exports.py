@@ -0,0 +1,120 @@
+'''
+    Cache of the files exported for download (CSV), shared by all workers.
+
+    Exports are content-addressed: a file is named after the hash of its
+    key, which includes everything its contents depend on (e.g. site,
+    variable, dates, language and the generation of the data), followed by
+    the file name of the download. Requests for the same export are served
+    from the same file, and exports of different sites, languages or
+    versions of the data never overwrite each other.
+
+    An export is written to a temporary file which then replaces the
+    original, so readers never see a partially written export. The cache
+    holds at most BUDGET bytes, and the least recently used exports are
+    removed first (the modification time of a file is updated whenever it
+    is used). Deletion is reference-safe: exports are opened before they
+    are sent, and a file removed while it is open can still be read until
+    it is closed, so downloads in progress are not cut short.
+'''
+
+from tempfile import mkstemp
+from hashlib import md5
+import time
+import os
+
+FOLDER = '/data/CSV'
+
+# Disk budget of the cache (bytes)
+BUDGET = 512 * 2**20
+
+# Age (seconds) of temporary files of interrupted writes to be removed
+ABANDONED = 3600
+
+STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def export_path(key, name):
+    ''' Path of export "name" (file name of the download) with key "key", a
+        tuple of the values its contents depend on '''
+    return f'{FOLDER}/{md5(repr(key).encode()).hexdigest()}-{name}'
+
+def download_name(path):
+    ''' File name of the download of an export '''
+    return os.path.basename(path).split('-', 1)[1]
+
+def open_export(path):
+    ''' Open export "path" (binary) and mark it as used. Returns None if it
+        is not in the cache, or if "path" is not an export. '''
+    if os.path.dirname(path) != FOLDER or path.endswith('.tmp'):
+        return None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass # Removed meanwhile, but still open
+    STATS['hits'] += 1
+    return f
+
+def stream(path, blocks):
+    ''' Blocks of text of export "path", from "blocks", written to the cache
+        as they are consumed (a generator). The export is published when all
+        the blocks have been written, and discarded if interrupted. '''
+    os.makedirs(FOLDER, exist_ok=True)
+    fd, tmp = mkstemp(dir=FOLDER, suffix='.tmp')
+    STATS['misses'] += 1
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            for block in blocks:
+                f.write(block)
+                yield block
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    evict()
+
+def publish(path, blocks):
+    ''' Path of export "path", written from "blocks" (text) unless it is in
+        the cache already. Blocks are only consumed if written. '''
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            STATS['hits'] += 1
+            return path
+        except FileNotFoundError:
+            pass # Removed meanwhile
+    for _ in stream(path, blocks):
+        pass
+    return path
+
+def evict():
+    ''' Remove the least recently used exports until the cache fits in
+        BUDGET, and temporary files left by interrupted writes '''
+    files, now = [], time.time()
+    with os.scandir(FOLDER) as entries:
+        for entry in entries:
+            try:
+                st = entry.stat()
+                if not entry.name.endswith('.tmp'):
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                elif now - st.st_mtime > ABANDONED:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= BUDGET:
+            break
+        try:
+            os.remove(path)
+            STATS['evictions'] += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def export_stats():
+    ''' Hits, misses and evictions of the export cache (in this worker) '''
+    return dict(STATS)
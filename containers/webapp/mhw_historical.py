@@ -1,11 +1,15 @@
 from netCDF4 import Dataset, num2date
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
 import plotly.graph_objects as go
+from exports import export_path, publish
+from csvwriter import csv_blocks
+from cache import stat_key
 from mhw import detect
 import plotly
 import numpy as np
+import fcntl
 import json
-import glob
 import os
 
 def configuration():
@@ -19,6 +23,18 @@ def configuration():
             config[key] = val
     return config
 
+@contextmanager
+def locked(ncname):
+    ''' NetCDF "ncname" open for reading, with a shared lock (through
+        "ncname.lock") so that rows are not appended while it is read '''
+    fd = os.open(ncname + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        with Dataset(ncname, 'r') as nc:
+            yield nc
+    finally:
+        os.close(fd)
+
 def datenum2datetime(datenum):
     return np.array([datetime.fromordinal(int(i)) + timedelta(days=i%1) for i in datenum])
 
@@ -202,64 +218,44 @@ def plot_mhw(longitude, latitude, time, SST, years, climatology, PCT10, PCT90, m
     
     return fig
 
-def cleancsv():
-    ''' Remove old CSV files from temporary folder '''
-
-    files = glob.glob('/tmp/*.csv')
-    if len(files) > 100:
-        for f in files:
-            os.remove(f)
+def csvexport(kind, lon, lat, version, lines):
+    ''' Path of CSV "kind" (e.g. 'sst') of grid point in the export cache,
+        written from "lines" only if not there yet. "version" identifies
+        the data it is written from. '''
+    name = f'csv-{kind}-%.3fN-%.3fW.csv' % (lat, abs(lon))
+    return publish(export_path((kind, float(lon), float(lat), version), name), lines)
 
-def sst2csv(lon, lat, time, sst):
+def sst2csv(lon, lat, time, sst, version):
     ''' Write CSV of SST time series '''
 
-    # Set CSV file name
-    filename = f'/tmp/csv-sst-%.3fN-%.3fW.csv' % (lat, abs(lon))
+    # Header, then data (whole columns at once)
+    lines = csv_blocks([(time, '%Y-%m-%d'), (sst, '%.2f')], 'Date,SST (ºC)\n', ',')
 
-    with open(filename, 'w') as f:
-        # Write header
-        f.write('Date,SST (ºC)\n')
-        # Write data line by line
-        for t, temp in zip(time, sst):
-            f.write(f'%s,%.2f\n' % (t.strftime('%Y-%m-%d'), temp))
+    return csvexport('sst', lon, lat, version, lines)
 
-    return filename
-
-def clim2csv(lon, lat, time, clim, pc10, pc90):
+def clim2csv(lon, lat, time, clim, pc10, pc90, version):
     ''' Write CSV of climatology '''
 
-    # Set CSV file name
-    filename = f'/tmp/csv-clim-%.3fN-%.3fW.csv' % (lat, abs(lon))
-
-    with open(filename, 'w') as f:
-        # Write header
-        f.write('Day,PCT.10 (ºC),mean (ºC),PCT.90 (ºC)\n')
-        # Write data line by line
-        for t, pct10, avg, pct90 in zip(time, pc10, clim, pc90):
-            f.write(f'%s,%.2f,%.2f,%.2f\n' % (datetime.strptime(t, '%Y-%m-%d').strftime('%d-%b'),
-                pct10, avg, pct90))
+    # Header, then data (whole columns at once)
+    lines = csv_blocks([(time, '%d-%b'), (pc10, '%.2f'), (clim, '%.2f'), (pc90, '%.2f')],
+        'Day,PCT.10 (ºC),mean (ºC),PCT.90 (ºC)\n', ',')
 
-    return filename
+    return csvexport('clim', lon, lat, version, lines)
 
-def mhw2csv(lon, lat, T0, T1, D, I, categ, mode='hot'):
+def mhw2csv(lon, lat, T0, T1, D, I, categ, version, mode='hot'):
     ''' Write CSV of MHWs '''
 
-    # Set CSV file name
+    # Header, then data (whole columns at once)
+    lines = csv_blocks([(np.arange(len(T0)), '%03d'), (T0, '%s'), (T1, '%s'),
+        (D, '%d'), (I, '%.2f'), (categ, '%s')],
+        'Event ID,start,end,duration (days),intensity (ºC),category\n', ',')
+
     if mode == 'hot':
-        filename = f'/tmp/csv-mhw-%.3fN-%.3fW.csv' % (lat, abs(lon))
+        return csvexport('mhw', lon, lat, version, lines)
     elif mode == 'cold':
-        filename = f'/tmp/csv-cs-%.3fN-%.3fW.csv' % (lat, abs(lon))
+        return csvexport('cs', lon, lat, version, lines)
 
-    with open(filename, 'w') as f:
-        # Write header
-        f.write('Event ID,start,end,duration (days),intensity (ºC),category\n')
-        # Write data line by line
-        for j, (t0, t1, d, i, c) in enumerate(zip(T0, T1, D, I, categ)):
-            f.write(f'%03d,%s,%s,%d,%.2f,%s\n' % (j, t0, t1, int(d), i, c))
-
-    return filename
-
-def process_extreme_events(time, sst, lonGrid, latGrid, mode='hot'):
+def process_extreme_events(time, sst, lonGrid, latGrid, version, mode='hot'):
     ''' Detect extreme events from Hobday container '''
     
     # Convert dates to ordinal times
@@ -286,19 +282,20 @@ def process_extreme_events(time, sst, lonGrid, latGrid, mode='hot'):
     
     # Write CSV of marine heat waves
     if mode == 'hot':
-        csvfile = mhw2csv(lonGrid, latGrid, t0, t1, duration, intensity, categ)
+        csvfile = mhw2csv(lonGrid, latGrid, t0, t1, duration, intensity, categ, version)
     elif mode == 'cold':
         csvfile = mhw2csv(lonGrid, latGrid, t0, t1, 
-                duration, intensity, categ, mode='cold')
+                duration, intensity, categ, version, mode='cold')
 
     return t0, t1, csvfile
 
 def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
 
-    cleancsv()
-    
     ''' Read configuration options '''
     config = configuration()
+
+    # Version of the SST and climatology, for the export cache
+    version = (stat_key(config.get('sstnc')), stat_key(config.get('climnc')))
     
     ''' Read buoy series, if needed '''
     buoydata, csvinsitu = None, None
@@ -311,7 +308,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
         # Set NetCDF full path
         ncname = f'/data/netcdf/{ncname}.nc'
         # Open NetCDF (downloaded from ERDDAP)
-        with Dataset(ncname, 'r') as nc:
+        with locked(ncname) as nc:
             # Read buoy time
             tbuoy = num2date(nc.variables['time'][:],
                     nc.variables['time'].units)
@@ -347,7 +344,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
         idy = np.argmin(abs(y - lat))
         # Read time
         t = nc.variables['time']
-        t = num2date(t[:], t.units)
+        t = num2date(t[:], t.units, only_use_cftime_datetimes=False)
         # Read SST
         sst = nc.variables['analysed_sst'][:, idy, idx] - 273.15 # Kelvin to Celsius
         
@@ -358,7 +355,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
     lonGrid, latGrid = x[idx], y[idy]
     
     # Write CSV of SST series
-    csvsst = sst2csv(lonGrid, latGrid, t, sst)
+    csvsst = sst2csv(lonGrid, latGrid, t, sst, version)
     
     ''' Divide by years '''
     years = np.array([i.year for i in t])
@@ -387,7 +384,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
     if display_mhw:
 
         t0, t1, csvmhw = process_extreme_events(t, sst,
-                lonGrid, latGrid) 
+                lonGrid, latGrid, version) 
         
     else:
         t0, t1, csvmhw = None, None, None
@@ -396,7 +393,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
     if display_cs:
         
         t0cold, t1cold, csvcs = process_extreme_events(t, sst,
-                lonGrid, latGrid, mode='cold') 
+                lonGrid, latGrid, version, mode='cold') 
 
     else:
         t0cold, t1cold, csvcs = None, None, None
@@ -409,7 +406,7 @@ def mhw_historical(lon, lat, display_mhw, display_cs, buoy):
         idate += timedelta(days=1)
         
     # Write CSV of climatology
-    csvclim = clim2csv(lonGrid, latGrid, time, seas, pc10, pc90)
+    csvclim = clim2csv(lonGrid, latGrid, time, seas, pc10, pc90, version)
 
     ''' Get y-axis range '''
     min_y, max_y = float(config.get('min_y')), float(config.get('max_y'))
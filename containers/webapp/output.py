@@ -1,54 +1,123 @@
-from datetime import datetime
 import numpy as np
-from json import dumps
+from encoder import encode, axis, local
 import pandas as pd
-import pytz
+
+# Decimal places of output variables (directions have none)
+PRECISION = {
+    'temp': 2, 'salt': 2, 'pH': 2, 'O2': 2, 'RFU': 2, 'BGA': 2, 'tur': 2,
+    'wave_height': 2, 'swell_height': 2, 's_wave': 1,
+    's_surface': 1, 's_seabed': 1, 's_15m': 1,
+    's_wind': 1, 'u_wind': 1, 'v_wind': 1,
+}
+
+def decimals(key):
+    ''' Decimal places of variable, also for its rollups (see store.rollup) '''
+    base, _, suffix = key.rpartition('_')
+    if suffix == 'count':
+        return 0
+    if suffix in ('min', 'max'):
+        key = base
+    if key.startswith('d_'):
+        return 0
+    return PRECISION.get(key)
 
 def jsonize(data):
+    ''' Encode each variable (but strings) as JSON '''
     for k, v in data.items():
         if isinstance(v, str): continue
         if isinstance(v, tuple): v = v[0]
         try:
-            data[k] = dumps(v) 
-        except TypeError as ERR:
-            if str(ERR) == 'Object of type datetime is not JSON serializable':
-                value = [i.strftime('%Y-%m-%d %H:%M') for i in v]
-                data[k] = dumps(value)   
-            elif str(ERR) == 'Object of type ndarray is not JSON serializable':
-                data[k] = dumps(v.tolist())
-            elif str(ERR) == 'Object of type MaskedArray is not JSON serializable':
-                data[k] = dumps(v.tolist())
+            data[k] = encode(v, decimals(k))
+        except TypeError:
+            pass
     return data
 
-def utc_to_local(time, tz):
-    ''' Convert UTC time to local time '''
+# Maximum number of points in the time series charts (a minimum and a
+# maximum for each pixel column of a chart)
+BUDGET = 2000
+
+# Rollup columns (see store.rollup), aggregated over the rows left out
+AGGREGATES = {'-min': np.fmin, '-max': np.fmax, '-count': np.add}
+
+def extremes(values, size):
+    ''' Rows of the minimum and maximum of each column of "values" in each
+        bucket of "size" consecutive rows, the first row of buckets with no
+        data (so that gaps are still drawn), and the first and last rows.
+        Returns sorted row numbers. '''
+    n = len(values)
+    nbuckets = -(-n // size)
+    v = np.full((nbuckets * size, values.shape[1]), np.nan)
+    v[:n] = values
+    v = v.reshape(nbuckets, size, values.shape[1])
+    missing = np.isnan(v)
+    low = np.where(missing, np.inf, v).argmin(axis=1)
+    high = np.where(missing, -np.inf, v).argmax(axis=1)
+    has = ~missing.all(axis=1)
+    base = np.arange(nbuckets)[:, None] * size
+    empty = ~has.any(axis=1)
+    return np.unique(np.concatenate(((base + low)[has], (base + high)[has],
+        base[empty, 0], [0, n - 1])))
 
-    time = datetime(time.year, time.month, time.day, time.hour, time.minute, 0, 0, pytz.UTC)
-    return time.astimezone(pytz.timezone(tz))
+def downsample(sub, budget=BUDGET):
+    ''' Reduce the time series to at most "budget" rows (shared by all
+        variables) by min-max decimation: the rows of the minimum and maximum
+        of each variable in buckets of consecutive rows, at the times they
+        occur. The number of buckets is the largest whose rows fit in the
+        budget. Rollup columns are not decimated, but aggregated over the
+        rows each row kept stands for: minimum of '-min', maximum of '-max'
+        and sum of '-count'. '''
+    n = len(sub)
+    if n <= budget:
+        return sub
+    rollups = [key for key in sub if key.endswith(tuple(AGGREGATES))]
+    series = [key for key in sub if key not in rollups]
+    values = sub[series].to_numpy(dtype=float)
+
+    # At most two rows per variable in each bucket (and the first and last)
+    lo, hi = max(1, (budget - 2) // (2 * max(1, len(series)))), budget // 2
+    rows = extremes(values, -(-n // lo))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        found = extremes(values, -(-n // mid))
+        if len(found) <= budget:
+            lo, rows = mid, found
+        else:
+            hi = mid - 1
+
+    out = sub.iloc[rows].copy()
+    for key in rollups:
+        aggregate = AGGREGATES['-' + key.rpartition('-')[2]]
+        column = sub[key].to_numpy(dtype=float)
+        if aggregate is np.add:
+            column = np.nan_to_num(column)
+        out[key] = aggregate.reduceat(column, rows)
+    return out
 
 def send_output(sub, boya):
     ''' Produce output PICKLE file to be sent to web app '''
 
+    # Bound the size of the response whatever the period requested (CSV
+    # files keep every sample)
+    sub = downsample(sub)
+
     if boya == 'Campello':
         timezone = 'Europe/Madrid'
     elif boya == 'Deenish':
         timezone = 'Europe/Dublin'
 
     # Convert UTC time to local time 
-    time = [utc_to_local(i, timezone) for i in sub.index]
+    time = local(sub.index, timezone)
 
     # Get time range
     t0, t1 = time[0], time[-1]
 
-    # Determine first x-axis tick
-    for i in time:
-        if not i.hour and not i.minute:
-            break
-    tick0 = i.strftime('%Y-%m-%d')
+    # Determine first x-axis tick (first midnight)
+    midnight = time[(time.hour == 0) & (time.minute == 0)]
+    tick0 = (midnight[0] if len(midnight) else t1).strftime('%Y-%m-%d')
 
     BUOY = {
-        # Buoy time
-        'time': time,
+        # Buoy time (compact axis, with the rows left out by downsample() as gaps)
+        'time': axis(sub.index, timezone),
         'tick0': tick0,
         't0': t0.strftime('%Y-%m-%d %H:%M'),
         'tf': t1.strftime('%Y-%m-%d %H:%M'),
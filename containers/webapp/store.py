@@ -0,0 +1,220 @@
+'''
+    Columnar, month-partitioned, append-only store of the in-situ history.
+
+    A store is a directory of tables, and each table is a set of monthly
+    partitions: {path}/{table}/{YYYY-MM}. A partition holds one NumPy
+    (*.npy) file per column, plus "time.npy" (nanoseconds since epoch, UTC),
+    which is read memory-mapped. Only the partitions touched by new data are
+    rewritten, and only the partitions that overlap a date range are read.
+
+    A partition is written to a new directory, {YYYY-MM}.{generation}, and
+    then published by atomically replacing the {YYYY-MM} symbolic link, so
+    readers never see a partially written partition. A generation replaced
+    is kept for GRACE seconds, as readers may have resolved the link just
+    before, and removed by a later write of the partition.
+'''
+
+from glob import glob
+import pandas as pd
+import numpy as np
+import shutil
+import json
+import time
+import os
+
+# Seconds a replaced generation is kept for readers (see publish)
+GRACE = 60
+
+def month(t):
+    ''' Partition (YYYY-MM) of a timestamp '''
+    return f'{t.year:04d}-{t.month:02d}'
+
+def partitions(path, table):
+    ''' Sorted list of partitions (YYYY-MM) in table '''
+    pattern = f'{path}/{table}/[0-9][0-9][0-9][0-9]-[0-9][0-9]'
+    return sorted(os.path.basename(p) for p in glob(pattern))
+
+def overlapping(path, table, t0=None, t1=None):
+    ''' Sorted list of partitions in table overlapping the period t0 to t1 '''
+    names = partitions(path, table)
+    if t0 is not None:
+        names = [name for name in names if name >= month(t0)]
+    if t1 is not None:
+        names = [name for name in names if name <= month(t1)]
+    return names
+
+def generations(path, table, t0=None, t1=None):
+    ''' Published versions of the partitions overlapping t0 to t1 (the
+        directories linked, {YYYY-MM}.{generation}). These change whenever
+        any of the data in the period is written again. '''
+    return [os.readlink(f'{path}/{table}/{name}') for name in overlapping(path, table, t0, t1)]
+
+def write_partition(path, table, name, df):
+    ''' Write a data frame, indexed by UTC time, as partition "name" '''
+    folder = f'{path}/{table}'
+    os.makedirs(folder, exist_ok=True)
+
+    new = f'{folder}/{name}.{time.time_ns()}'
+    os.makedirs(new)
+    np.save(f'{new}/time.npy', df.index.asi8)
+    for key in df.columns:
+        values = df[key].to_numpy()
+        # Strings (e.g. file names) as fixed-width arrays, not pickled objects
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(f'{new}/{key}.npy', values)
+    with open(f'{new}/columns.json', 'w') as f:
+        json.dump(list(df.columns), f)
+
+    publish(f'{folder}/{name}', new)
+
+def publish(link, new):
+    ''' Publish directory "new" ({link}.{generation}) by atomically replacing
+        the symbolic link "link". The generation replaced is not removed:
+        readers may have resolved the link before it changed and still be
+        reading it (see remove_replaced). A directory at "link" (e.g. a store
+        built in place) is first moved aside, as the generation before. '''
+    if os.path.isdir(link) and not os.path.islink(link):
+        os.rename(link, f'{link}.{int(new.rsplit(".", 1)[1]) - 1}')
+    tmp = f'{link}.link'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(new), tmp)
+    os.replace(tmp, link)
+    remove_replaced(link)
+
+def remove_replaced(prefix):
+    ''' Remove generations {prefix}.{generation} replaced more than GRACE
+        seconds ago (each was replaced when the next one was written). The
+        last two, the current one and the one it replaced, are kept. '''
+    names = sorted(glob(f'{prefix}.[0-9]*'), key=lambda p: int(p.rsplit('.', 1)[1]))
+    now = time.time_ns()
+    for old, following in zip(names[:-2], names[1:]):
+        if now - int(following.rsplit('.', 1)[1]) > GRACE * 10**9:
+            shutil.rmtree(old, ignore_errors=True)
+
+def read_partition(path, table, name, columns=None):
+    ''' Read a partition as a data frame indexed by UTC time. Columns are
+        memory-mapped, and only "columns" (default all) are read. '''
+    folder = os.path.realpath(f'{path}/{table}/{name}')
+    with open(f'{folder}/columns.json', 'r') as f:
+        keys = json.load(f)
+    if columns is not None:
+        keys = [key for key in keys if key in columns]
+    index = pd.to_datetime(np.load(f'{folder}/time.npy', mmap_mode='r'), utc=True)
+    data = {key: np.load(f'{folder}/{key}.npy', mmap_mode='r', allow_pickle=False)
+            for key in keys}
+    return pd.DataFrame(data, index=pd.DatetimeIndex(index, name='time'))
+
+def window(df, t0=None, t1=None, closed='both'):
+    ''' Rows of a data frame (sorted by time) between t0 and t1, found by
+        binary search on the index. "closed" is 'both', 'left', 'right' or
+        'neither', i.e. which bounds are included. Returns a slice (view),
+        no data are copied. '''
+    time = df.index
+    i0, i1 = 0, len(time)
+    if t0 is not None:
+        i0 = time.searchsorted(t0, side='left' if closed in ('both', 'left') else 'right')
+    if t1 is not None:
+        i1 = time.searchsorted(t1, side='right' if closed in ('both', 'right') else 'left')
+    return df.iloc[i0 : max(i0, i1)]
+
+def read_table(path, table, t0=None, t1=None, columns=None, freq=None, closed='both'):
+    ''' Read the rows of table between t0 and t1 (default all), as in
+        window(). Only the partitions that overlap the period are read. If
+        "freq" is given, the result is reindexed to a continuous time axis,
+        with NaN for gaps between partitions. '''
+    names = overlapping(path, table, t0, t1)
+    if not names:
+        return pd.DataFrame()
+    df = pd.concat([read_partition(path, table, name, columns) for name in names])
+    df = window(df, t0, t1, closed)
+    if freq and len(df):
+        df = df.reindex(pd.date_range(df.index[0], df.index[-1], freq=freq, name='time'))
+    return df
+
+def read_chunks(path, table, t0=None, t1=None, columns=None, freq=None, closed='both'):
+    ''' Rows of read_table(), one partition at a time (a generator), so that
+        long periods are read in constant memory. If "freq" is given, each
+        chunk is reindexed to the continuous time axis from the end of the
+        previous chunk, so the chunks join as the rows of read_table(). '''
+    names = overlapping(path, table, t0, t1)
+    last = None
+    for name in names:
+        df = window(read_partition(path, table, name, columns), t0, t1, closed)
+        if not len(df):
+            continue
+        if freq:
+            first = df.index[0] if last is None else last + pd.tseries.frequencies.to_offset(freq)
+            df = df.reindex(pd.date_range(first, df.index[-1], freq=freq, name='time'))
+            last = df.index[-1]
+        yield df
+
+def extent(path, table):
+    ''' First and last times in table '''
+    names = partitions(path, table)
+    if not names:
+        return pd.DatetimeIndex([], tz='UTC')
+    first = os.path.realpath(f'{path}/{table}/{names[0]}')
+    last = os.path.realpath(f'{path}/{table}/{names[-1]}')
+    return pd.to_datetime([np.load(f'{first}/time.npy', mmap_mode='r')[0],
+        np.load(f'{last}/time.npy', mmap_mode='r')[-1]], utc=True)
+
+def nearest(path, table, t):
+    ''' Times of the last row before "t" and of the first row at or after
+        "t" in table (None if there is none). Only the times of the
+        partitions from the month of "t" outwards are read, until found. '''
+    names, value = partitions(path, table), pd.Timestamp(t).value
+    times = lambda name: np.load(f'{os.path.realpath(f"{path}/{table}/{name}")}/time.npy',
+            mmap_mode='r')
+    before = after = None
+    for name in reversed([name for name in names if name <= month(t)]):
+        time = times(name)
+        i = np.searchsorted(time, value)
+        if i:
+            before = pd.Timestamp(time[i - 1], tz='UTC')
+            break
+    for name in [name for name in names if name >= month(t)]:
+        time = times(name)
+        i = np.searchsorted(time, value)
+        if i < len(time):
+            after = pd.Timestamp(time[i], tz='UTC')
+            break
+    return before, after
+
+def previous(path, table, name, n):
+    ''' Last "n" rows of the partition before "name", or None '''
+    names = [p for p in partitions(path, table) if p < name]
+    if not names:
+        return None
+    return read_partition(path, table, names[-1]).iloc[-n:]
+
+def rollup(df, freq, angles=()):
+    ''' Aggregate a data frame indexed by time into bins of "freq". Each
+        column gives its mean, minimum, maximum and number of values (not
+        missing), as {column}, {column}-min, {column}-max, {column}-count.
+        Columns in "angles" (degrees) are averaged as unit vectors. '''
+    bins = df.resample(freq)
+    mean, low, high, count = bins.mean(), bins.min(), bins.max(), bins.count()
+    for key in angles:
+        rad = np.deg2rad(df[key])
+        sin, cos = np.sin(rad).resample(freq).mean(), np.cos(rad).resample(freq).mean()
+        mean[key] = np.rad2deg(np.arctan2(sin, cos)) % 360
+    out = {}
+    for key in df.columns:
+        out[key], out[f'{key}-min'], out[f'{key}-max'], out[f'{key}-count'] = \
+                mean[key], low[key], high[key], count[key]
+    return pd.DataFrame(out, index=mean.index)
+
+def append_records(path, table, new, key):
+    ''' Append new rows to table. Rows already in the table with the same
+        value of column "key" are replaced. Returns the partitions touched. '''
+    touched = []
+    for name, rows in new.groupby(new.index.strftime('%Y-%m')):
+        if os.path.islink(f'{path}/{table}/{name}'):
+            old = read_partition(path, table, name)
+            old = old[~old[key].isin(rows[key])]
+            rows = pd.concat([old, rows])
+        write_partition(path, table, name, rows.sort_index(kind='stable'))
+        touched.append(name)
+    return touched
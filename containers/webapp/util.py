@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
-from wind_rose import wind_rose
+from wind_rose import wind_rose, frequencies
 from output import send_output
 from pytz import timezone
-from pickle import load
+from store import read_table, read_chunks, extent, partitions, generations, nearest
+from roseindex import rose_frequencies
 import numpy as np
 import to_csv
 import json
@@ -13,83 +14,127 @@ def prepare_wind_rose(r, D):
 
     return np.vstack((r, D)).T
 
-def windrose(sub, level='surface', vartype='currents'):
-    ''' Create wind rose figure and associated time series '''
-    series = dict(time=sub.index,
-            speed=sub.get(f's-{level}'),
-            direction=sub.get(f'd-{level}'))
+def windrose(sub, level='surface', vartype='currents', frequency=None, dates=None):
+    ''' Create wind rose figure and associated time series. The first and
+        last dates of the title are those of "sub", unless given as "dates"
+        (then "sub" may be None if "frequency" is given). '''
+    if sub is None:
+        series, data = None, None
+    else:
+        series = dict(time=sub.index,
+                speed=sub.get(f's-{level}'),
+                direction=sub.get(f'd-{level}'))
+        data = prepare_wind_rose(sub.get(f's-{level}'), sub.get(f'd-{level}'))
 
-    # Subset for the last 24 hours
-    time, r, D = sub.index, sub.get(f's-{level}'), sub.get(f'd-{level}')
+    time = sub.index if dates is None else dates
     # Create figure
-    idate, edate, wind_rose_fig = wind_rose(time, prepare_wind_rose(r, D), vartype)
-    # Fix legend
-    if 'wave' in level:
-        wind_rose_fig = wind_rose_fig.replace("strength", "period")
-    else:
-        wind_rose_fig = wind_rose_fig.replace("strength", "speed")
+    idate, edate, wind_rose_fig = wind_rose(time, data, vartype, frequency,
+            'period' if 'wave' in level else 'speed')
     # Wrap 
     fig = {'idate': idate, 'edate': edate, 'fig': wind_rose_fig}
 
     return series, fig
 
-def address_request(start, end, uv, boya, language='en'):
-    ''' Subset in-situ data for the requested dates '''
-
-    # Load historical buoy data
+def windroses(sub, levels, frequency=None, dates=None):
+    ''' Wind roses of several levels, given as (level, vartype) pairs. The
+        histograms of all levels are computed at once, unless already
+        given as "frequency" (e.g. from the wind rose index). '''
+    if frequency is None:
+        data = [(prepare_wind_rose(sub.get(f's-{level}'), sub.get(f'd-{level}')), vartype)
+                for level, vartype in levels]
+        frequency = frequencies(data)
+    return [windrose(sub, level, vartype, f, dates)
+            for (level, vartype), f in zip(levels, frequency)]
+
+# Wind roses of each buoy (level, vartype)
+ROSES = {
+    'Campello': [('surface', 'currents'), ('15m', 'currents'), ('wind', 'wind'), ('wave', 'wave')],
+    'Deenish': [('surface', 'currents'), ('seabed', 'currents')],
+}
+
+# Rollup tiers of the historical store (coarsest first) and their time step
+TIERS = (('1D', timedelta(days=1)), ('1H', timedelta(hours=1)))
+
+# Minimum number of points in the time series of a historical request
+MIN_POINTS = 1000
+
+def tier(boya, t0, t1):
+    ''' Coarsest table of the store giving at least MIN_POINTS from t0 to t1 '''
+    for table, step in TIERS:
+        if (t1 - t0) / step >= MIN_POINTS and partitions(store(boya), table):
+            return table
+    return '10T'
+
+def store(boya):
+    ''' Historical store of buoy '''
     if boya == 'Campello':
-        f = '/data/his/El-Campello/El-Campello.pkl'
+        return '/data/his/El-Campello/store'
     elif boya == 'Deenish':
-        f = '/data/his/Deenish-Island/Deenish-Island.pkl'
-    with open(f, 'rb') as f:
-        var = load(f)
+        return '/data/his/Deenish-Island/store'
 
-    # Subset for the requested time period
+def timelist(boya):
+    ''' First and last times of historical buoy data, for the calendars '''
+    return extent(store(boya), '10T')
+
+def period(start, end):
+    ''' Period [t0, t1) of the requested dates (UTC), from the first date to
+        the end of the last one '''
     t0 = timezone('UTC').localize(datetime.strptime(start, '%Y-%m-%d'))
     t1 = timezone('UTC').localize(datetime.strptime(end,   '%Y-%m-%d'))
     if t0 > t1: 
         t0, t1 = t1, t0
-        start, end = end, start
-    t1 += timedelta(days=1)
-    
-    sub = subset(var, t0, t1)
+    return t0, t1 + timedelta(days=1)
+
+def available(boya, t0, t1):
+    ''' Period [t0, t1), or if there are no data in it (e.g. dates in a gap,
+        or after the last data) the period of as many days with the nearest
+        data '''
+    before, after = nearest(store(boya), '10T', t0)
+    if after is not None and after < t1 or before is None and after is None:
+        return t0, t1
+    day = timedelta(days=1)
+    if after is None or before is not None and t0 - before <= after - t1:
+        end = before.floor('D') + day
+        return end - (t1 - t0), end
+    start = after.floor('D')
+    return start, start + (t1 - t0)
 
-    # Surface currents
-    surface_series, surface_fig = windrose(sub)
-    # Seabed currents
-    if boya == 'Campello':
-        seabed_series, seabed_fig = windrose(sub, level='15m')
-        # Winds 
-        wind_series, wind_fig = windrose(sub, level='wind', vartype='wind')
-        # Wave period
-        wave_series, wave_fig = windrose(sub, level='wave', vartype='wave')
-    elif boya == 'Deenish':
-        seabed_series, seabed_fig = windrose(sub, level='seabed')
+def address_request(start, end, uv, boya, language='en'):
+    ''' Subset in-situ data for the requested dates (or the nearest dates
+        with data, see available) '''
 
-    ''' Output dictionary '''
-    data = send_output(sub, boya)        
+    # Subset for the requested time period
+    t0, t1 = available(boya, *period(start, end))
+
+    # Time series from the coarsest rollup tier with enough points for the
+    # period, rather than every 10-minute sample (only the months in the
+    # requested period are read)
+    table = tier(boya, t0, t1)
+    sub = read_table(store(boya), table, t0, t1, freq=table, closed='left')
+
+    # Wind rose histograms of the requested dates from the index (cumulative
+    # daily counts), rather than binning every sample of the period. The
+    # 10-minute table is only read for them if the index is not built.
+    levels = ROSES[boya]
+    frequency = rose_frequencies(store(boya), t0, t1, [level for level, _ in levels])
+    rose = sub if table == '10T' else None
+    if frequency is None and rose is None:
+        rose = read_table(store(boya), '10T', t0, t1, freq='10T', closed='left')
+
+    # First and last dates of the wind roses: the period, within the data
+    first, last = timelist(boya)
+    dates = [max(t0, first), min(t1 - timedelta(minutes=10), last)]
 
-    ''' Generate CSV files '''
-    # Adapt HISTORY data to the shape expected by the CSV functions
-    csvdata = sub ; #csvdata = csvformat(data, boya)
-    # Make CSV's 
     if boya == 'Campello':
-        buoyvars = ('temp', 'tur', 'O2')
+        # Surface and 15-meter depth currents, winds and wave period
+        (surface_series, surface_fig), (seabed_series, seabed_fig), \
+        (wind_series, wind_fig), (wave_series, wave_fig) = windroses(rose, levels, frequency, dates)
     elif boya == 'Deenish':
-        buoyvars = ('temp', 'salt', 'pH', 'O2', 'RFU', 'BGA')
+        # Surface and seabed currents
+        (surface_series, surface_fig), (seabed_series, seabed_fig) = windroses(rose, levels, frequency, dates)
 
-    for i in buoyvars:
-        to_csv.to_csv(csvdata, start, end, i, language, write_forecast=False)
-
-    if boya == 'Campello':
-        # Make CSV for Significant Wave Height
-        to_csv.to_csv_swh(csvdata, start, end, language, write_forecast=False)
-        # Make CSV for wave period and direction
-        to_csv.to_csv_wave_rose(csvdata, start, end, language, write_forecast=False)
-        # Make CSV for wind
-        to_csv.to_csv_wind(csvdata, start, end, language, write_forecast=False)
-    # Make CSV for surface and seabed currents
-    to_csv.to_csv_currents_rose(csvdata, start, end, language, boya)
+    ''' Output dictionary '''
+    data = send_output(sub, boya)
 
     # Add surface currents figure
     data['surf_rose_fig']=surface_fig.get('fig')
@@ -114,6 +159,19 @@ def address_request(start, end, uv, boya, language='en'):
 
     return data 
 
+def csv_export(boya, variable, start, end, language='en'):
+    ''' Key of CSV "variable" of buoy for the requested dates in the export
+        cache, and its text as a generator (see to_csv.csv_lines). The key
+        includes the generations of the partitions read, so it changes when
+        the data do. The historical store is read one partition at a time,
+        as the text is consumed. '''
+    t0, t1 = period(start, end)
+    key = (boya, variable, t0.isoformat(), t1.isoformat(), language,
+            tuple(generations(store(boya), '10T', t0, t1)))
+    chunks = read_chunks(store(boya), '10T', t0, t1, to_csv.columns(variable, boya),
+            freq='10T', closed='left')
+    return key, to_csv.csv_lines(chunks, variable, boya, language)
+
 def csvformat(data, boya):
     ''' The CSV generating functions are not prepared to handle
         the historical data, since different variable names have
@@ -156,16 +214,3 @@ def csvformat(data, boya):
     new['DCP_time'] = new['time']
 
     return new
-
-def subset(buoy, t0, t1):
-    ''' Subset buoy data for the requested time period '''
-    
-    # List of available times in the buoy dataset
-    time = buoy.index
-    
-    # Find appropriate time indexes
-    i0, i1 = np.argmin(abs(time - t0)), np.argmin(abs(time - t1)) + 1
-    
-    sub = buoy[i0 : i1]
-        
-    return sub
@@ -1,113 +1,96 @@
-import plotly.express as px
-import plotly
+from functools import lru_cache
+from hashlib import md5
 import numpy as np
 import json
+import os
 import pandas as pd
 
-def wind_dir_speed_freq(wind_rose_data, boundary_lower_speed, boundary_higher_speed, boundary_lower_direction, boundary_higher_direction):
-    
-    ''' mask for wind speed column '''
-    log_mask_speed = (wind_rose_data[:,0] >= boundary_lower_speed) & (wind_rose_data[:,0] < boundary_higher_speed)
-    
-    ''' mask for wind direction '''
-    log_mask_direction = (wind_rose_data[:,1] >= boundary_lower_direction) & (wind_rose_data[:,1] < boundary_higher_direction)
-    
-    ''' Application of the filter on the wind_rose_data array '''
-    return wind_rose_data[log_mask_speed & log_mask_direction]
+''' Direction bins '''
+DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+DIRECTIONS_DEG = np.array([0, 22.5, 45, 72.5, 90, 112.5, 135, 157.5, 180, 202.5, 225, 247.5, 270, 292.5, 315, 337.5])
 
-def wind_rose(time, wind_rose_data, vartype):
-    
+''' Distance between the centre of the bin and its edge '''
+STEP = 11.25
+
+''' Direction bin edges (data between 348.75 and 360 are converted to negative) '''
+DIRECTION_EDGES = np.append(DIRECTIONS_DEG - STEP, [DIRECTIONS_DEG[-1] + STEP])
+
+''' Speed bins '''
+SPEED_BINS = {
+    'wind': ['0-5 km/h', '6-11 km/h', '12-19 km/h', '20-28 km/h',
+             '29-38 km/h', '39-49 km/h', '50-61 km/h', '62-74 km/h', '>74 km/h'],
+    'currents': ['0-10 cm/s', '10-20 cm/s', '20-25 cm/s', '25-30 cm/s',
+                 '30-35 cm/s', '35-40 cm/s', '40-45 cm/s', '45-50 cm/s', '>50 cm/s'],
+    'wave': ['0-2 s', '2-3 s', '3-4 s', '4-5 s', '5-6 s',
+             '6-7 s', '7-8 s', '8-9 s', '>9 s'],
+}
+
+''' Speed bin edges (the last edge is the threshold above which outliers are removed) '''
+SPEED_EDGES = {
+    'wind': np.array([0, 5.5, 11.5, 19.5, 28.5, 38.5, 49.5, 61.5, 74.5, 200]),
+    'currents': np.array([0, 10, 20, 25, 30, 35, 40, 45, 50, 200]),
+    'wave': np.array([0, 2, 3, 4, 5, 6, 7, 8, 9, 300]),
+}
+
+''' Wind rose colours '''
+BEAUFORT = ['#AEF1F9', '#96F7DC', '#96F7B4',
+            '#6FF46F', '#73ED12', '#A4ED12',
+            '#DAED12', '#EDC212', '#ED8F12']
+
+''' Figure skeletons are saved here, so plotly is only needed to build them once '''
+SKELETONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wind_rose_skeletons')
+
+''' Figure JSON by hash of input (oldest first), up to MAX_FIGURES '''
+FIGURES, MAX_FIGURES = {}, 256
+
+def histograms(series):
     ''' 
-        This function returns a JSON object representing a wind rose figure.
-        The input "wind_rose_data" must be an Nx2 Numpy array with speed on
-        the left and direction on the right. "vartype" is either 'wind',
-        'currents', or 'wave'.
+        Number of samples in each speed and direction bin for a list of
+        series, given as (wind_rose_data, vartype) pairs. All series are
+        binned together in a single pass. Returns an array with a row of
+        9x16 counts (speed bins first) per series, and the number of
+        samples of each series. Bins include their lower edge only. Missing
+        (NaN) or out-of-range data fall in no bin, but are counted in the
+        number of samples of their series.
     '''
 
-    ''' Return time interval for wind rose title '''
-    idate = time[0]
-    edate = time[-1]
-    
-    wind_rose_df = pd.DataFrame(np.zeros((16*9, 3)), index = None, columns = ('direction', 'strength', 'frequency'))
-    
-    ''' Set direction bins '''
-    directions = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-    directions_deg = np.array([0, 22.5, 45, 72.5, 90, 112.5, 135, 157.5, 180, 202.5, 225, 247.5, 270, 292.5, 315, 337.5])
-    
-    ''' Set speed bins '''
-    if vartype == 'wind':
-        speed_bins = ['0-5 km/h', '6-11 km/h', '12-19 km/h', '20-28 km/h', 
-                      '29-38 km/h', '39-49 km/h', '50-61 km/h', '62-74 km/h', '>74 km/h']
-        
-    elif vartype == 'currents':
-        speed_bins = ['0-10 cm/s', '10-20 cm/s', '20-25 cm/s', '25-30 cm/s', 
-                      '30-35 cm/s', '35-40 cm/s', '40-45 cm/s', '45-50 cm/s', '>50 cm/s']
+    nspeed, ndirection = len(SPEED_EDGES['wind']) - 1, len(DIRECTIONS)
 
-    elif vartype == 'wave':
-        speed_bins = ['0-2 s', '2-3 s', '3-4 s', '4-5 s', '5-6 s',
-                        '6-7 s', '7-8 s', '8-9 s', '>9 s']
+    bins, lengths = [], []
+    for k, (wind_rose_data, vartype) in enumerate(series):
+        speed, direction = np.asarray(wind_rose_data, dtype=float).reshape(-1, 2).T
+
+        ''' Converting data between 348.75 and 360 to negative '''
+        direction = np.where((direction >= DIRECTION_EDGES[-1]) & (direction < 360),
+                direction - 360, direction)
+
+        ''' Bin of each sample (NaN is sorted after the last edge) '''
+        i = np.searchsorted(SPEED_EDGES[vartype], speed, side='right') - 1
+        j = np.searchsorted(DIRECTION_EDGES, direction, side='right') - 1
+        valid = (i >= 0) & (i < nspeed) & (j >= 0) & (j < ndirection)
+
+        bins.append((k * nspeed + i[valid]) * ndirection + j[valid])
+        lengths.append(len(speed))
+
+    counts = np.bincount(np.concatenate(bins), minlength=len(series) * nspeed * ndirection)
+    return counts.reshape(len(series), nspeed * ndirection), np.array(lengths)
+
+def frequencies(series):
+    ''' Frequency (%) of each speed and direction bin for a list of series,
+        as in histograms(). Returns an array with a row per series. '''
+    counts, lengths = histograms(series)
+    return counts / lengths[:, None] * 100 # [%]
+
+def build_skeleton(vartype):
+    ''' Wind rose figure of "vartype" produced with plotly.express, with
+        zero frequencies. Returns the figure JSON. '''
+    import plotly.express as px
+    import plotly
+
+    wind_rose_df = pd.DataFrame({'direction': DIRECTIONS * 9,
+        'strength': np.repeat(SPEED_BINS[vartype], 16), 'frequency': np.zeros(16*9)})
 
-    
-    ''' Filling in the dataframe with directions and speed bins '''
-    wind_rose_df.direction = directions * 9
-    wind_rose_df.strength = np.repeat(speed_bins, 16)
-    
-    idx = pd.MultiIndex.from_product([speed_bins,
-                                      directions_deg],
-                                     names=['wind_speed_bins', 'wind_direction_bins'])
-    col = ['frequency']
-    frequencies_df = pd.DataFrame(0, idx, col)
-    
-    ''' Distance between the centre of the bin and its edge '''
-    step = 11.25
-    
-    ''' Converting data between 348.75 and 360 to negative '''
-    for i in range(len(wind_rose_data)):
-        if directions_deg[-1] + step <= wind_rose_data[i,1] and wind_rose_data[i,1] < 360:
-            wind_rose_data[i,1] = wind_rose_data[i,1] - 360
-    
-    ''' Determining the direction bins '''
-    bin_edges_dir = directions_deg - step
-    bin_edges_dir = np.append(bin_edges_dir, [directions_deg[-1]+step]) 
-        
-    ''' Determining speed bins ( the last bin is 50 as above those speeds the outliers were removed for the measurements) '''
-    if vartype == 'wind':
-        threshold_outlier_rm = 200
-        bin_edges_speed = np.array([0, 5.5, 11.5, 19.5, 28.5, 38.5, 49.5, 61.5, 74.5, threshold_outlier_rm])
-        
-    elif vartype == 'currents':
-        threshold_outlier_rm = 200
-        bin_edges_speed = np.array([0, 10, 20, 25, 30, 35, 40, 45, 50, threshold_outlier_rm])
-
-    elif vartype == 'wave':
-        threshold_outlier_rm = 300 
-        bin_edges_speed = np.array([0, 2, 3, 4, 5, 6, 7, 8, 9, threshold_outlier_rm])
-    
-    frequencies = np.array([])
-    ''' Loop selecting given bins and calculating frequencies '''
-    for i in range(len(bin_edges_speed)-1):
-        for j in range(len(bin_edges_dir)-1):
-            bin_contents = wind_dir_speed_freq(wind_rose_data, bin_edges_speed[i], bin_edges_speed[i+1], bin_edges_dir[j], bin_edges_dir[j+1])
-            
-            # applying the filtering function for every bin and checking the number of measurements
-            bin_size = len(bin_contents)
-            frequency = bin_size/len(wind_rose_data)
-            
-            #obtaining the final frequencies of bin
-            frequencies = np.append(frequencies, frequency)
-    
-    ''' Updating the frequencies dataframe '''
-    frequencies_df.frequency = frequencies*100 # [%]
-    
-    ''' This is a "strength", "frequency", "direction" data frame '''
-    wind_rose_df.frequency = frequencies*100 # [%]
-        
-    ''' Use Plotly to produce wind rose from data frame '''
     if vartype == 'wind':
-        BEAUFORT = ['#AEF1F9', '#96F7DC', '#96F7B4', 
-                    '#6FF46F', '#73ED12', '#A4ED12', 
-                    '#DAED12', '#EDC212', '#ED8F12'] 
-       
         fig = px.bar_polar(wind_rose_df, r="frequency", theta="direction",
                         color="strength", template="plotly_dark",
                         color_discrete_sequence=BEAUFORT)
@@ -115,5 +98,62 @@ def wind_rose(time, wind_rose_data, vartype):
         fig = px.bar_polar(wind_rose_df, r="frequency", theta="direction",
                         color="strength", template="plotly_dark",
                         color_discrete_sequence= px.colors.sequential.Plasma_r)
+
+    return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+@lru_cache()
+def skeleton(vartype, legend):
+    ''' Figure skeleton of "vartype" with "legend" as the title of speed
+        bins: a trace per speed bin (with directions, colours and labels),
+        and the layout as JSON. The skeleton is built once and saved to
+        SKELETONS. '''
+    name = f'{SKELETONS}/{vartype}.json'
+    try:
+        with open(name, 'r') as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = build_skeleton(vartype)
+        try:
+            os.makedirs(SKELETONS, exist_ok=True)
+            with open(name + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(name + '.tmp', name)
+        except OSError:
+            pass # Read-only: build it again next time
+    fig = json.loads(text.replace('strength', legend))
+    return fig['data'], json.dumps(fig['layout'])
+
+def figure(vartype, frequency, legend='strength'):
+    ''' Figure JSON of a wind rose, made by injecting the 9x16 frequencies
+        into the skeleton of "vartype". Figures are cached by hash of
+        their input, so an unchanged wind rose is not emitted again. '''
+    frequency = np.ascontiguousarray(frequency, dtype=float)
+    key = md5(f'{vartype} {legend} '.encode() + frequency.tobytes()).hexdigest()
+    if key not in FIGURES:
+        traces, layout = skeleton(vartype, legend)
+        data = [dict(trace, r=frequency[16*k : 16*(k+1)].tolist())
+                for k, trace in enumerate(traces)]
+        if len(FIGURES) >= MAX_FIGURES:
+            FIGURES.pop(next(iter(FIGURES)))
+        FIGURES[key] = '{"data": ' + json.dumps(data) + ', "layout": ' + layout + '}'
+    return FIGURES[key]
+
+def wind_rose(time, wind_rose_data, vartype, frequency=None, legend='strength'):
     
-    return idate, edate, json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    ''' 
+        This function returns a JSON object representing a wind rose figure.
+        The input "wind_rose_data" must be an Nx2 Numpy array with speed on
+        the left and direction on the right. "vartype" is either 'wind',
+        'currents', or 'wave'. Frequencies already computed with
+        frequencies() (e.g. for several wind roses at once) can be given
+        as "frequency". "legend" is the title of the speed bins.
+    '''
+
+    ''' Return time interval for wind rose title '''
+    idate = time[0]
+    edate = time[-1]
+
+    if frequency is None:
+        frequency = frequencies([(wind_rose_data, vartype)])[0]
+
+    return idate, edate, figure(vartype, frequency, legend)
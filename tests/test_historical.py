@@ -0,0 +1,65 @@
+'''
+    Historical requests of the webapp (util.address_request) on a synthetic
+    store with a gap in the data.
+
+    Usage:
+
+        python -m pytest tests
+
+'''
+
+import pandas as pd
+import numpy as np
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'containers', 'webapp'))
+from store import write_partition, rollup
+import util
+
+@pytest.fixture
+def deenish(tmp_path, monkeypatch):
+    ''' Store of Deenish Island with data in January and from 10 to 20 March
+        2020 (a gap from February to 9 March), and its hourly rollup '''
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2020-01-01', '2020-03-20', freq='10T', tz='UTC', inclusive='left')
+    time = time[(time < '2020-02-01') | (time >= '2020-03-10')]
+    columns = ['temp', 'salt', 'pH', 'O2', 'RFU', 'BGA',
+            's-surface', 'd-surface', 's-seabed', 'd-seabed']
+    df = pd.DataFrame(rng.uniform(1, 30, (len(time), len(columns))), index=time, columns=columns)
+    for name, chunk in df.groupby(df.index.strftime('%Y-%m')):
+        write_partition(str(tmp_path), '10T', name, chunk)
+        write_partition(str(tmp_path), '1H', name, rollup(chunk, '1H', ['d-surface', 'd-seabed']))
+    monkeypatch.setattr(util, 'store', lambda boya: str(tmp_path))
+    monkeypatch.setattr(util, 'rose_frequencies', lambda *args: None)
+    return df
+
+def test_available(deenish):
+    t0, t1 = util.period('2020-01-05', '2020-01-06')
+    assert util.available('Deenish', t0, t1) == (t0, t1)
+    # Nearer to the end of January, and to 10 March
+    assert util.available('Deenish', *util.period('2020-02-03', '2020-02-04')) == \
+        (pd.Timestamp('2020-01-30', tz='UTC'), pd.Timestamp('2020-02-01', tz='UTC'))
+    assert util.available('Deenish', *util.period('2020-03-05', '2020-03-06')) == \
+        (pd.Timestamp('2020-03-10', tz='UTC'), pd.Timestamp('2020-03-12', tz='UTC'))
+
+def test_request_in_gap(deenish):
+    data = util.address_request('2020-02-10', '2020-02-12', 'false', 'Deenish')
+    assert data['t0'] == '2020-01-29 00:00' and data['tf'] == '2020-01-31 23:50'
+    assert data['idate_surf_rose'] == '2020-Jan-29'
+    assert data['edate_seab_rose'] == '2020-Jan-31'
+
+def test_request_from_rollup(deenish, monkeypatch):
+    # 78 days give more than MIN_POINTS hours: the hourly rollup is read,
+    # and not the 10-minute table (the wind roses come from the index)
+    tables = []
+    read_table = util.read_table
+    monkeypatch.setattr(util, 'read_table', lambda path, table, *args, **kwargs:
+            tables.append(table) or read_table(path, table, *args, **kwargs))
+    monkeypatch.setattr(util, 'rose_frequencies', lambda path, t0, t1, levels:
+            np.full((len(levels), 16 * 9), 100 / 144))
+    data = util.address_request('2020-01-01', '2020-03-18', 'false', 'Deenish')
+    assert tables == ['1H']
+    assert data['idate_surf_rose'] == '2020-Jan-01' and data['edate_surf_rose'] == '2020-Mar-18'